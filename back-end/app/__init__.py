@@ -7,9 +7,13 @@ import rq_dashboard
 from flask import Flask
 from redis import Redis
 
-from app.extensions import db, migrate, cors, mail
+from app.extensions import db, migrate, cors, mail, view_counter, notification_stream, adjacency_cache
 from config import Config
 from app.api import bp as api_bp
+from app.models import user_cache
+from app.utils.cache import count_cache, response_cache
+from app.utils.email import email_dispatcher
+from app.utils.json_provider import get_json_encoder
 
 
 def create_app(config_class=Config):
@@ -26,6 +30,8 @@ def configure_app(app, config_class):
     """加载app配置"""
     app.config.from_object(config_class)
     app.url_map.strict_slashes = False
+    # jsonify 使用的编码器
+    app.json_encoder = get_json_encoder(app.config['JSON_PROVIDER'])
     # 整合rq任务队列
     app.redis = Redis.from_url(app.config["REDIS_URL"])
     app.task_queue = rq.Queue('madblog-tasks', connection=app.redis, default_timeout=3600)  # 设置任务队列中各任务的执行最大超时时间为 1 小时
@@ -45,3 +51,10 @@ def configure_extensions(app):
     migrate.init_app(app)
     cors.init_app(app)
     mail.init_app(app)
+    view_counter.init_app(app)
+    email_dispatcher.init_app(app)
+    notification_stream.init_app(app)
+    adjacency_cache.init_app(app)
+    response_cache.init_app(app)
+    count_cache.init_app(app)
+    user_cache.init_app(app)
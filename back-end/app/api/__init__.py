@@ -9,4 +9,4 @@ from flask import Blueprint
 bp = Blueprint('api', __name__)
 
 # 写在最后是为了防止循环导入，ping.py文件也会导入 bp
-from . import ping,user,tokens,posts,comments,notifications,messages
\ No newline at end of file
+from . import ping,user,tokens,posts,comments,notifications,messages,metrics
\ No newline at end of file
@@ -26,11 +26,14 @@ def verify_password(username,password):
 def verify_token(token):
     """检查token是否有效"""
 
-    g.current_user = User.verify_token(token) if token else None
+    # token 内容留给权限校验使用
+    g.token_claims = User.decode_token(token) if token else None
+    g.current_user = User.from_claims(g.token_claims) if g.token_claims else None
     if g.current_user:
-        # 每次认证通过后（即将访问资源API），更新 last_seen 时间
-        g.current_user.ping()
-        db.session.commit()
+        # 认证通过后（即将访问资源API）更新 last_seen 时间, 同一用户 LAST_SEEN_INTERVAL 秒内只写一次
+        if not g.current_user.seen_recently():
+            g.current_user.ping()
+            db.session.commit()
     return g.current_user is not None
 
 @basic_auth.error_handler
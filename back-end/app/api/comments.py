@@ -10,7 +10,8 @@ from flask import url_for
 from app import db
 from app.api.auth import token_auth
 from app.api.error import bad_request, error_response
-from app.models import Comment, Post, Permission
+from app.models import Comment, Post, Permission, Notification, UnreadCounter, incr_counter
+from app.utils.cache import response_cache
 from app.utils.decorator import permission_required
 from . import bp
 
@@ -44,13 +45,12 @@ def create_comment():
     comment.author = g.current_user
     comment.post = post
     db.session.add(comment)
-    db.session.commit()
-    # 获取当前评论所有的祖先评论的作者
-    users = set()
-    users.add(comment.post.author)
-    if comment.parent:
-        ancestors_authors = {c.author for c in comment.get_ancestors()}
-        users = users|ancestors_authors
+    incr_counter(post, 'comments_count')
+    # 先写入评论, 插入事件生成路径后才能找到祖先评论
+    db.session.flush()
+    # 获取当前评论所有的祖先评论的作者, 增加他们的未读评论计数
+    users = comment.notify_recipients()
+    UnreadCounter.incr([u.id for u in users], 'unread_recived_comments_count')
     # 给所有的祖先评论作者发送通知
     for u in users:
         u.add_notification('unread_recived_comments_count',
@@ -62,11 +62,10 @@ def create_comment():
 
     # 201响应的请求头中要包含一个location
     response.headers['Location']= url_for('api.get_comment',id=comment.id)
-    # 给用户发送新评论的通知
-    post.author.add_notification('unread_recived_comments_count',post.author.new_recived_comments())
     return response
 
 @bp.route('/comments/',methods=["GET"])
+@response_cache.cached('comments', 'users')
 def get_comments():
     """获取所有评论"""
     page = request.args.get('page',1,type=int)
@@ -90,6 +89,10 @@ def update_comment(id):
     json_data = request.json
     if not json_data:
         return bad_request('You must post JSON data.')
+    # 评论的位置(所属文章和父评论)决定了物化路径, 不允许修改
+    if json_data.get('post_id', comment.post_id) != comment.post_id or \
+            json_data.get('parent_id', comment.parent_id) != comment.parent_id:
+        return bad_request('post_id and parent_id cannot be changed.')
 
     comment.from_dict(json_data)
 
@@ -104,20 +107,19 @@ def delete_comment(id):
     if g.current_user != comment.author and g.current_user != comment.post.author and not g.current_user.can(Permission.ADMIN):
         return error_response(403)
 
-    # 获取当前评论所有的祖先评论的作者
-    users = set()
-    users.add(comment.post.author)
-    if comment.parent:
-        ancestors_authors = {c.author for c in comment.get_ancestors()}
-        users = users | ancestors_authors
+    # 评论连同所有回复一起删除, 删除前统计每个通知对象还没读过其中几条, 从未读计数中减掉
+    unread = comment.unread_thread_recipients()
+    UnreadCounter.incr_many({user_id: -count for user_id, count in unread.items()}, 'unread_recived_comments_count')
 
-    db.session.delete(comment)
-    db.session.commit()
+    post_id = comment.post_id
+    comment.delete_thread()
+    # 批量删除不经过模型事件
+    response_cache.invalidate('comments', 'post:%d:comments' % post_id)
 
-    # 给所有的祖先评论作者发送通知
-    for u in users:
-        u.add_notification('unread_recived_comments_count',
-                           u.new_recived_comments())
+    # 给未读计数变化的用户发送通知
+    Notification.bulk_replace('unread_recived_comments_count',
+                              UnreadCounter.get_many(unread, 'unread_recived_comments_count'))
+    db.session.commit()
 
     return '', 204
 
@@ -129,6 +131,7 @@ def like_comment(id):
     comment = Comment.query.get_or_404(id)
     comment.liked_by(g.current_user)
     db.session.add(comment)
+    comment.author.add_notification('unread_likes_count', comment.author.new_likes())
     db.session.commit()
 
     return jsonify({
@@ -144,6 +147,7 @@ def unlike_comment(id):
     comment = Comment.query.get_or_404(id)
     comment.un_liked_by(g.current_user)
     db.session.add(comment)
+    comment.author.add_notification('unread_likes_count', comment.author.new_likes())
     db.session.commit()
 
     return jsonify({
@@ -27,6 +27,11 @@ def bad_request(message):
     '''最常用的错误 400：错误的请求'''
     return error_response(400,message)
 
+@bp.app_errorhandler(400)
+def bad_request_error(error):
+    """捕获400错误, 如 abort(400, message)"""
+    return error_response(400, error.description)
+
 @bp.app_errorhandler(404)
 def not_found_error(error):
     """捕获404错误"""
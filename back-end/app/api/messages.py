@@ -12,7 +12,7 @@ from flask import url_for
 from app import db
 from app.api.auth import token_auth
 from app.api.error import bad_request, error_response
-from app.models import Message, User
+from app.models import Message, User, UnreadCounter, Conversation
 from . import bp
 
 # restful接口设计
@@ -46,9 +46,11 @@ def create_message():
     message.sender = g.current_user
     message.recipient = user
     db.session.add(message)
-    db.session.commit()
-
+    db.session.flush()
+    Conversation.incr(g.current_user.id, [user.id])
+    UnreadCounter.incr(user.id, 'unread_messages_count')
     user.add_notification('unread_messages_count',user.new_recived_messages())
+    db.session.commit()
 
     response = jsonify(message.to_dict())
     response.status_code = 201
@@ -98,9 +100,15 @@ def delete_message(id):
     message = Message.query.get_or_404(id)
     if g.current_user != message.sender:
         return error_response(403)
+    recipient = message.recipient
+    # 对方还没读过的私信被删除时, 减少对方的未读计数
+    unread = message.timestamp > (recipient.last_messages_read_time or datetime.min)
+    if unread:
+        UnreadCounter.incr(recipient.id, 'unread_messages_count', -1)
     db.session.delete(message)
+    db.session.flush()
+    Conversation.remove(message.sender_id, recipient.id, unread)
+    recipient.add_notification('unread_messages_count',recipient.new_recived_messages())
     db.session.commit()
 
-    message.recipient.add_notification('unread_messages_count',message.recipient.new_recived_messages())
-
     return '',204
@@ -0,0 +1,26 @@
+"""
+File:metrics.py
+Author:laoyang
+"""
+from flask import jsonify
+
+from app.api.auth import token_auth
+from app.extensions import view_counter
+from app.utils.cache import response_cache
+from app.utils.decorator import admin_required
+from . import bp
+
+
+@bp.route('/metrics', methods=['GET'])
+@token_auth.login_required
+@admin_required
+def get_metrics():
+    """运行指标"""
+    return jsonify({
+        'pending_views': view_counter.pending(),
+        'response_cache': {
+            'hits': response_cache.stats['hits'],
+            'misses': response_cache.stats['misses'],
+            'not_modified': response_cache.stats['not_modified'],
+        },
+    })
@@ -2,11 +2,15 @@
 File:notifications.py
 Author:Young
 """
-from flask import g, jsonify
+import json
+from time import time
+
+from flask import g, jsonify, Response, current_app
 from flask import request
 
 from app.api.auth import token_auth
 from app.api.error import error_response
+from app.extensions import db, notification_stream
 from app.models import Notification
 from . import bp
 
@@ -19,3 +23,73 @@ def get_notification(id):
         return error_response(403)
     data = notification.to_dict()
     return jsonify(data)
+
+
+def _subscribe(id, since):
+    """先订阅再查询 since 之后的通知, 避免漏掉两者之间发布的通知"""
+    subscription = notification_stream.subscribe(id)
+    events = Notification.events_since(id, since)
+    # 结束只读事务, 把数据库连接还给连接池, 等待推送期间不占用连接
+    db.session.commit()
+    return subscription, events
+
+
+@bp.route('users/<int:id>/notifications/poll', methods=["GET"])
+@token_auth.login_required
+def poll_user_notifications(id):
+    """长轮询: since 之后有通知时立即返回, 否则等待新通知或超时后返回空列表"""
+    if g.current_user.id != id:
+        return error_response(403)
+    since = request.args.get('since', 0.0, type=float)
+    limit = current_app.config['NOTIFICATION_POLL_TIMEOUT']
+    timeout = min(request.args.get('timeout', limit, type=float), limit)
+
+    subscription, events = _subscribe(id, since)
+    try:
+        if not events:
+            event = subscription.get(timeout)
+            while event is not None:
+                events.append(event)
+                # 同时到达的通知一起返回
+                event = subscription.get(0)
+    finally:
+        subscription.close()
+    return jsonify(events)
+
+
+@bp.route('users/<int:id>/notifications/stream', methods=["GET"])
+@token_auth.login_required
+def stream_user_notifications(id):
+    """Server-Sent Events: 先补发 since(或 Last-Event-ID)之后的通知, 之后有新通知立即推送"""
+    if g.current_user.id != id:
+        return error_response(403)
+    since = request.args.get('since', type=float)
+    if since is None:
+        try:
+            since = float(request.headers.get('Last-Event-ID', 0))
+        except ValueError:
+            since = 0.0
+    timeout = current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+    heartbeat = current_app.config['NOTIFICATION_HEARTBEAT']
+    subscription, events = _subscribe(id, since)
+
+    def format_event(event):
+        return 'id: {}\ndata: {}\n\n'.format(event['timestamp'], json.dumps(event))
+
+    def generate():
+        try:
+            for event in events:
+                yield format_event(event)
+            deadline = time() + timeout
+            while True:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                event = subscription.get(min(heartbeat, remaining))
+                # 没有通知时发送注释行作为心跳, 及时发现断开的连接
+                yield format_event(event) if event is not None else ': keep-alive\n\n'
+        finally:
+            subscription.close()
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
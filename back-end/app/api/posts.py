@@ -2,16 +2,22 @@
 File:posts.py
 Author:Young
 """
-from flask import abort
+from datetime import datetime
+from operator import itemgetter
+
 from flask import current_app
 from flask import g
 from flask import request, jsonify
 from flask import url_for
+from sqlalchemy import func
 
 from app import db
 from app.api.auth import token_auth
 from app.api.error import bad_request, error_response
-from app.models import Post, Comment, Permission
+from app.extensions import view_counter
+from app.models import Post, Comment, Permission, User, UnreadCounter, Timeline, Notification, followers, \
+    incr_counter
+from app.utils.cache import response_cache
 from app.utils.decorator import permission_required
 from . import bp
 
@@ -25,6 +31,7 @@ from . import bp
 # delete api/posts/<id> 删除一篇博客
 
 @bp.route('/posts/', methods=["GET"])
+@response_cache.cached('posts')
 def get_posts():
     """获取所有文章"""''
     page = request.args.get('page', 1, type=int)
@@ -58,6 +65,12 @@ def create_post():
     post.from_dict(json_data)
     post.author = g.current_user  # 通过 auth.py 中 verify_token() 传递过来的（同一个request中，需要先进行 Token 认证）
     db.session.add(post)
+    incr_counter(g.current_user, 'posts_count')
+    # 粉丝的 "关注的人发布的文章" 未读计数加一
+    UnreadCounter.incr(db.session.query(followers.c.follower_id).filter(
+        followers.c.followed_id == g.current_user.id), 'unread_followeds_posts_count')
+    # 写入粉丝的首页时间线
+    Timeline.push(post)
     db.session.commit()
     response = jsonify(post.to_dict())
     response.status_code = 201
@@ -69,13 +82,11 @@ def create_post():
 @bp.route('/posts/<int:id>', methods=["GET"])
 def get_post(id):
     """获取一篇文章"""
-    post = Post.query.get_or_404(id)
-    if not post:
-        abort(404)
-    post.views += 1
-    db.session.add(post)
-    db.session.commit()
-    return jsonify(post.to_dict())
+    response = response_cache.respond(['post:%d' % id], lambda: jsonify(Post.query.get_or_404(id).to_dict()))
+    # 阅读数先记在内存中, 由后台线程批量写入, 读文章不再提交事务; 命中响应缓存时也要计数.
+    # 文章不存在时 get_or_404 抛出异常, 不会为任意的 id 记录阅读数
+    view_counter.incr(id)
+    return response
 
 
 @bp.route('/posts/<int:id>', methods=["PUT"])
@@ -110,13 +121,22 @@ def update_post(id):
 def delete_post(id):
     """删除一篇文章"""
     post = Post.query.get_or_404(id)
-    if post.id != g.current_user.id and not g.current_user.can(Permission.ADMIN):  # 管理员也可以删除文章
+    if post.author_id != g.current_user.id and not g.current_user.can(Permission.ADMIN):  # 管理员也可以删除文章
         return error_response(403)
+    # 还没看过这篇文章的粉丝, 未读计数减一
+    unread_followers = db.session.query(followers.c.follower_id).join(User, User.id == followers.c.follower_id).filter(
+        followers.c.followed_id == post.author_id,
+        func.coalesce(User.last_followeds_posts_read_time, datetime.min) < post.timestamp)
+    UnreadCounter.incr(unread_followers, 'unread_followeds_posts_count', -1)
+    Timeline.remove_post(post.id)
+    incr_counter(post.author, 'posts_count', -1)
     db.session.delete(post)
 
-    for user in post.author.followers:
-        user.add_notification('unread_followeds_posts_count',
-                              user.new_followeds_posts())
+    # 一次读取所有粉丝的计数, 批量更新通知
+    follower_ids = [row[0] for row in db.session.query(followers.c.follower_id).filter(
+        followers.c.followed_id == post.author_id)]
+    Notification.bulk_replace('unread_followeds_posts_count',
+                              UnreadCounter.get_many(follower_ids, 'unread_followeds_posts_count'))
 
     db.session.commit()
 
@@ -124,21 +144,49 @@ def delete_post(id):
 
 
 @bp.route('/posts/<int:id>/comments/', methods=["GET"])
+@response_cache.cached('post:{id}:comments', 'users')
 def get_post_comments(id):
-    """获取文章下的所有评论"""
+    """获取文章下的所有评论
+
+    每条一级评论的子孙按时间平铺在 descendants 中; format=nested 时改为按回复关系嵌套在 replies 中.
+    max_depth 限制返回的回复层数"""
     post = Post.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
     per_page = min(
         request.args.get(
             'per_page', current_app.config['COMMENTS_PER_PAGE'], type=int), 100)
-    data = Comment.to_collection_dict(post.comments.filter(Comment.parent
+    max_depth = request.args.get('max_depth', type=int)
+    nested_format = request.args.get('format') == 'nested'
+    kwargs = {}
+    if max_depth is not None:
+        kwargs['max_depth'] = max_depth
+    if nested_format:
+        kwargs['format'] = 'nested'
+    data = Comment.to_collection_dict(post.comments.filter(Comment.parent_id
                                                            == None).order_by(Comment.timestamp.desc()), page, per_page,
-                                      'api.get_post_comments', id=id)
-    from operator import itemgetter
+                                      'api.get_post_comments', id=id, **kwargs)
+    # 一次查询取出本页所有一级评论的回复, 在内存中按 parent_id 组装
+    replies = Comment.load_threads([item['id'] for item in data['items']], max_depth)
+
+    def nested(parent_id, depth):
+        if max_depth is not None and depth > max_depth:
+            return []
+        return [dict(c.to_dict(), replies=nested(c.id, depth + 1)) for c in replies.get(parent_id, [])]
+
+    def descendants(root_id):
+        result, stack = [], [root_id]
+        while stack:
+            for c in replies.get(stack.pop(), []):
+                if max_depth is None or c.depth <= max_depth:
+                    result.append(dict(c.to_dict(), depth=c.depth))
+                    stack.append(c.id)
+        return sorted(result, key=itemgetter('timestamp'))
+
     for item in data['items']:
-        comment = Comment.query.get(item['id'])
-        descendants = [child.to_dict() for child in comment.get_descendants()]
-        item['descendants'] = sorted(descendants, keys=itemgetter('timestamp'))
+        if nested_format:
+            item['replies'] = nested(item['id'], 1)
+        else:
+            item['descendants'] = descendants(item['id'])
 
     return jsonify(data)
 
@@ -150,10 +198,9 @@ def like_post(id):
     post = Post.query.get_or_404(id)
     post.liked_by(g.current_user)
     db.session.add(post)
-    # 切记要先提交，先添加喜欢记录到数据库，因为 new_posts_likes() 会查询 posts_likes 关联表
-    db.session.commit()
     # 添加收到的通知
     post.author.add_notification('unread_posts_likes_count', post.author.new_posts_likes())
+    db.session.commit()
     return jsonify({
         'status': 'success',
         'message': 'You are now liking this post.'
@@ -166,11 +213,10 @@ def unlike_post(id):
     """取消喜欢文章"""
     post = Post.query.get_or_404(id)
     post.unliked_by(g.current_user)
-    # 切记要先提交，先添加喜欢记录到数据库，因为 new_posts_likes() 会查询 posts_likes 关联表
     db.session.add(post)
-    db.session.commit()
     # 添加收到的通知
     post.author.add_notification('unread_posts_likes_count', post.author.new_posts_likes())
+    db.session.commit()
     return jsonify({
         'status': 'success',
         'message': 'You are now liking this post.'
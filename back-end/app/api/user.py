@@ -9,13 +9,16 @@ from operator import itemgetter
 from flask import current_app
 from flask import g
 from flask import request, jsonify, url_for
+from sqlalchemy import and_, or_
 
 from app import db
 from app.api.auth import token_auth
 from app.api.error import bad_request, error_response
-from app.models import User, Post, Comment, Notification, Message, posts_likes, Permission, Task
+from app.models import User, Post, Comment, Notification, Message, posts_likes, Permission, Task, followers, \
+    Conversation, UnreadCounter
 from app.utils.decorator import permission_required, admin_required
 from app.utils.email import send_email
+from app.utils.serializer import serialize_collection
 from . import bp
 
 
@@ -79,6 +82,7 @@ def create_user():
         <p><small>Note: replies to this email address are not monitored.</small></p>
         '''.format(user.username, confirm_url)
 
+    # 只把邮件放入发送队列, 不在请求中等待 SMTP
     send_email('[Madblog] Confirm Your Account',
                sender=current_app.config['MAIL_SENDER'],
                recipients=[user.email],
@@ -182,6 +186,7 @@ def follow(id):
     if g.current_user.is_following(user):
         return bad_request("You have already followed that user")
     g.current_user.follow(user)
+    user.add_notification('new_follows_count', user.new_follows())
     db.session.commit()
     return jsonify({
         'status': 'success',
@@ -200,6 +205,7 @@ def unfollow(id):
     if not g.current_user.is_following(user):
         return bad_request('You are not following this user.')
     g.current_user.unfollow(user)
+    user.add_notification('new_follows_count', user.new_follows())
     db.session.commit()
     return jsonify({
         'status': 'success',
@@ -214,15 +220,14 @@ def get_followers(id):
     user = User.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', current_app.config['USERS_PER_PAGE'], type=int), 100)
-
-    data = User.to_collection_dict(user.followers, page, per_page, 'api.get_followers', id=id)
+    # 关注时间和粉丝在同一条查询中取出
+    query = user.followers.add_columns(followers.c.timestamp.label('timestamp')).order_by(
+        followers.c.timestamp.desc())
+    data = User.to_collection_dict(query, page, per_page, 'api.get_followers', id=id)
     # 为每个粉丝添加is_following标准
+    following_ids = g.current_user.following_ids([item['id'] for item in data['items']])
     for item in data['items']:
-        item['is_following'] = g.current.user.is_following(User.query.get(item['id']))
-        res = db.engine.execute(
-            "select * from followers where follower_id={} and followed_id={}".format(user.id, item['id'])
-        )
-        item['timestamp'] = datetime.strptime(list(res)[0][2], '%Y-%m-%d %H:%M:%S.%f')
+        item['is_following'] = item['id'] in following_ids
 
     return jsonify(data)
 
@@ -233,14 +238,16 @@ def get_followeds(id):
     user = User.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', current_app.config['USERS_PER_PAGE'], type=int), 100)
-    data = User.to_collection_dict(user.followeds, page, per_page, 'api.get_followers', id=id)
-    # 为每个关注者添加is_following标志
-    for item in data['items']:
-        item['is_following'] = g.current.user.is_following(User.query.get(item['id']))
-        res = db.engine.execute(
-            "select * from followers where follower_id={} and followed_id={}".format(user.id, item['id'])
-        )
-        item['timestamp'] = datetime.strptime(list(res)[0][2], '%Y-%m-%d %H:%M:%S.%f')
+    query = user.followeds.add_columns(followers.c.timestamp.label('timestamp')).order_by(
+        followers.c.timestamp.desc())
+    data = User.to_collection_dict(query, page, per_page, 'api.get_followeds', id=id)
+    # 匿名访问时没有当前用户, 不返回is_following标志
+    current_user = g.get('current_user')
+    if current_user is not None:
+        # 为每个关注者添加is_following标志
+        following_ids = current_user.following_ids([item['id'] for item in data['items']])
+        for item in data['items']:
+            item['is_following'] = item['id'] in following_ids
 
     return jsonify(data)
 
@@ -254,7 +261,11 @@ def get_user_followed_posts(id):
         request.args.get(
             'per_page', current_app.config['POSTS_PER_PAGE'], type=int), 100)
 
-    data = Post.to_collection_dict(user.followed_posts, page, per_page, 'api.get_user_posts', id=id)
+    data = Post.to_collection_dict(user.timeline_posts, page, per_page, 'api.get_user_followed_posts', id=id)
+    # 标记用户已经收藏过的文章, 一页只判断一次
+    liked_ids = user.liked_post_ids([item['id'] for item in data['items']])
+    for item in data['items']:
+        item['liked'] = item['id'] in liked_ids
 
     return jsonify(data)
 
@@ -283,25 +294,27 @@ def get_user_recived_comments(id):
         return error_response(403)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', current_app.config['COMMENTS_PER_PAGE'], type=int), 100)
-    # 用户发布的所有文章ID集合
-    user_post_ids = [post.id for post in g.current_user.posts.all()]
-    # 评论的posts.id在user_post_ids中,且评论的用户不是当前用户.
+    # 评论的文章属于当前用户,且评论的用户不是当前用户.
     data = Comment.to_collection_dict(
-        Comment.query.filter(Comment.post_id in user_post_ids, Comment.author != g.current_user)
-            .order_by(Comment.mark_read, Comment.timestamp.desc())
-    )
-    # 标记哪些评论是最新的
+        Comment.query.join(Post, Post.id == Comment.post_id).filter(
+            Post.author_id == user.id, Comment.author_id != user.id)
+            .order_by(Comment.mark_read, Comment.timestamp.desc()), page, per_page,
+        'api.get_user_recived_comments', id=id)
+    # 标记哪些评论是最新的, 以及哪些已经点赞过
     last_read_time = user.last_recived_comments_read_time or datetime(1900, 1, 1)
+    liked_ids = user.liked_comment_ids([item['id'] for item in data['items']])
     for item in data['items']:
         if item['timestamp'] > last_read_time:
-            item['is_new'] == True
+            item['is_new'] = True
+        item['liked'] = item['id'] in liked_ids
 
-    if data['_meta']["page"] * data['_meta']["perpage"] >= user.new_recived_comments():
+    new_count = user.new_recived_comments()
+    if page * per_page >= new_count:
         user.last_recived_comments_read_time = datetime.utcnow()
+        UnreadCounter.set(user.id, 'unread_recived_comments_count', 0)
         user.add_notification('unread_recived_comments_count', 0)
     else:
-        n = user.new_recived_comments() - data['_meta']["page"] * data['_meta']["perpage"]
-        user.add_notification('unread_recived_comments_count', n)
+        user.add_notification('unread_recived_comments_count', new_count - page * per_page)
 
     db.session.commit()
 
@@ -321,7 +334,7 @@ def get_user_notifications(id):
         Notification.timestamp > since).order_by(Notification.timestamp.asc()
                                                  )
 
-    return jsonify([n.to_dict() for n in notifications])
+    return jsonify(serialize_collection(Notification, notifications))
 
 
 @bp.route('users/<int:id>/messages-recipients/', methods=["GET"])
@@ -332,26 +345,15 @@ def get_user_messages_recipients(id):
     user = User.query.get_or_404(id)
     if g.current_user != user:
         return error_response(403)
-    page = request.args.get('page', 1, type=1)
+    page = request.args.get('page', 1, type=int)
     per_page = min(
         request.args.get(
             'per_page', current_app.config['MESSAGES_PER_PAGE'], type=int), 100)
-    data = Message.to_collection_dict(
-        user.messages_sent.group_by(Message.recipient_id).order_by(Message.timestamp.desc()), page, per_page,
+    # 会话汇总表中已有最后一条私信、总数和对方的未读数
+    data = Conversation.to_collection_dict(
+        Conversation.query.filter_by(user_id=user.id).order_by(Conversation.timestamp.desc()), page, per_page,
         'api.get_user_messages_recipients', id=id)
 
-    for item in data['items']:
-        # 发给了谁
-        recipient = User.query.get_or_404(item['recipient']['id'])
-        # 发送给这个人的个数
-        item['total_count'] = user.messages_sent.filter_by(recipient_id=item['recipient']['id']).count()
-        last_read_time = recipient.last_messages_read_time or datetime(1900, 0, 0)
-        if item['timestamp'] > last_read_time:
-            item['is_new'] = True
-            # 继续获取发给这个用户的私信有几条是新的
-            item['new_count'] = user.messages_sent.filter_by(recipient_id=item['recipient']['id']).filter(
-                Message.timestamp > last_read_time).count()
-
     return jsonify(data)
 
 
@@ -363,22 +365,19 @@ def get_user_messages_senders(id):
     user = User.query.get_or_404(id)
     if g.current_user != user:
         return error_response(403)
-    page = request.args.get('page', 1, type=1)
+    page = request.args.get('page', 1, type=int)
     per_page = min(
         request.args.get(
             'per_page', current_app.config['MESSAGES_PER_PAGE'], type=int), 100)
-    data = Message.to_collection_dict(
-        user.messages_received.group_by(Message.recipient_id).order_by(Message.timestamp.desc()), page, per_page,
-        'api.get_messages_senders', id=id)
-    last_read_time = user.last_messages_read_time or datetime(1900, 0, 0)
+    data = Conversation.to_collection_dict(
+        Conversation.query.filter_by(peer_id=user.id).order_by(Conversation.timestamp.desc()), page, per_page,
+        'api.get_user_messages_senders', id=id)
     new_items = []
     not_new_items = []
     for item in data['items']:
-        if item['timestamp'] > last_read_time:
-            item['is_new'] = True
+        if item.get('is_new'):
             # 新未读私信的总数
-            item['total_count'] = user.messages_received.filter_by(sender_id=item['sender']['id']).filter(
-                Message.timestamp > last_read_time).count()
+            item['total_count'] = item['new_count']
             new_items.append(item)
         else:
             not_new_items.append(item)
@@ -403,33 +402,29 @@ def get_user_history_messages(id):
     from_id = request.args.get('from', type=int)
     if not from_id:
         return bad_request("You must provide the user id of opposite site")
-    # 对方发给我的message
-    q1 = Message.query.filter(Message.sender_id == from_id, Message.recipient_id == user.id)
-    # 我给对方发送的message
-    q2 = Message.query.filter(Message.sender_id == user.id, Message.recipient_id == from_id)
-    # 按时间正序排序
-    history_messages = q1.union(q2).order_by(Message.timestamp)
-    data = Message.to_collection_dict(history_messages, page, per_page, 'api.get_user_history_messages', id=id)
-    recived_message = [item for item in data['items'] if item['sender']['id'] != id]
-    sent_message = [item for item in data['items'] if item['sender']['id'] == id]
-    last_read_time = user.last_messages_read_time or datetime(1900, 0, 0)
-    new_count = 0
-    for item in recived_message:
-        if item['timestamp'] > last_read_time:
+    # 一条 OR 查询取出双方互发的私信, 两个方向分别走 (sender_id, recipient_id, timestamp) 组合索引;
+    # 带 cursor 参数时按 (timestamp, id) 倒序做游标分页, 向前翻看很久以前的记录也不需要 OFFSET
+    history_messages = Message.query.filter(or_(
+        and_(Message.sender_id == from_id, Message.recipient_id == user.id),
+        and_(Message.sender_id == user.id, Message.recipient_id == from_id))).order_by(Message.timestamp)
+    data = Message.to_collection_dict(history_messages, page, per_page, 'api.get_user_history_messages', id=id,
+                                      **{'from': from_id})
+    last_read_time = user.last_messages_read_time or datetime(1900, 1, 1)
+    new_times = []
+    for item in data['items']:
+        if item['sender']['id'] != id and item['timestamp'] > last_read_time:
             item['is_new'] = True
-            new_count += 1
-    # 未读的私信个数
-    if new_count > 0:
-        user.last_messages_read_time = recived_message[-1]['timestamp']
-        db.session.commit()
-
-        user.add_notification('unread_message_count', user.new_recived_messages())
+            new_times.append(item['timestamp'])
+    # 有未读的私信时更新已读时间
+    if new_times:
+        user.last_messages_read_time = max(new_times)
+        # 已读时间变化后, 用一条索引查询重新得到未读私信数
+        UnreadCounter.set(user.id, 'unread_messages_count', user.messages_received.filter(
+            Message.timestamp > user.last_messages_read_time).count())
+        Conversation.refresh_unread(user)
+        user.add_notification('unread_messages_count', user.new_recived_messages())
         db.session.commit()
 
-    messages = recived_message + sent_message
-    messages.sort(key=data['items'].index)
-
-    data['items'] = messages
     return jsonify(data)
 
 
@@ -511,12 +506,13 @@ def get_user_recived_posts_likes(id):
                 data['post'] = p.to_dict()
                 res = db.engine.execute("select * from posts_likes where user_id={} and post_id={}".format(u.id, p.id))
                 data["timestamp"] = datetime.strptime(list(res)[0][2], "%Y-%m-%d %H:%M:%S.%f")
-                last_read_time = user.last_posts_likes_read_time or datetime(1900, 0, 0)
+                last_read_time = user.last_posts_likes_read_time or datetime(1900, 1, 1)
                 if data["timestamp"] > last_read_time:
                     data["is_new"] = True
                 records['items'].append(data)
     records['items'] = sorted(records['items'], key=itemgetter('timestamp'), reverse=True)
     user.last_posts_likes_read_time = datetime.utcnow()
+    UnreadCounter.set(user.id, 'unread_posts_likes_count', 0)
     user.add_notification('unread_posts_likes_count', 0)
     db.session.commit()
     return jsonify(records)
@@ -598,8 +594,9 @@ def reset_password_request():
                 <p><small>Note: replies to this email address are not monitored.</small></p>
                 '''.format(user.username, json_data.get('confirm_email_base_url') + token)
 
+        # 只把邮件放入发送队列, 不在请求中等待 SMTP
         send_email('[Madblog] Reset Your Password', sender=current_app.config['MAIL_SENDER']
-                   , recipients=[user.username], text_body=text_body, html_body=html_body)
+                   , recipients=[user.email], text_body=text_body, html_body=html_body)
 
         return jsonify({
             'status': 'success',
@@ -644,7 +641,13 @@ def send_messages():
         if 'body' not in json_data and not json_data.get('body'):
             return bad_request({'message':'Body is required'})
 
-        g.current_user.lanuch_tasks('send_messages', '....正在群发短信',kwrags={'user_id': g.current_user.id, 'body': json_data.get('body')})
+        if current_app.config['BROADCAST_JOB_SIZE']:
+            # 按接收者id范围拆成多个子任务, 由所有 worker 并行执行
+            g.current_user.lanuch_broadcast('....正在群发短信', json_data.get('body'))
+        else:
+            g.current_user.lanuch_tasks('send_messages', '....正在群发短信',
+                                        user_id=g.current_user.id, body=json_data.get('body'))
+            db.session.commit()
         return jsonify(message='正在运行群发私信后台任务')
 
 @bp.route('/users/<int:id>/tasks/',methods=["GET"])
@@ -655,6 +658,19 @@ def get_user_tasks_in_progress(id):
         return error_response(403)
     page = request.args.get('page',1,type=int)
     per_page = min(request.args.get('per_page',current_app.config['TASKS_PER_PAGE'],type=int),100)
-    data = Task.to_collection_dict(Task.query.filter_by(user_id=user.id,complate=False).all(),page,per_page,endpoint=url_for('api.get_user_tasks_in_progress',id=id))
+    data = Task.to_collection_dict(Task.query.filter_by(user_id=user.id,complate=False),page,per_page,
+                                   'api.get_user_tasks_in_progress',id=id)
 
-    return jsonify(data)
\ No newline at end of file
+    return jsonify(data)
+
+
+@bp.route('/tasks/<id>/retry', methods=["POST"])
+@token_auth.login_required
+def retry_task(id):
+    """只重新执行任务中失败的子任务"""
+    task = Task.query.get_or_404(id)
+    if g.current_user.id != task.user_id:
+        return error_response(403)
+    retried = task.retry_failed_chunks()
+    db.session.commit()
+    return jsonify(retried=retried)
\ No newline at end of file
@@ -9,6 +9,9 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from sqlalchemy import MetaData
 from flask_mail import Mail
+from app.utils.views import ViewCounter
+from app.utils.stream import NotificationStream
+from app.utils.adjacency import AdjacencyCache
 
 # Flask-Cors plugin
 cors = CORS()
@@ -24,4 +27,10 @@ db = SQLAlchemy(metadata=MetaData(naming_convention=naming_convention))
 # Flask-Migrate plugin
 migrate = Migrate(db=db)
 # Flask-Mail plugin
-mail = Mail()
\ No newline at end of file
+mail = Mail()
+# 文章阅读数写回缓冲
+view_counter = ViewCounter()
+# 用户通知推送通道
+notification_stream = NotificationStream()
+# 关注、拉黑、点赞关系缓存
+adjacency_cache = AdjacencyCache()
@@ -7,45 +7,148 @@ import json
 from _md5 import md5
 
 from datetime import datetime, timedelta
+from functools import lru_cache
+from math import ceil
 from time import time
+from uuid import uuid4
+
 import jwt
+from flask import abort
 from flask import current_app
+from flask import request
 from flask import url_for
-
-from app.extensions import db
+from sqlalchemy import and_, case, func, literal, or_, select, text
+from sqlalchemy.orm import selectinload, validates
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.expression import ClauseElement
+
+from app.extensions import db, notification_stream, adjacency_cache
+from app.utils.cache import ObjectCache, count_cache, response_cache
+from app.utils.pagination import encode_cursor, decode_cursor, seek_clause
+from app.utils.serializer import eager_options
 from werkzeug.security import check_password_hash, generate_password_hash
 
 followers = db.Table(
     'followers',
     db.Column('follower_id', db.Integer, db.ForeignKey('users.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('users.id')),
-    db.Column('timestamp', db.DateTime, default=datetime.utcnow)
+    db.Column('followed_id', db.Integer, db.ForeignKey('users.id'), index=True),
+    db.Column('timestamp', db.DateTime, default=datetime.utcnow),
+    db.Index('ix_followers_follower_id_followed_id', 'follower_id', 'followed_id', unique=True)
 )
 
 
 class PaginatedAPIMixin(object):
     """用户扩展类"""
+    # 游标分页的排序列, 与 id 一起组成游标; 为 None 时不支持游标分页
+    __cursor_column__ = 'timestamp'
 
     # 根据传入的参数来进行所有用户的序列化操作
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        resources = query.paginate(page, per_page, False)
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, **kwargs):
+        # 请求中带有 cursor 参数时(可以为空, 表示第一页)使用游标分页
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            return cls.to_cursor_collection_dict(query, cursor, per_page, endpoint, **kwargs)
+
+        page = max(page, 1)
+        count = cls.get_count_mode('cached')
+        if count != 'cached':
+            kwargs['count'] = count
+        # 多取一条用来判断是否还有下一页, 这样不统计总数时也能给出 next 链接
+        items = query.options(*eager_options(cls)).limit(per_page + 1).offset((page - 1) * per_page).all()
+        has_next = len(items) > per_page
+        items = items[:per_page]
+        total = count_cache.count(query, count)
 
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': [cls.item_to_dict(item) for item in items],
             '_meta': {
                 "page": page,
                 "per_page": per_page,
-                "total_pages": resources.pages,
-                "total_items": resources.total,
+                "total_pages": int(ceil(total / float(per_page))) if total is not None and per_page else None,
+                "total_items": total,
             },
             '_links': {
                 'self': url_for(endpoint, page=page, per_page=per_page,
                                 **kwargs),
                 'next': url_for(endpoint, page=page + 1, per_page=per_page,
-                                **kwargs) if resources.has_next else None,
+                                **kwargs) if has_next else None,
                 'prev': url_for(endpoint, page=page - 1, per_page=per_page,
-                                **kwargs) if resources.has_prev else None
+                                **kwargs) if page > 1 else None
+            }
+        }
+
+        return data
+
+    @staticmethod
+    def item_to_dict(item):
+        """序列化一行结果, 查询通过 add_columns 附带的列(如关注时间)合并到字典中"""
+        if isinstance(item, db.Model):
+            return item.to_dict()
+        data = item[0].to_dict()
+        data.update(zip(item.keys()[1:], item[1:]))
+        return data
+
+    @staticmethod
+    def get_count_mode(default):
+        """读取请求参数 count=approx|exact|none, 决定如何统计总数"""
+        count = request.args.get('count', default)
+        if count not in count_cache.MODES:
+            abort(400, 'count must be one of approx, exact or none.')
+        return count
+
+    @classmethod
+    def to_cursor_collection_dict(cls, query, cursor, per_page, endpoint, **kwargs):
+        """游标分页: 按 (时间戳, id) 倒序, 用 WHERE 条件定位而不是 OFFSET, 默认不统计总数"""
+        if cls.__cursor_column__ is None:
+            abort(400, 'Cursor pagination is not supported for this resource.')
+        column = getattr(cls, cls.__cursor_column__)
+        try:
+            position = decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            abort(400, str(e))
+
+        seek_query = query.order_by(None)
+        if position is not None:
+            seek_query = seek_query.filter(seek_clause(column, cls.id, position))
+        if position is not None and position.backwards:
+            seek_query = seek_query.order_by(column.asc(), cls.id.asc())
+        else:
+            seek_query = seek_query.order_by(column.desc(), cls.id.desc())
+        # 多取一条用来判断是否还有下一页
+        items = seek_query.options(*eager_options(cls)).limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+
+        if position is not None and position.backwards:
+            items.reverse()
+            has_next, has_prev = True, has_more
+        else:
+            has_next, has_prev = has_more, position is not None
+        entities = [item if isinstance(item, db.Model) else item[0] for item in items]
+
+        # 客户端明确要求时才统计总数
+        count = cls.get_count_mode('none')
+        if count != 'none':
+            kwargs['count'] = count
+        meta = {
+            'per_page': per_page,
+            'cursor': cursor,
+        }
+        if count != 'none':
+            meta['total_items'] = count_cache.count(query, count)
+
+        data = {
+            'items': [cls.item_to_dict(item) for item in items],
+            '_meta': meta,
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page, **kwargs),
+                'next': url_for(endpoint, per_page=per_page, **kwargs,
+                                cursor=encode_cursor(getattr(entities[-1], cls.__cursor_column__), entities[-1].id))
+                if items and has_next else None,
+                'prev': url_for(endpoint, per_page=per_page, **kwargs,
+                                cursor=encode_cursor(getattr(entities[0], cls.__cursor_column__), entities[0].id, True))
+                if items and has_prev else None
             }
         }
 
@@ -56,22 +159,25 @@ class PaginatedAPIMixin(object):
 blacklist = db.Table(
     'blacklist',
     db.Column('user_id', db.Integer, db.ForeignKey('users.id')),
-    db.Column('block_id', db.Integer, db.ForeignKey('users.id')),
-    db.Column('timestamp', db.DateTime, default=datetime.utcnow())
+    db.Column('block_id', db.Integer, db.ForeignKey('users.id'), index=True),
+    db.Column('timestamp', db.DateTime, default=datetime.utcnow),
+    db.Index('ix_blacklist_user_id_block_id', 'user_id', 'block_id', unique=True)
 )
 
 # 喜欢文章
 posts_likes = db.Table(
     'posts_likes',
     db.Column('user_id', db.Integer, db.ForeignKey('users.id')),
-    db.Column('post_id', db.Integer, db.ForeignKey('posts.id')),
-    db.Column('timestamp', db.DateTime, default=datetime.utcnow())
+    db.Column('post_id', db.Integer, db.ForeignKey('posts.id'), index=True),
+    db.Column('timestamp', db.DateTime, default=datetime.utcnow),
+    db.Index('ix_posts_likes_user_id_post_id', 'user_id', 'post_id', unique=True)
 )
 
 
 class Task(PaginatedAPIMixin, db.Model):
     """后台任务"""
     __tablename__ = 'tasks'
+    __cursor_column__ = None
     id = db.Column(db.String(36), primary_key=True)  # 不适用数值id,而是使用rq为每个任务生成的字符串id
     # 任务名
     name = db.Column(db.String(128), index=True)
@@ -81,9 +187,15 @@ class Task(PaginatedAPIMixin, db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     # 是否执行完成
     complate = db.Column(db.Boolean, default=False)
+    # 拆分到多个 worker 并行执行的子任务
+    chunks = db.relationship('TaskChunk', backref='task', lazy='dynamic', cascade='all,delete-orphan')
 
     def get_progress(self):
-        """获取实时进度"""
+        """获取实时进度, 拆分执行的任务汇总各子任务的进度"""
+        sent, total = db.session.query(func.sum(TaskChunk.sent), func.sum(TaskChunk.total)).filter(
+            TaskChunk.task_id == self.id).one()
+        if total is not None:
+            return 100 if self.complate or not total else min(100, 100 * (sent or 0) // total)
         try:
             rq_job = current_app.task_queue.fetch_job(self.id)
         except Exception as e:
@@ -104,9 +216,56 @@ class Task(PaginatedAPIMixin, db.Model):
     def __repr__(self):
         return '<Task {}>'.format(self.id)
 
+    def retry_failed_chunks(self) -> int:
+        """只重新执行失败的子任务, 从子任务上次处理到的位置继续, 返回重试的个数
+
+        worker 意外退出时子任务停在 running, 对应的 job 超时后被 rq 移入失败列表, 之后同样可以重试"""
+        from rq.exceptions import NoSuchJobError
+        from rq.job import Job
+        from rq.registry import StartedJobRegistry
+
+        StartedJobRegistry(queue=current_app.task_queue).cleanup()
+        retry = []
+        for chunk in self.chunks.filter(TaskChunk.status.in_([TaskChunk.FAILED, TaskChunk.RUNNING])):
+            try:
+                job = Job.fetch(chunk.job_id, connection=current_app.redis)
+            except NoSuchJobError:
+                current_app.logger.warning('[群发私信]子任务 %s 的 job 已过期, 无法重试', chunk.id)
+                continue
+            if chunk.status == TaskChunk.RUNNING and not job.is_failed:
+                continue
+            chunk.status = TaskChunk.QUEUED
+            retry.append(job)
+        # 先提交状态再入队, 以免覆盖 worker 已经写入的 running 或 done
+        db.session.commit()
+        for job in retry:
+            # 重新入队原来的 job, 全部子任务成功后 rq 才会执行依赖它们的父任务
+            job.requeue()
+        return len(retry)
+
+
+class TaskChunk(db.Model):
+    """群发任务按接收者id范围拆分出的子任务"""
+    __tablename__ = 'task_chunks'
+    QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.String(36), db.ForeignKey('tasks.id', ondelete='CASCADE'), index=True)
+    job_id = db.Column(db.String(36))
+    min_id = db.Column(db.Integer)
+    max_id = db.Column(db.Integer)
+    last_id = db.Column(db.Integer)  # 已处理到的接收者id, 重试时从下一个开始
+    sent = db.Column(db.Integer, default=0)
+    total = db.Column(db.Integer, default=0)
+    status = db.Column(db.String(16), default=QUEUED)
+    attempts = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        return '<TaskChunk {} {}-{}>'.format(self.task_id, self.min_id, self.max_id)
+
 
 class User(PaginatedAPIMixin, db.Model):
     __tablename__ = 'users'
+    __cursor_column__ = 'member_since'
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
@@ -118,6 +277,7 @@ class User(PaginatedAPIMixin, db.Model):
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
     confirmed = db.Column(db.Boolean, default=False)  # 确认邮箱
     last_seen = db.Column(db.DateTime(), default=datetime.utcnow)
+    avatar_hash = db.Column(db.String(32))  # 邮箱的 MD5, 修改邮箱时更新
     posts = db.relationship('Post', backref='author', cascade='all,delete-orphan', lazy='dynamic')
     last_recived_comments_read_time = db.Column(db.DateTime)  # 最后一次收到评论的时间
     # 用户最后一次查看 用户的粉丝 页面的时间，用来判断哪些粉丝是新的
@@ -129,11 +289,17 @@ class User(PaginatedAPIMixin, db.Model):
     # 用户最后一次查看 收到的文章被喜欢的时间,用来判断哪些喜欢是最新的
     last_posts_likes_read_time = db.Column(db.DateTime)
     last_messages_read_time = db.Column(db.DateTime)  # 最后一次读取私信时间
+    # 冗余计数, 与关注、发布文章在同一事务中更新, 由 reconcile_counters 修正偏差
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followeds_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    posts_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     # 用户的关注
     followeds = db.relationship('User', secondary=followers,
                                 primaryjoin=(followers.c.follower_id == id),
                                 secondaryjoin=(followers.c.followed_id == id),
                                 backref=db.backref('followers', lazy='dynamic'), lazy='dynamic')
+    # 用户发表的评论
+    comments = db.relationship('Comment', backref='author', lazy='dynamic', cascade='all,delete-orphan')
     # 关联的通知
     notifications = db.relationship('Notification', backref='user', lazy='dynamic', cascade='all,delete-orphan')
     # 用户发送的私信
@@ -150,36 +316,67 @@ class User(PaginatedAPIMixin, db.Model):
     # 用户的后台任务
     tasks = db.relationship('Task', backref='user', lazy='dynamic')
 
-    def new_recived_messages(self) -> int:
-        """最新未读的私信个数"""
-        last_read_time = self.last_messages_read_time or datetime(1900, 0, 0)
-
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
-
     @property
     def followed_posts(self):
+        '''关注的人发布的文章, 读取时联表计算'''
         followed = Post.query.join(
-            followers, (followers.c.followed_id == Post.author_id).filter(
+            followers, followers.c.followed_id == Post.author_id).filter(
                 followers.c.follower_id == self.id
-            ))
+            )
         return followed.order_by(Post.timestamp.desc())
 
+    @property
+    def timeline_posts(self):
+        '''首页时间线: 读取预先写入的 timelines 表, 粉丝过多没有推送的作者的文章在读取时合并进来'''
+        query = Post.query.join(Timeline, Timeline.post_id == Post.id).filter(Timeline.user_id == self.id)
+        pulled = self.followed_posts.filter(Post.fanout.is_(False)).order_by(None)
+        if not db.session.query(pulled.exists()).scalar():
+            # 时间线已按 (user_id, timestamp) 建立索引, 直接读取有序的一段
+            return query.order_by(Timeline.timestamp.desc(), Timeline.post_id.desc())
+        return query.union_all(pulled).order_by(Post.timestamp.desc(), Post.id.desc())
+
     def is_following(self, user) -> bool:
         """判断是否关注user对象"""
-        return self.followeds.filter(
-            followers.c.followed_id == user.id
-        ).count() > 0
+        flush_ids(self, user)
+        return adjacency_cache.contains('followeds', self.id, user.id)
+
+    def following_ids(self, ids) -> set:
+        """返回 ids 中被当前用户关注的用户id集合, 整页数据一次判断"""
+        return adjacency_cache.contains_many('followeds', self.id, ids)
+
+    def liked_post_ids(self, ids) -> set:
+        """返回 ids 中当前用户收藏过的文章id集合"""
+        return adjacency_cache.contains_many('liked_posts', self.id, ids)
+
+    def liked_comment_ids(self, ids) -> set:
+        """返回 ids 中当前用户点赞过的评论id集合"""
+        return adjacency_cache.contains_many('liked_comments', self.id, ids)
 
     def follow(self, user):
         """关注user对象"""
         if not self.is_following(user):
             self.followeds.append(user)
+            adjacency_cache.add(db.session, 'followeds', self.id, user.id)
+            count_cache.touch(followers.name)
+            incr_counter(self, 'followeds_count')
+            incr_counter(user, 'followers_count')
+            UnreadCounter.incr(user.id, 'new_follows_count')
+            Timeline.add_author(self.id, user.id)
 
     def unfollow(self, user):
         """取消user对象的关注"""
         if self.is_following(user):
+            timestamp = db.session.query(followers.c.timestamp).filter(
+                followers.c.follower_id == self.id, followers.c.followed_id == user.id).scalar()
             self.followeds.remove(user)
+            adjacency_cache.remove(db.session, 'followeds', self.id, user.id)
+            count_cache.touch(followers.name)
+            incr_counter(self, 'followeds_count', -1)
+            incr_counter(user, 'followers_count', -1)
+            Timeline.remove_author(self.id, user.id)
+            # 对方还没看到的关注要从未读计数中减掉
+            if timestamp and timestamp > (user.last_follows_read_time or datetime.min):
+                UnreadCounter.incr(user.id, 'new_follows_count', -1)
 
     def __repr__(self):
         return '<User {}>'.format(self.username)
@@ -206,8 +403,11 @@ class User(PaginatedAPIMixin, db.Model):
             'email': self.email,
             'name': self.name,
             'location': self.location,
-            'member_since': self.member_since.isoformat() + 'Z',
-            'last_seen': self.last_seen.isoformat() + 'Z',
+            'member_since': self.member_since,
+            'last_seen': self.last_seen,
+            'followers_count': self.followers_count,
+            'followeds_count': self.followeds_count,
+            'posts_count': self.posts_count,
             '_links': {
                 'self': url_for('api.get_user', id=self.id),
                 'avatar': self.avatar(128)
@@ -239,7 +439,10 @@ class User(PaginatedAPIMixin, db.Model):
             'user_avatar': base64.b64encode(self.avatar(24).
                                             encode('utf-8')).decode('utf-8'),
             'confirmed': self.confirmed,
-            'permissions': self.role.get_permissions(),
+            'permissions': self.role.get_permissions() if self.role else '',
+            # 权限位掩码和角色版本, 权限校验直接读取这两项, 不再查询角色
+            'perms': self.role.permissions if self.role else 0,
+            'role_version': self.role_version,
             'exp': now + timedelta(seconds=expires_in),
             'iat': now
         }
@@ -253,105 +456,108 @@ class User(PaginatedAPIMixin, db.Model):
         self.last_seen = datetime.utcnow()
         db.session.add(self)
 
+    @property
+    def role_version(self):
+        '''角色 id 和角色版本, 更换角色或修改角色权限后都会变化'''
+        if self.role is None:
+            return None
+        return [self.role.id, self.role.version or 0]
+
     @staticmethod
-    def verify_token(token):
+    def decode_token(token):
+        '''解码jwt, 无效时返回 None'''
         # 捕获异常信息
-        # 解码jwt
         try:
-            payload = jwt.decode(
+            return jwt.decode(
                 token,
                 current_app.config["SECRET_KEY"],
                 algorithms="HS256"
             )
-        except (jwt.exceptions.ExpiredSignatureError, jwt.exceptions.InvalidSignatureError) as e:
+        except jwt.exceptions.InvalidTokenError:
             # Token过期，或被人修改，那么签名验证也会失败
             return None
-        # 返回用户
-        return User.query.get(payload.get('user_id'))
+
+    @staticmethod
+    def verify_token(token):
+        payload = User.decode_token(token)
+        return User.from_claims(payload) if payload else None
+
+    @staticmethod
+    def from_claims(payload):
+        '''根据 token 内容返回用户'''
+        # 用户和角色缓存在进程内, 命中时不访问数据库
+        user = user_cache.get(payload.get('user_id'), ttl=current_app.config['USER_CACHE_TTL'])
+        # 签发后更换过角色或角色权限有变化, token 作废, 需要重新登录获取
+        if user is not None and 'role_version' in payload and payload['role_version'] != user.role_version:
+            return None
+        return user
+
+    def seen_recently(self):
+        '''最近 LAST_SEEN_INTERVAL 秒内是否已经更新过最后访问时间'''
+        interval = timedelta(seconds=current_app.config['LAST_SEEN_INTERVAL'])
+        return self.last_seen is not None and datetime.utcnow() - self.last_seen < interval
+
+    @validates('email')
+    def update_avatar_hash(self, key, email):
+        """修改邮箱时重新计算头像哈希"""
+        self.avatar_hash = gravatar_hash(email)
+        return email
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+        return gravatar_url(self.avatar_hash or gravatar_hash(self.email), size)
 
-    def new_recived_comments(self):
+    def new_recived_comments(self) -> int:
         """用户下未读评论计数"""
-        last_read_time = self.last_recived_comments_read_time or datetime(1900, 1, 1)
-        # 用户发布的文章的id
-        user_posts_ids = [post.id for post in self.posts.all()]
-        q1 = set(Comment.query.fileter(Comment.post_id.in_(user_posts_ids), Comment.author == self))
-        q2 = set()
-        for c in self.comments:
-            q2 = q2 | c.get_descendants()
-        recived_comments = q1 | q2
-        return len([c for c in recived_comments if c.timestamp > last_read_time])
-
-    def new_recived_messages(self):
+        return UnreadCounter.get(self.id, 'unread_recived_comments_count')
+
+    def new_recived_messages(self) -> int:
         """用户未读私信计数"""
-        last_read_time = self.last_messages_read_time or datetime(1900, 0, 0)
-        return Message.query.filter_by(Message.recipient == self).filter(Message.timestamp > last_read_time).count()
+        return UnreadCounter.get(self.id, 'unread_messages_count')
 
     def add_notification(self, name, data):
-        """为用户添加一个通知"""
-        self.notifications.filter(name == name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
-
-    def new_follows(self):
+        """添加或更新用户的一个通知, 同一事务中的多次更新在提交时合并为一条 upsert 语句"""
+        if self.id is None:
+            db.session.flush()
+        row = {'user_id': self.id, 'name': name, 'payload_json': json.dumps(data), 'timestamp': time()}
+        db.session.info.setdefault('pending_notifications_upserts', {})[(self.id, name)] = row
+        # 提交后推送给在线的客户端
+        notification_stream.queue(db.session, self.id, {'name': name, 'payload': data, 'timestamp': row['timestamp']})
+        return row
+
+    def new_follows(self) -> int:
         """新的粉丝记数"""
-        last_read_time = self.last_follows_read_time or datetime(1900, 0, 0)
-        return self.followers.filter(followers.c.timestamp > last_read_time).count()
-
-    def new_likes(self):
-        """用户收到的点赞数量"""
-        last_read_time = self.last_likes_read_time or datetime(1900, 0, 0)
-        comment = self.comments.join(comments_likes).all()
-        news_likes_count = 0
-        for c in comment:
-            # 获取点赞时间
-            for u in c.likes:
-                res = db.engine.execute(
-                    "select * from comments_likes where user_id={} and comment_id={}".format(u.id, c.id))
-                timestapm = datetime.strptime(list(res)[0][2], '%Y-%m-%d %H:%M:%S.%f')
-                if timestapm > last_read_time:
-                    news_likes_count += 1
-        return news_likes_count
+        return UnreadCounter.get(self.id, 'new_follows_count')
+
+    def new_likes(self) -> int:
+        """用户收到的评论点赞数量"""
+        return UnreadCounter.get(self.id, 'unread_likes_count')
 
     def new_posts_likes(self) -> int:
         """用户收到的文章被喜欢的计数"""
-        last_read_time = self.last_posts_likes_read_time or datetime(1990, 0, 0)
-        new_likes_count = 0
-        # 查找到自己所有的被喜欢的文章
-        posts = self.posts.join(posts_likes).all()
-        for p in posts:
-            for u in p.likes:
-                if u != self:  # 用户自己喜欢的文章不用通知
-                    res = db.engine.execute(
-                        "select * from posts_likes WHERE user_id={} and post_id={}".format(u.id, p.id))
-                    timestamp = datetime.strptime(list(res)[0][2], "%Y-%m-%d %H:%M:%S.%f")
-                    if timestamp > last_read_time:
-                        new_likes_count += 1
-
-        return new_likes_count
-
-    def new_follows(self):
+        return UnreadCounter.get(self.id, 'unread_posts_likes_count')
+
+    def new_followeds_posts(self) -> int:
         """关注者发布的文章记数"""
-        last_read_time = self.last_followeds_posts_read_time or datetime(1900, 0, 0)
-        return self.followed_posts().filter(Post.timestamp > last_read_time).count()
+        return UnreadCounter.get(self.id, 'unread_followeds_posts_count')
 
     def is_blocking(self, user) -> bool:
         """判断当前用户是否被拉黑"""
-        return self.harassers.filter(blacklist.c.block_id == user.id).count() > 0
+        flush_ids(self, user)
+        return adjacency_cache.contains('blocks', self.id, user.id)
 
     def block(self, user):
         """当前用户拉黑一个用户"""
         if not self.is_blocking(user):
             self.harassers.append(user)
+            adjacency_cache.add(db.session, 'blocks', self.id, user.id)
+            count_cache.touch(blacklist.name)
 
     def unblock(self, user):
         """解除拉黑一个用户"""
         if self.is_blocking(user):
             self.harassers.remove(user)
+            adjacency_cache.remove(db.session, 'blocks', self.id, user.id)
+            count_cache.touch(blacklist.name)
 
     def generate_confirmed_jwt(self, expires_in=3600):
         """生成验证token"""
@@ -408,13 +614,32 @@ class User(PaginatedAPIMixin, db.Model):
 
     def get_task_in_process(self, name):
         """获取正在运行的任务"""
-        return Task.query.filter_by(name=name, user=self, compile=False)
+        return Task.query.filter_by(name=name, user=self, complate=False).first()
 
     def lanuch_tasks(self, name, description, *args, **kwargs):
         """用户发布一个任务"""
         rq_job = current_app.task_queue.enqueue('app.utils.tasks.' + name, *args, **kwargs)
         task = Task(id=rq_job.get_id(), name=name, description=description, user=self)
-        db.session.add()
+        db.session.add(task)
+        return task
+
+    def lanuch_broadcast(self, description, body):
+        """把群发私信按接收者id范围拆成多个子任务, 分给所有 worker 并行执行
+
+        子任务全部成功后, 依赖它们的父任务负责收尾; 父任务的 id 即 Task 的 id"""
+        from app.utils.broadcast import plan_chunks
+
+        task = Task(id=str(uuid4()), name='send_messages', description=description, user=self)
+        db.session.add(task)
+        chunks = plan_chunks(task, self.id, current_app.config['BROADCAST_JOB_SIZE'])
+        for chunk in chunks:
+            chunk.job_id = str(uuid4())
+        # 子任务记录提交后再入队, 以免 worker 读不到
+        db.session.commit()
+        jobs = [current_app.task_queue.enqueue('app.utils.tasks.send_messages_chunk', chunk.id, self.id, body,
+                                               job_id=chunk.job_id) for chunk in chunks]
+        current_app.task_queue.enqueue('app.utils.tasks.finish_broadcast', task.id, self.id, body,
+                                       job_id=task.id, depends_on=jobs or None)
         return task
 
 
@@ -427,7 +652,10 @@ class Post(PaginatedAPIMixin, db.Model):
     body = db.Column(db.Text)
     timestamp = db.Column(db.DateTime(), index=True, default=datetime.utcnow)
     views = db.Column(db.Integer, default=0)
-    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 收藏数
+    comments_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 评论数
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    fanout = db.Column(db.Boolean, nullable=False, default=True, server_default=db.true())  # 是否已推送到粉丝的时间线, 粉丝过多的作者读取时再合并
     comments = db.relationship('Comment', backref='post', lazy='dynamic', cascade='all,delete-orphan')
     # 喜欢博客的人和被喜欢的文章是多对多的关系,一个人可以喜欢多个文章,一个文章可以被多个人喜欢
     likers = db.relationship('User', secondary=posts_likes, backref=db.backref('liked_posts', lazy='dynamic'),
@@ -450,6 +678,8 @@ class Post(PaginatedAPIMixin, db.Model):
             'body': self.body,
             'summary': self.summary,
             'author_id': self.author_id,
+            'likes_count': self.likes_count,
+            'comments_count': self.comments_count,
             '_links': {
                 'self': url_for('api.get_post', id=self.id),
                 'author_url': url_for('api.get_users', id=self.author_id)
@@ -459,80 +689,215 @@ class Post(PaginatedAPIMixin, db.Model):
         return data
 
     def is_liked_by(self, user):
-        """是否收藏过文章"""
-        return user in self.likers
+        """是否收藏过文章, 查询用户的收藏集合, 不加载全部收藏者"""
+        flush_ids(self, user)
+        return adjacency_cache.contains('liked_posts', user.id, self.id)
 
     def liked_by(self, user):
         """收藏文章"""
         if not self.is_liked_by(user):
             self.likers.append(user)
+            adjacency_cache.add(db.session, 'liked_posts', user.id, self.id)
+            count_cache.touch(posts_likes.name)
+            incr_counter(self, 'likes_count')
+            # 用户自己喜欢的文章不用通知
+            if user.id != self.author_id:
+                UnreadCounter.incr(self.author_id, 'unread_posts_likes_count')
 
     def unliked_by(self, user):
         """取消收藏文章"""
         if self.is_liked_by(user):
+            timestamp = db.session.query(posts_likes.c.timestamp).filter(
+                posts_likes.c.user_id == user.id, posts_likes.c.post_id == self.id).scalar()
             self.likers.remove(user)
+            adjacency_cache.remove(db.session, 'liked_posts', user.id, self.id)
+            count_cache.touch(posts_likes.name)
+            incr_counter(self, 'likes_count', -1)
+            if user.id != self.author_id and timestamp and \
+                    timestamp > (self.author.last_posts_likes_read_time or datetime.min):
+                UnreadCounter.incr(self.author_id, 'unread_posts_likes_count', -1)
 
 
 # 评论点赞
 comments_likes = db.Table(
     'comments_likes',
     db.Column('user_id', db.Integer, db.ForeignKey('users.id')),
-    db.Column('comments_id', db.Integer, db.ForeignKey('comments.id')),
-    db.Column('timestamp', db.DateTime, default=datetime.utcnow)
+    db.Column('comments_id', db.Integer, db.ForeignKey('comments.id'), index=True),
+    db.Column('timestamp', db.DateTime, default=datetime.utcnow),
+    db.Index('ix_comments_likes_user_id_comments_id', 'user_id', 'comments_id', unique=True)
 )
 
+# 关系集合以用户id为键, 成员为对方用户或文章、评论的id
+adjacency_cache.register('followeds', followers.c.follower_id, followers.c.followed_id)
+adjacency_cache.register('blocks', blacklist.c.user_id, blacklist.c.block_id)
+adjacency_cache.register('liked_posts', posts_likes.c.user_id, posts_likes.c.post_id)
+adjacency_cache.register('liked_comments', comments_likes.c.user_id, comments_likes.c.comments_id)
+
+
+def incr_counter(obj, name, n=1):
+    """计数列加 n. 已存在的记录生成 SET name = name + n, 并发更新不会丢失, 随当前事务提交"""
+    state = db.inspect(obj)
+    if not state.persistent:
+        setattr(obj, name, (getattr(obj, name) or 0) + n)
+        return
+    # 同一次 flush 前多次修改时在已有的表达式上累加
+    current = state.dict.get(name)
+    if isinstance(current, ClauseElement):
+        setattr(obj, name, current + n)
+    else:
+        setattr(obj, name, getattr(type(obj), name) + n)
+
+
+def gravatar_hash(email) -> str:
+    return md5((email or '').lower().encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=65536)
+def gravatar_url(avatar_hash, size) -> str:
+    """按头像哈希和尺寸生成 gravatar 地址, 序列化一页数据时同一用户只拼接一次"""
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(avatar_hash, size)
+
+
+def flush_ids(*objects):
+    """关系缓存按id查询, 新建的对象先写入会话得到id"""
+    if any(obj.id is None for obj in objects):
+        db.session.flush()
+
 
 class Comment(PaginatedAPIMixin, db.Model):
     """评论模型类"""
     __tablename__ = 'comments'
+    # to_dict 访问的关联, 序列化集合时批量预加载
+    __serialize_relations__ = ('author', 'post.author', 'children')
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.TEXT)
-    timestamp = db.Column(db.DateTime, index=True)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     mark_read = db.Column(db.Boolean, default=False)  # 是否已读
     disabled = db.Column(db.Boolean, default=False)  # 屏蔽显示
     # 评论者的id
-    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
     # 评论博文的id
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), index=True)
     # 父评论id
-    parent_id = db.Column(db.Integer, db.ForeignKey('comments.id', ondelete='CASCADE'))
+    parent_id = db.Column(db.Integer, db.ForeignKey('comments.id', ondelete='CASCADE'), index=True)
     parent = db.relationship('Comment', backref= \
         db.backref('children', cascade='all,delete-orphan'), remote_side=[id])
     likers = db.relationship('User', secondary=comments_likes, backref=db.backref('liked_comments', lazy='dynamic'))
+    # 物化路径: 从根评论到当前评论的定宽id, 如 0000000001/0000000005/, 插入后由事件维护
+    path = db.Column(db.String(500), index=True)
+    depth = db.Column(db.Integer, default=0)  # 根评论深度为0
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # 点赞数
+
+    PATH_WIDTH = 10
 
     def __repr__(self):
         """控制台输出"""
         return "<Comment {}>".format(self.id)
 
-    def get_descendants(self):
-        '''获取一级评论的所有子孙'''
-        data = set()
+    @staticmethod
+    def make_path(parent_path, id):
+        """由父评论路径和自身id生成路径"""
+        return (parent_path or '') + str(id).zfill(Comment.PATH_WIDTH) + '/'
 
-        def descendants(comment):
-            if comment.children:
-                data.update(comment.children)
-                for child in comment.children:
-                    descendants(child)
+    @staticmethod
+    def subtree_filter(path):
+        """路径以 path 开头的评论, 用范围条件代替 LIKE 以便走索引('/' 的下一个字符是 '0')"""
+        return and_(Comment.path >= path, Comment.path < path[:-1] + '0')
 
-        descendants(self)
-        return data
+    def path_ids(self) -> list:
+        """路径上的评论id, 从根评论到自身"""
+        return [int(i) for i in self.path.split('/') if i] if self.path else []
 
-    def get_ancestors(self):
-        """获取评论的所有爸爸们"""
-        data = []
+    def get_descendants(self):
+        '''获取一级评论的所有子孙'''
+        if not self.path:
+            return set()
+        return set(Comment.query.filter(Comment.subtree_filter(self.path), Comment.id != self.id))
 
-        def ancestors(comment):
-            if comment.parent:
-                data.append(comment.parent)
-                ancestors(comment.parent)
+    def get_ancestors(self):
+        """获取评论的所有爸爸们, 由近到远"""
+        if self.path:
+            ids = self.path_ids()[:-1]
+        else:
+            # 还没有写入数据库的评论, 路径取自父评论
+            ids = self.parent.path_ids() if self.parent is not None else []
+        if not ids:
+            return []
+        return sorted(Comment.query.filter(Comment.id.in_(ids)), key=lambda c: c.depth, reverse=True)
 
-        ancestors(self)
-        return data
+    @staticmethod
+    def load_threads(root_ids, max_depth=None) -> dict:
+        """一次查询取出多棵评论树的全部回复, 返回 {parent_id: [按时间排序的回复]}
+
+        回复的 children 由内存中的字典直接填充, 序列化时不会再逐条懒加载"""
+        if not root_ids:
+            return {}
+        query = Comment.query.filter(
+            or_(*[Comment.subtree_filter(Comment.make_path(None, id)) for id in root_ids]),
+            Comment.parent_id.isnot(None))
+        if max_depth is not None:
+            # 多取一层, 用来判断最深一层的评论是否还有回复
+            query = query.filter(Comment.depth <= max_depth + 1)
+        comments = query.options(selectinload(Comment.author)).order_by(Comment.timestamp, Comment.id).all()
+        replies = {}
+        for comment in comments:
+            replies.setdefault(comment.parent_id, []).append(comment)
+        for comment in comments:
+            set_committed_value(comment, 'children', replies.get(comment.id, []))
+        return replies
+
+    def unread_thread_recipients(self) -> dict:
+        """评论及其所有子孙在通知对象中还没读过的条数, 返回 {用户id: 条数}, 删除整个讨论前用来减少未读计数"""
+        comments = db.session.query(Comment.id, Comment.path, Comment.author_id, Comment.timestamp).filter(
+            Comment.subtree_filter(self.path)).all()
+        authors = dict(db.session.query(Comment.id, Comment.author_id).filter(
+            Comment.id.in_(self.path_ids()[:-1])))
+        authors.update((c.id, c.author_id) for c in comments)
+        recipients = []
+        for id, path, author_id, timestamp in comments:
+            users = {self.post.author_id} | {authors.get(int(i)) for i in path.split('/')[:-2]}
+            recipients.append((timestamp, users - {author_id, None}))
+        user_ids = set().union(*[users for timestamp, users in recipients])
+        if not user_ids:
+            return {}
+        read_times = dict(db.session.query(User.id, User.last_recived_comments_read_time).filter(
+            User.id.in_(user_ids)))
+        counts = {}
+        for timestamp, users in recipients:
+            for user_id in users:
+                if timestamp and timestamp > (read_times.get(user_id) or datetime.min):
+                    counts[user_id] = counts.get(user_id, 0) + 1
+        return counts
+
+    def delete_thread(self):
+        """用路径一次删除评论及其所有子孙, 以及它们的点赞记录, 返回删除的评论数
+
+        批量删除不经过 un_liked_by, 被删除评论上未读的点赞从作者的未读计数中减掉, 点赞集合缓存同步移除"""
+        post = self.post
+        ids = db.session.query(Comment.id).filter(Comment.subtree_filter(self.path))
+        likes = db.session.query(comments_likes.c.user_id, comments_likes.c.comments_id, comments_likes.c.timestamp,
+                                 Comment.author_id, User.last_likes_read_time).join(
+            Comment, Comment.id == comments_likes.c.comments_id).join(User, User.id == Comment.author_id).filter(
+            Comment.subtree_filter(self.path)).all()
+        unread = {}
+        for user_id, comment_id, timestamp, author_id, read_time in likes:
+            adjacency_cache.remove(db.session, 'liked_comments', user_id, comment_id)
+            if user_id != author_id and timestamp and timestamp > (read_time or datetime.min):
+                unread[author_id] = unread.get(author_id, 0) - 1
+        UnreadCounter.incr_many(unread, 'unread_likes_count')
+        Notification.bulk_replace('unread_likes_count', UnreadCounter.get_many(unread, 'unread_likes_count'))
+        db.session.execute(comments_likes.delete().where(comments_likes.c.comments_id.in_(ids.statement)))
+        count = Comment.query.filter(Comment.subtree_filter(self.path)).delete(synchronize_session='fetch')
+        incr_counter(post, 'comments_count', -count)
+        # 批量删除不经过模型事件, 分页总数缓存需要手动标记
+        count_cache.touch(Comment.__tablename__, comments_likes.name)
+        return count
 
     def from_dict(self, data: dict):
         """填充数据至当前模型类"""
-        for filed in ['body', 'timestamp', 'mark_read', 'disabled', 'post_id', 'parent_id']:
-            setattr(self, filed, data[filed])
+        for filed in ['body', 'mark_read', 'disabled', 'post_id', 'parent_id']:
+            if filed in data:
+                setattr(self, filed, data[filed])
 
     def to_dict(self) -> dict:
         """序列化评论模型"""
@@ -542,6 +907,7 @@ class Comment(PaginatedAPIMixin, db.Model):
             'timestamp': self.timestamp,
             'mark_read': self.mark_read,
             'disabled': self.disabled,
+            'likes_count': self.likes_count,
             'author': {
                 'id': self.author.id,
                 'username': self.author.username,
@@ -553,37 +919,77 @@ class Comment(PaginatedAPIMixin, db.Model):
                 'title': self.post.title,
                 'author_id': self.post.author.id
             },
-            'parent_id': self.parent_id if self.parent else None,
+            'parent_id': self.parent_id,
             '_links': {
                 'self': url_for('api.get_comment', id=self.id),
                 'author_url': url_for('api.get_user', id=self.author_id),
                 'post_url': url_for('api.get_post', id=self.post_id),
-                'parent_url': url_for('api.get_comment', id=self.parent_id) if self.parent else None,
+                'parent_url': url_for('api.get_comment', id=self.parent_id) if self.parent_id else None,
                 'children_url': [url_for('api.get_comment', id=child.id) for child in
-                                 self.children] if self.childeren else None
+                                 self.children] if self.children else None
             }
         }
 
         return data
 
     def is_liked_by(self, user):
-        """用户是否点赞"""
-        return user in self.likers
+        """用户是否点赞, 查询用户的点赞集合, 不加载全部点赞者"""
+        flush_ids(self, user)
+        return adjacency_cache.contains('liked_comments', user.id, self.id)
 
     def liked_by(self, user):
         """点赞评论"""
         if not self.is_liked_by(user):
             self.likers.append(user)
+            adjacency_cache.add(db.session, 'liked_comments', user.id, self.id)
+            count_cache.touch(comments_likes.name)
+            incr_counter(self, 'likes_count')
+            if user.id != self.author_id:
+                UnreadCounter.incr(self.author_id, 'unread_likes_count')
 
     def un_liked_by(self, user):
         """取消点赞"""
         if self.is_liked_by(user):
+            timestamp = db.session.query(comments_likes.c.timestamp).filter(
+                comments_likes.c.user_id == user.id, comments_likes.c.comments_id == self.id).scalar()
             self.likers.remove(user)
+            adjacency_cache.remove(db.session, 'liked_comments', user.id, self.id)
+            count_cache.touch(comments_likes.name)
+            incr_counter(self, 'likes_count', -1)
+            if user.id != self.author_id and timestamp and \
+                    timestamp > (self.author.last_likes_read_time or datetime.min):
+                UnreadCounter.incr(self.author_id, 'unread_likes_count', -1)
+
+    def notify_recipients(self) -> set:
+        """需要收到这条评论通知的用户: 文章作者和所有祖先评论的作者, 不包括评论者自己"""
+        users = {self.post.author}
+        if self.parent:
+            users |= {c.author for c in self.get_ancestors()}
+        users.discard(self.author)
+        return users
+
+
+@db.event.listens_for(Comment, 'after_insert')
+def set_comment_path(mapper, connection, target):
+    """插入评论后根据父评论的路径写入自己的路径和深度"""
+    parent_path = None
+    if target.parent_id is not None:
+        # 只使用已经加载的父评论, 避免在 flush 过程中触发懒加载
+        parent = target.__dict__.get('parent')
+        parent_path = parent.path if parent is not None else connection.scalar(
+            select([Comment.path]).where(Comment.id == target.parent_id))
+    path = Comment.make_path(parent_path, target.id)
+    depth = path.count('/') - 1
+    connection.execute(Comment.__table__.update().where(Comment.id == target.id).values(path=path, depth=depth))
+    set_committed_value(target, 'path', path)
+    set_committed_value(target, 'depth', depth)
 
 
 class Notification(db.Model):
-    """用户通知"""
+    """用户通知, 每个用户每种通知一行, 更新时原地改写内容和时间戳"""
     __tablename__ = 'notifications'
+    __serialize_relations__ = ('user',)
+    __table_args__ = (db.Index('ix_notifications_user_id_name', 'user_id', 'name', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -618,19 +1024,75 @@ class Notification(db.Model):
 
         return data
 
+    @staticmethod
+    def events_since(user_id, since):
+        """用户在 since 之后收到的通知, 按时间先后, 格式与推送的内容一致"""
+        rows = db.session.query(Notification.name, Notification.payload_json, Notification.timestamp).filter(
+            Notification.user_id == user_id, Notification.timestamp > since).order_by(Notification.timestamp.asc())
+        return [{'name': name, 'payload': json.loads(payload), 'timestamp': timestamp}
+                for name, payload, timestamp in rows]
+
     def from_dict(self, data):
         """装载数据至模型类"""
         for field in ["name", "payload"]:
             if field in data:
                 setattr(self, field, data[field])
 
+    @staticmethod
+    def upsert(rows, session=None):
+        """按 (user_id, name) 插入或更新一批通知, 一条语句完成"""
+        if not rows:
+            return
+        session = session or db.session
+        table = Notification.__table__
+        dialect = session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(table).values(rows)
+            stmt = stmt.on_conflict_do_update(index_elements=['user_id', 'name'], set_={
+                'payload_json': stmt.excluded.payload_json, 'timestamp': stmt.excluded.timestamp})
+            session.execute(stmt)
+        elif dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            stmt = insert(table).values(rows)
+            session.execute(stmt.on_duplicate_key_update(
+                payload_json=stmt.inserted.payload_json, timestamp=stmt.inserted.timestamp))
+        elif dialect == 'sqlite':
+            session.execute(text(
+                'INSERT INTO notifications (user_id, name, payload_json, timestamp) '
+                'VALUES (:user_id, :name, :payload_json, :timestamp) '
+                'ON CONFLICT (user_id, name) DO UPDATE SET '
+                'payload_json = excluded.payload_json, timestamp = excluded.timestamp'), rows)
+        else:
+            for row in rows:
+                updated = session.execute(table.update().where(and_(
+                    table.c.user_id == row['user_id'], table.c.name == row['name'])).values(
+                    payload_json=row['payload_json'], timestamp=row['timestamp'])).rowcount
+                if not updated:
+                    session.execute(table.insert().values(**row))
+
+    @staticmethod
+    def bulk_replace(name, payloads: dict):
+        """批量更新一组用户的同名通知, payloads 为 {用户id: 数据}"""
+        if not payloads:
+            return
+        now = time()
+        Notification.upsert([{'name': name, 'user_id': user_id, 'timestamp': now, 'payload_json': json.dumps(data)}
+                             for user_id, data in payloads.items()])
+        for user_id, data in payloads.items():
+            notification_stream.queue(db.session, user_id, {'name': name, 'payload': data, 'timestamp': now})
+
 
 class Message(PaginatedAPIMixin, db.Model):
     """用户私信"""
     __tablename__ = "messages"
+    __serialize_relations__ = ('sender', 'recipient')
+    # 私信记录按对话双方和时间查询
+    __table_args__ = (db.Index('ix_messages_sender_id_recipient_id_timestamp', 'sender_id', 'recipient_id', 'timestamp'),
+                      db.Index('ix_messages_recipient_id_sender_id_timestamp', 'recipient_id', 'sender_id', 'timestamp'))
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
-    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow())
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     sender_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     recipient_id = db.Column(db.Integer, db.ForeignKey('users.id'))
 
@@ -642,7 +1104,7 @@ class Message(PaginatedAPIMixin, db.Model):
         data = {
             'id': self.id,
             'body': self.body,
-            'timestamp': self.timestamp if self.timestamp else datetime(1900, 0, 0),
+            'timestamp': self.timestamp if self.timestamp else datetime(1900, 1, 1),
             'sender': self.sender.to_dict(),
             'recipient': self.recipient.to_dict(),
             '_links': {
@@ -661,6 +1123,108 @@ class Message(PaginatedAPIMixin, db.Model):
                 setattr(self, filed, data[filed])
 
 
+class Conversation(PaginatedAPIMixin, db.Model):
+    """私信会话汇总, 每行是 user_id 发给 peer_id 的全部私信: 最后一条私信、总数和对方未读数
+
+    发件箱按 user_id 读取, 收件箱按 peer_id 读取, 两者都有按时间排序的索引"""
+    __tablename__ = 'conversations'
+    __cursor_column__ = None
+    __serialize_relations__ = ('last_message.sender', 'last_message.recipient')
+    __table_args__ = (db.Index('ix_conversations_user_id_timestamp', 'user_id', 'timestamp'),
+                      db.Index('ix_conversations_peer_id_timestamp', 'peer_id', 'timestamp'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    peer_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('messages.id', ondelete='SET NULL'))
+    timestamp = db.Column(db.DateTime)  # 最后一条私信的时间
+    total_count = db.Column(db.Integer, nullable=False, default=0)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    last_message = db.relationship('Message')
+
+    def __repr__(self):
+        return '<Conversation {}->{}>'.format(self.user_id, self.peer_id)
+
+    def to_dict(self):
+        """最后一条私信, 附带总数和未读数"""
+        data = self.last_message.to_dict()
+        data['total_count'] = self.total_count
+        data['new_count'] = self.unread_count
+        if self.unread_count:
+            data['is_new'] = True
+        return data
+
+    @staticmethod
+    def _last_message(columns):
+        """会话中最后一条私信的相关子查询"""
+        return select(columns).where(and_(
+            Message.sender_id == Conversation.user_id, Message.recipient_id == Conversation.peer_id)).order_by(
+            Message.id.desc()).limit(1).as_scalar()
+
+    @staticmethod
+    def incr(sender_id, recipient_ids):
+        """sender 给一批接收者各发送一条私信后更新会话, 私信需已写入数据库"""
+        recipient_ids = list(recipient_ids)
+        if not recipient_ids:
+            return
+        db.session.query(Conversation).filter(
+            Conversation.user_id == sender_id, Conversation.peer_id.in_(recipient_ids)).update({
+                Conversation.total_count: Conversation.total_count + 1,
+                Conversation.unread_count: Conversation.unread_count + 1,
+                Conversation.last_message_id: Conversation._last_message([Message.id]),
+                Conversation.timestamp: Conversation._last_message([Message.timestamp]),
+            }, synchronize_session=False)
+        # 第一次发私信的接收者, 根据私信表插入会话
+        exists = db.session.query(Conversation).filter(
+            Conversation.user_id == sender_id, Conversation.peer_id == Message.recipient_id).exists()
+        missing = db.session.query(
+            literal(sender_id), Message.recipient_id, func.max(Message.id), func.max(Message.timestamp),
+            func.count(Message.id), func.count(Message.id)).filter(
+            Message.sender_id == sender_id, Message.recipient_id.in_(recipient_ids), ~exists).group_by(
+            Message.recipient_id)
+        db.session.execute(Conversation.__table__.insert().from_select(
+            ['user_id', 'peer_id', 'last_message_id', 'timestamp', 'total_count', 'unread_count'], missing))
+        count_cache.touch(Conversation.__tablename__)
+
+    @staticmethod
+    def remove(sender_id, recipient_id, unread):
+        """删除一条私信后更新会话, 私信需已从数据库删除"""
+        query = db.session.query(Conversation).filter_by(user_id=sender_id, peer_id=recipient_id)
+        query.update({
+            Conversation.total_count: Conversation.total_count - 1,
+            Conversation.unread_count: case([(Conversation.unread_count > 0, Conversation.unread_count - int(unread))],
+                                            else_=0),
+            Conversation.last_message_id: Conversation._last_message([Message.id]),
+            Conversation.timestamp: Conversation._last_message([Message.timestamp]),
+        }, synchronize_session=False)
+        query.filter(Conversation.total_count <= 0).delete(synchronize_session=False)
+        count_cache.touch(Conversation.__tablename__)
+
+    @staticmethod
+    def refresh_unread(user):
+        """用户的私信已读时间变化后, 重新计算发给他的各会话的未读数"""
+        unread = select([func.count(Message.id)]).where(and_(
+            Message.sender_id == Conversation.user_id, Message.recipient_id == Conversation.peer_id,
+            Message.timestamp > (user.last_messages_read_time or datetime(1900, 1, 1)))).as_scalar()
+        db.session.query(Conversation).filter(
+            Conversation.peer_id == user.id, Conversation.unread_count > 0).update(
+            {Conversation.unread_count: unread}, synchronize_session=False)
+
+    @staticmethod
+    def rebuild():
+        """根据私信表重新生成所有会话, 返回会话数"""
+        db.session.query(Conversation).delete(synchronize_session=False)
+        Recipient = db.aliased(User)
+        query = db.session.query(
+            Message.sender_id, Message.recipient_id, func.max(Message.id), func.max(Message.timestamp),
+            func.count(Message.id),
+            func.sum(case([(Message.timestamp > func.coalesce(Recipient.last_messages_read_time,
+                                                              datetime(1900, 1, 1)), 1)], else_=0))).join(
+            Recipient, Recipient.id == Message.recipient_id).group_by(Message.sender_id, Message.recipient_id)
+        db.session.execute(Conversation.__table__.insert().from_select(
+            ['user_id', 'peer_id', 'last_message_id', 'timestamp', 'total_count', 'unread_count'], query))
+        count_cache.touch(Conversation.__tablename__)
+        return db.session.query(Conversation).count()
+
+
 class Permission(object):
     """权限认证中的各种操作，对应二进制的位，比如
        FOLLOW: 0b00000001，转换为十六进制为 0x01
@@ -679,11 +1243,13 @@ class Permission(object):
 class Role(PaginatedAPIMixin, db.Model):
     """角色表"""
     __tablename__ = 'roles'
+    __cursor_column__ = None
     id = db.Column(db.Integer, primary_key=True)
     slug = db.Column(db.String(255), unique=True)
     name = db.Column(db.String(255))  # 角色表
     default = db.Column(db.Boolean, default=False, index=True)  # 是否是默认角色
     permissions = db.Column(db.Integer)  # 角色拥有的权限，各操作对应一个二进制位，能执行某项操作的角色，其位会被设为 1
+    version = db.Column(db.Integer, default=0)  # 权限每修改一次加一, 用于作废之前签发的token
     users = db.relationship('User', backref='role', lazy='dynamic')
 
     def __init__(self, **kwargs):
@@ -761,3 +1327,236 @@ class Role(PaginatedAPIMixin, db.Model):
 
     def __repr__(self):
         return '<Role {}>'.format(self.name)
+
+
+class UnreadCounter(db.Model):
+    """用户未读计数, 每个用户每种计数一行, 在产生事件的事务中原子地增减
+
+    计数名与通知名一致: unread_recived_comments_count, unread_likes_count, unread_posts_likes_count,
+    new_follows_count, unread_followeds_posts_count, unread_messages_count"""
+    __tablename__ = 'unread_counters'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    name = db.Column(db.String(64), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<UnreadCounter {} {}={}>'.format(self.user_id, self.name, self.count)
+
+    @staticmethod
+    def _in_users(column, user_ids):
+        """user_ids 可以是单个id、id列表或者返回用户id的查询"""
+        if isinstance(user_ids, int):
+            return column == user_ids
+        if isinstance(user_ids, (list, tuple, set)):
+            return column.in_(list(user_ids))
+        return column.in_(user_ids.statement)
+
+    @staticmethod
+    def incr(user_ids, name, delta=1):
+        """把一个或一批用户的计数加上 delta, 结果不小于0, 缺少的计数行会被补上"""
+        if isinstance(user_ids, (list, tuple, set)) and not user_ids:
+            return
+        value = UnreadCounter.count + delta
+        db.session.query(UnreadCounter).filter(
+            UnreadCounter._in_users(UnreadCounter.user_id, user_ids), UnreadCounter.name == name).update(
+            {UnreadCounter.count: case([(value < 0, 0)], else_=value)}, synchronize_session=False)
+        if delta > 0:
+            # 还没有计数行的用户, 插入初始值
+            exists = db.session.query(UnreadCounter).filter(
+                UnreadCounter.user_id == User.id, UnreadCounter.name == name).exists()
+            missing = db.session.query(User.id, literal(name), literal(delta)).filter(
+                UnreadCounter._in_users(User.id, user_ids), ~exists)
+            db.session.execute(UnreadCounter.__table__.insert().from_select(['user_id', 'name', 'count'], missing))
+
+    @staticmethod
+    def incr_many(deltas: dict, name):
+        """按 {用户id: 增量} 更新一批用户的计数, 增量相同的用户合并为一条语句"""
+        groups = {}
+        for user_id, delta in deltas.items():
+            if delta:
+                groups.setdefault(delta, []).append(user_id)
+        for delta, user_ids in groups.items():
+            UnreadCounter.incr(user_ids, name, delta)
+
+    @staticmethod
+    def get(user_id, name) -> int:
+        """读取计数"""
+        value = db.session.query(UnreadCounter.count).filter_by(user_id=user_id, name=name).scalar()
+        return value or 0
+
+    @staticmethod
+    def get_many(user_ids, name) -> dict:
+        """一次读取一批用户的计数, 返回 {用户id: 计数}"""
+        counts = dict(db.session.query(UnreadCounter.user_id, UnreadCounter.count).filter(
+            UnreadCounter.user_id.in_(list(user_ids)), UnreadCounter.name == name))
+        return {user_id: counts.get(user_id, 0) for user_id in user_ids}
+
+    @staticmethod
+    def rebuild():
+        """根据源数据重新计算所有用户的未读计数, 用于修复计数"""
+        epoch = datetime(1900, 1, 1)
+        counts = {}
+
+        def collect(name, query):
+            for user_id, count in query:
+                counts[(user_id, name)] = count
+
+        collect('unread_messages_count', db.session.query(Message.recipient_id, func.count(Message.id)).join(
+            User, User.id == Message.recipient_id).filter(
+            Message.timestamp > func.coalesce(User.last_messages_read_time, epoch)).group_by(Message.recipient_id))
+        collect('new_follows_count', db.session.query(followers.c.followed_id, func.count()).join(
+            User, User.id == followers.c.followed_id).filter(
+            followers.c.timestamp > func.coalesce(User.last_follows_read_time, epoch)).group_by(followers.c.followed_id))
+        collect('unread_posts_likes_count', db.session.query(Post.author_id, func.count()).select_from(
+            posts_likes).join(Post, Post.id == posts_likes.c.post_id).join(User, User.id == Post.author_id).filter(
+            posts_likes.c.user_id != Post.author_id,
+            posts_likes.c.timestamp > func.coalesce(User.last_posts_likes_read_time, epoch)).group_by(Post.author_id))
+        collect('unread_likes_count', db.session.query(Comment.author_id, func.count()).select_from(
+            comments_likes).join(Comment, Comment.id == comments_likes.c.comments_id).join(
+            User, User.id == Comment.author_id).filter(
+            comments_likes.c.user_id != Comment.author_id,
+            comments_likes.c.timestamp > func.coalesce(User.last_likes_read_time, epoch)).group_by(Comment.author_id))
+        collect('unread_followeds_posts_count', db.session.query(followers.c.follower_id, func.count(Post.id)).select_from(
+            followers).join(Post, Post.author_id == followers.c.followed_id).join(
+            User, User.id == followers.c.follower_id).filter(
+            Post.timestamp > func.coalesce(User.last_followeds_posts_read_time, epoch)).group_by(followers.c.follower_id))
+
+        # 收到的评论需要沿评论树向上找祖先评论的作者, 一次取出所有评论在内存中计算
+        comments = db.session.query(Comment.id, Comment.parent_id, Comment.author_id, Comment.timestamp,
+                                    Post.author_id).join(Post, Post.id == Comment.post_id).all()
+        parents = {c[0]: (c[1], c[2]) for c in comments}
+        read_times = dict(db.session.query(User.id, User.last_recived_comments_read_time))
+        for id, parent_id, author_id, timestamp, post_author_id in comments:
+            users = {post_author_id}
+            while parent_id is not None:
+                parent_id, ancestor_author_id = parents.get(parent_id, (None, None))
+                users.add(ancestor_author_id)
+            users -= {author_id, None}
+            for user_id in users:
+                if timestamp and timestamp > (read_times.get(user_id) or epoch):
+                    key = (user_id, 'unread_recived_comments_count')
+                    counts[key] = counts.get(key, 0) + 1
+
+        db.session.query(UnreadCounter).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(UnreadCounter, [
+            {'user_id': user_id, 'name': name, 'count': count} for (user_id, name), count in counts.items()])
+        return len(counts)
+
+    @staticmethod
+    def set(user_id, name, value=0):
+        """直接设置计数, 用于更新已读时间后清零或重新计数"""
+        updated = db.session.query(UnreadCounter).filter_by(user_id=user_id, name=name).update(
+            {UnreadCounter.count: value}, synchronize_session=False)
+        if not updated:
+            db.session.add(UnreadCounter(user_id=user_id, name=name, count=value))
+
+
+class Timeline(db.Model):
+    """首页时间线, 作者发布文章时写入每个粉丝的时间线, 读取时按时间倒序取一段即可"""
+    __tablename__ = 'timelines'
+    __table_args__ = (db.Index('ix_timelines_user_id_timestamp', 'user_id', 'timestamp', 'post_id'),)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True, index=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
+    timestamp = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<Timeline {} {}>'.format(self.user_id, self.post_id)
+
+    @staticmethod
+    def _insert(query):
+        db.session.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'], query))
+        count_cache.touch(Timeline.__tablename__)
+
+    @staticmethod
+    def _delete(*criterion):
+        db.session.query(Timeline).filter(*criterion).delete(synchronize_session=False)
+        count_cache.touch(Timeline.__tablename__)
+
+    @staticmethod
+    def push(post):
+        """把新文章写入所有粉丝的时间线, 粉丝数超过 TIMELINE_FANOUT_LIMIT 时不推送, 由读取方合并"""
+        db.session.flush()
+        post.fanout = post.author.followers.count() <= current_app.config['TIMELINE_FANOUT_LIMIT']
+        if post.fanout:
+            Timeline._insert(db.session.query(
+                followers.c.follower_id, literal(post.id), literal(post.author_id), literal(post.timestamp)).filter(
+                followers.c.followed_id == post.author_id))
+
+    @staticmethod
+    def remove_post(post_id):
+        """文章删除后从所有时间线中移除"""
+        Timeline._delete(Timeline.post_id == post_id)
+
+    @staticmethod
+    def add_author(user_id, author_id):
+        """关注后把对方已推送过的文章补进时间线"""
+        Timeline._insert(db.session.query(literal(user_id), Post.id, Post.author_id, Post.timestamp).filter(
+            Post.author_id == author_id, Post.fanout.isnot(False)))
+
+    @staticmethod
+    def remove_author(user_id, author_id):
+        """取消关注后移除对方的文章"""
+        Timeline._delete(Timeline.user_id == user_id, Timeline.author_id == author_id)
+
+    @staticmethod
+    def rebuild():
+        """根据关注关系重新生成所有时间线, 返回写入的条数"""
+        Timeline._delete()
+        query = db.session.query(followers.c.follower_id, Post.id, Post.author_id, Post.timestamp).join(
+            Post, Post.author_id == followers.c.followed_id).filter(Post.fanout.isnot(False))
+        Timeline._insert(query)
+        return db.session.query(Timeline).count()
+
+
+# 这些表插入或删除记录后, 分页总数缓存失效
+count_cache.watch(Post, Comment, User, Message)
+
+
+def post_response_tags(post, operation):
+    """文章变化时失效的响应缓存, 评论中带有文章标题"""
+    tags = ['posts', 'post:%d' % post.id]
+    if operation == 'delete' or db.inspect(post).attrs.title.history.has_changes():
+        tags += ['comments', 'post:%d:comments' % post.id]
+    return tags
+
+
+def comment_response_tags(comment, operation):
+    return ['comments', 'post:%d:comments' % comment.post_id]
+
+
+def user_response_tags(user, operation):
+    """评论中带有作者的名字和头像, 只有这几项变化时才失效"""
+    state = db.inspect(user)
+    if operation == 'delete' or any(state.attrs[name].history.has_changes() for name in ('username', 'name', 'email')):
+        return ['users']
+    return []
+
+
+response_cache.watch(Post, post_response_tags)
+response_cache.watch(Comment, comment_response_tags)
+response_cache.watch(User, user_response_tags)
+# token 认证时使用的用户缓存, 用户或角色更新后失效
+user_cache = ObjectCache(User, relations={'role': Role})
+
+
+@db.event.listens_for(Role, 'before_update')
+def bump_role_version(mapper, connection, target):
+    '''角色权限变化时版本号加一'''
+    history = db.inspect(target).attrs.permissions.history
+    if history.added and history.added[0] != (history.deleted[0] if history.deleted else None):
+        target.version = (target.version or 0) + 1
+
+
+@db.event.listens_for(db.session, 'before_commit')
+def flush_notifications(session):
+    '''提交前把本事务中 add_notification 的更新合并写入'''
+    pending = session.info.pop('pending_notifications_upserts', None)
+    if pending:
+        Notification.upsert(list(pending.values()), session)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_notifications(session):
+    session.info.pop('pending_notifications_upserts', None)
@@ -0,0 +1,219 @@
+"""
+File:adjacency.py
+Author:laoyang
+"""
+import threading
+from time import time
+
+from redis.exceptions import RedisError, ResponseError
+from sqlalchemy import event
+
+# 空集合也要缓存, 用不会出现的 id 0 占位, 区分 "集合为空" 和 "没有缓存"
+PLACEHOLDER = 0
+
+
+class AdjacencyCache(object):
+    """关注、拉黑、点赞关系的邻接集合缓存
+
+    每个用户每种关系一个集合, 如 followeds 为用户关注的人的 id, liked_posts 为用户收藏的文章 id.
+    集合在第一次查询时从关联表整体读入, 之后判断是否包含某个 id 不再访问数据库,
+    一页数据的批量判断用一次 SMISMEMBER 完成. 写入关联表时记录在会话中, 事务提交后再同步到集合,
+    回滚时删除涉及的集合. 每个集合有一个版本号, 每次同步或删除都加一; 读入集合前先记下版本号,
+    写入时版本号已经变化说明读库期间有新提交的修改, 放弃这次读入的结果, 以免缓存旧数据.
+    ADJACENCY_CACHE_BACKEND 为 redis 时多个进程共享 app.redis 中的集合,
+    为 memory 时只缓存在当前进程, 为 None 时每次都查询数据库"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.sources = {}
+        self._sets = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._smismember = True
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app.extensions import db
+
+        if self.app is None:
+            event.listen(db.session, 'after_commit', self._after_commit)
+            event.listen(db.session, 'after_rollback', self._after_rollback)
+        self.app = app
+        app.extensions['adjacency_cache'] = self
+        # 进程内的集合属于上一个应用的数据库
+        with self._lock:
+            self._sets.clear()
+            self._versions.clear()
+
+    def register(self, kind, owner_column, member_column):
+        """登记一种关系对应的关联表列"""
+        self.sources[kind] = (owner_column, member_column)
+
+    @property
+    def backend(self):
+        return self.app.config.get('ADJACENCY_CACHE_BACKEND') if self.app is not None else None
+
+    @staticmethod
+    def key(kind, owner_id):
+        return 'madblog:adjacency:{}:{}'.format(kind, owner_id)
+
+    @staticmethod
+    def version_key(key):
+        return key + ':version'
+
+    def add(self, session, kind, owner_id, member_id):
+        """记录一条新增的关系, 事务提交后同步"""
+        session.info.setdefault('pending_adjacency', []).append((kind, owner_id, member_id, True))
+
+    def remove(self, session, kind, owner_id, member_id):
+        """记录一条删除的关系, 事务提交后同步"""
+        session.info.setdefault('pending_adjacency', []).append((kind, owner_id, member_id, False))
+
+    def contains(self, kind, owner_id, member_id) -> bool:
+        """owner 的关系集合中是否包含 member"""
+        return member_id in self.contains_many(kind, owner_id, [member_id])
+
+    def contains_many(self, kind, owner_id, member_ids) -> set:
+        """返回 member_ids 中属于 owner 关系集合的 id"""
+        from app.extensions import db
+
+        member_ids = list(member_ids)
+        if not member_ids:
+            return set()
+        found = None
+        if self.backend == 'redis':
+            found = self._redis_contains(kind, owner_id, member_ids)
+        elif self.backend == 'memory':
+            found = self._load_memory(kind, owner_id) & set(member_ids)
+        if found is None:
+            owner_column, member_column = self.sources[kind]
+            found = {row[0] for row in db.session.query(member_column).filter(
+                owner_column == owner_id, member_column.in_(member_ids))}
+        # 当前事务中尚未提交的修改
+        for pending_kind, pending_owner, member_id, added in db.session.info.get('pending_adjacency', ()):
+            if pending_kind == kind and pending_owner == owner_id and member_id in member_ids:
+                if added:
+                    found.add(member_id)
+                else:
+                    found.discard(member_id)
+        return found
+
+    def invalidate(self, kind, owner_id):
+        """删除 owner 的关系集合, 下次查询时重新读入"""
+        key = self.key(kind, owner_id)
+        if self.backend == 'redis':
+            try:
+                pipe = self.app.redis.pipeline()
+                pipe.incr(self.version_key(key))
+                pipe.expire(self.version_key(key), self._ttl())
+                pipe.delete(key)
+                pipe.execute()
+            except RedisError:
+                self.app.logger.exception('[关系缓存]删除失败')
+        with self._lock:
+            self._sets.pop(key, None)
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def _members(self, kind, owner_id):
+        from app.extensions import db
+
+        owner_column, member_column = self.sources[kind]
+        return [row[0] for row in db.session.query(member_column).filter(owner_column == owner_id)]
+
+    def _ttl(self):
+        return self.app.config.get('ADJACENCY_CACHE_TTL', 3600)
+
+    def _load_memory(self, kind, owner_id) -> set:
+        key = self.key(kind, owner_id)
+        with self._lock:
+            entry = self._sets.get(key)
+            version = self._versions.get(key, 0)
+        if entry is not None and entry[1] > time():
+            return set(entry[0])
+        members = set(self._members(kind, owner_id))
+        with self._lock:
+            if self._versions.get(key, 0) == version:
+                self._sets[key] = (members, time() + self._ttl())
+        return set(members)
+
+    def _redis_contains(self, kind, owner_id, member_ids):
+        """集合不存在时整体读入, Redis 不可用时返回 None 由调用者查询数据库"""
+        redis = self.app.redis
+        key = self.key(kind, owner_id)
+        try:
+            if not redis.exists(key):
+                version = redis.get(self.version_key(key)) or b'0'
+                members = self._members(kind, owner_id)
+                redis.eval(self.FILL_SCRIPT, 2, key, self.version_key(key), version, self._ttl(),
+                           PLACEHOLDER, *members)
+                return set(members) & set(member_ids)
+            if self._smismember:
+                try:
+                    flags = redis.execute_command('SMISMEMBER', key, *member_ids)
+                except ResponseError:
+                    # Redis 6.2 之前没有 SMISMEMBER, 改用管道逐个判断
+                    self._smismember = False
+            if not self._smismember:
+                pipe = redis.pipeline(transaction=False)
+                for member_id in member_ids:
+                    pipe.sismember(key, member_id)
+                flags = pipe.execute()
+            return {member_id for member_id, flag in zip(member_ids, flags) if flag}
+        except RedisError:
+            self.app.logger.exception('[关系缓存]读取失败')
+            return None
+
+    # 版本号没有变化时才写入读到的集合, 成员分段加入, 避免超出 Lua 的参数个数限制
+    FILL_SCRIPT = """
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] then return 0 end
+redis.call('del', KEYS[1])
+for i = 3, #ARGV, 5000 do
+    redis.call('sadd', KEYS[1], unpack(ARGV, i, math.min(i + 4999, #ARGV)))
+end
+redis.call('expire', KEYS[1], ARGV[2])
+return 1
+"""
+
+    # 版本号加一, 集合已经存在时才加入或删除成员, 以免生成不完整的集合
+    APPLY_SCRIPT = """
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[3])
+if redis.call('exists', KEYS[1]) == 0 then return 0 end
+if ARGV[2] == '1' then return redis.call('sadd', KEYS[1], ARGV[1]) end
+return redis.call('srem', KEYS[1], ARGV[1])
+"""
+
+    def _apply(self, kind, owner_id, member_id, added):
+        key = self.key(kind, owner_id)
+        if self.backend == 'redis':
+            try:
+                self.app.redis.eval(self.APPLY_SCRIPT, 2, key, self.version_key(key), member_id,
+                                    1 if added else 0, self._ttl())
+            except RedisError:
+                self.app.logger.exception('[关系缓存]同步失败')
+                self.invalidate(kind, owner_id)
+            return
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            entry = self._sets.get(key)
+            if entry is not None:
+                if added:
+                    entry[0].add(member_id)
+                else:
+                    entry[0].discard(member_id)
+
+    def _after_commit(self, session):
+        if self.app is None or not self.backend:
+            session.info.pop('pending_adjacency', None)
+            return
+        for kind, owner_id, member_id, added in session.info.pop('pending_adjacency', ()):
+            self._apply(kind, owner_id, member_id, added)
+
+    def _after_rollback(self, session):
+        pending = session.info.pop('pending_adjacency', ())
+        if self.app is None or not self.backend:
+            return
+        # 事务中读入的集合可能包含未提交的修改, 全部丢弃
+        for kind, owner_id in {(kind, owner_id) for kind, owner_id, member_id, added in pending}:
+            self.invalidate(kind, owner_id)
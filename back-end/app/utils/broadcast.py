@@ -0,0 +1,140 @@
+"""
+File:broadcast.py
+Author:laoyang
+"""
+import time
+from datetime import datetime
+
+from flask import current_app
+
+from app.extensions import db
+from app.models import User, Message, Notification, UnreadCounter, TaskChunk, Conversation
+from app.utils.cache import count_cache
+from app.utils.email import build_email, dispatch_email
+
+TEXT_BODY = '''
+            Dear {},
+            {}
+            Sincerely,
+            The Madblog Team
+            Note: replies to this email address are not monitored.
+            '''
+
+HTML_BODY = '''
+            <p>Dear {0},</p>
+            <p>{1}</p>
+            <p>Sincerely,</p>
+            <p>The Madblog Team</p>
+            <p><small>Note: replies to this email address are not monitored.</small></p>
+            '''
+
+
+def iter_recipient_chunks(sender_id, chunk_size, min_id=None, max_id=None):
+    """按用户id顺序分批取出接收者 (id, username, email), 用 id > 上一批最大id 定位, 不使用 OFFSET"""
+    last_id = min_id - 1 if min_id is not None else None
+    while True:
+        query = db.session.query(User.id, User.username, User.email).filter(User.id != sender_id)
+        if last_id is not None:
+            query = query.filter(User.id > last_id)
+        if max_id is not None:
+            query = query.filter(User.id <= max_id)
+        chunk = query.order_by(User.id).limit(chunk_size).all()
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+
+
+def send_chunk(sender_id, body, recipients):
+    """给一批接收者群发私信: 批量插入私信, 一条语句更新未读计数, 批量写通知, 返回要发送的邮件
+
+    不提交事务, 由调用方和处理进度一起提交, 重试时不会重复插入已提交的私信"""
+    now = datetime.utcnow()
+    ids = [r.id for r in recipients]
+    db.session.execute(Message.__table__.insert(), [
+        {'body': body, 'timestamp': now, 'sender_id': sender_id, 'recipient_id': id} for id in ids])
+    count_cache.touch(Message.__tablename__)
+    Conversation.incr(sender_id, ids)
+    UnreadCounter.incr(ids, 'unread_messages_count')
+    Notification.bulk_replace('unread_messages_count', UnreadCounter.get_many(ids, 'unread_messages_count'))
+    return [build_email('[Madblog] 温馨提醒',
+                        sender=current_app.config['MAIL_SENDER'],
+                        recipients=[r.email],
+                        text_body=TEXT_BODY.format(r.username, body),
+                        html_body=HTML_BODY.format(r.username, body))
+            for r in recipients if r.email]
+
+
+def send_chunk_emails(emails):
+    """私信提交后逐封交给邮件队列, 由队列负责重试; 一封邮件失败只记录日志, 不影响其他接收者"""
+    for msg in emails:
+        try:
+            dispatch_email(msg)
+        except Exception:
+            current_app.logger.exception('[群发私信]邮件发送失败: %s', msg.recipients)
+
+
+def broadcast(sender_id, body, progress=None, min_id=None, max_id=None):
+    """分批群发私信, 每批结束后调用 progress(已发送数, 总数, 本批最大的接收者id)
+
+    progress 在本批私信所在的事务中执行, 记录的进度和私信一起提交.
+    每批人数由 BROADCAST_CHUNK_SIZE 决定, BROADCAST_RATE 限制每秒发送的人数, 为 0 时不限速"""
+    chunk_size = current_app.config['BROADCAST_CHUNK_SIZE']
+    rate = current_app.config['BROADCAST_RATE']
+    query = db.session.query(User.id).filter(User.id != sender_id)
+    if min_id is not None:
+        query = query.filter(User.id >= min_id)
+    if max_id is not None:
+        query = query.filter(User.id <= max_id)
+    total = query.count()
+    sent = 0
+    for chunk in iter_recipient_chunks(sender_id, chunk_size, min_id, max_id):
+        started = time.time()
+        emails = send_chunk(sender_id, body, chunk)
+        sent += len(chunk)
+        if progress is not None:
+            progress(sent, total, chunk[-1].id)
+        db.session.commit()
+        send_chunk_emails(emails)
+        if rate:
+            # 按设定的速率补足这一批应占用的时间
+            time.sleep(max(0, len(chunk) / float(rate) - (time.time() - started)))
+    return sent
+
+
+def plan_chunks(task, sender_id, job_size):
+    """按接收者id顺序每 job_size 人划分一个id范围, 为每个范围创建一个子任务"""
+    ids = [row.id for row in db.session.query(User.id).filter(User.id != sender_id).order_by(User.id)]
+    chunks = []
+    for start in range(0, len(ids), job_size):
+        part = ids[start:start + job_size]
+        chunks.append(TaskChunk(task=task, min_id=part[0], max_id=part[-1], total=len(part)))
+    db.session.add_all(chunks)
+    db.session.flush()
+    return chunks
+
+
+def run_chunk(chunk, sender_id, body):
+    """执行一个子任务, 每批提交后记录处理到的位置, 失败后重试时从该位置继续"""
+    if chunk.status == TaskChunk.DONE:
+        return
+    chunk.status = TaskChunk.RUNNING
+    chunk.attempts = (chunk.attempts or 0) + 1
+    db.session.commit()
+    start = chunk.last_id + 1 if chunk.last_id is not None else chunk.min_id
+    sent_before = chunk.sent or 0
+
+    def progress(sent, total, last_id):
+        chunk.sent = sent_before + sent
+        chunk.last_id = last_id
+        db.session.commit()
+
+    try:
+        broadcast(sender_id, body, progress=progress, min_id=start, max_id=chunk.max_id)
+    except Exception:
+        db.session.rollback()
+        chunk.status = TaskChunk.FAILED
+        db.session.commit()
+        raise
+    chunk.status = TaskChunk.DONE
+    db.session.commit()
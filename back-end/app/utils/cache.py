@@ -0,0 +1,461 @@
+"""
+File:cache.py
+Author:laoyang
+"""
+import threading
+from collections import Counter, OrderedDict
+from functools import wraps
+from hashlib import sha1
+from time import time
+
+from flask import current_app, make_response, request
+from redis.exceptions import RedisError
+from sqlalchemy import Table, event
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.util import find_tables
+
+from app.extensions import db
+
+
+class TTLCache(object):
+    """线程安全的进程内缓存, 条目超过 ttl 秒后过期, 超过 maxsize 时淘汰最久未使用的条目"""
+
+    def __init__(self, ttl=60, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, allow_expired=False):
+        """读取缓存, allow_expired 为 True 时过期的条目也会返回"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time() and not allow_expired:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """写入缓存"""
+        with self._lock:
+            self._data[key] = (value, time() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """删除一个条目"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CountCache(object):
+    """分页总数缓存, 以查询编译后的 SQL 和参数为键
+
+    每张表维护一个版本号, 被监视的模型插入或删除记录并提交后, 对应表的版本号加一; 关联表和批量写入
+    不经过模型事件, 由写入方调用 touch 标记. 缓存条目记录了计算时涉及各表的版本号, 版本号变化即视为失效.
+    COUNT_CACHE_BACKEND 为 redis 时版本号保存在 app.redis 中, 一个进程的写入会使所有进程的缓存失效;
+    为 memory 时版本号只在当前进程中, 其他进程的总数最多滞后 COUNT_CACHE_TTL 秒"""
+
+    MODES = ('cached', 'approx', 'exact', 'none')
+    GENERATIONS_KEY = 'madblog:count:generations'
+
+    def __init__(self, app=None, maxsize=1024):
+        self.app = None
+        self.cache = TTLCache(maxsize=maxsize)
+        self.generations = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.cache.clear()
+        with self._lock:
+            self.generations.clear()
+        app.extensions['count_cache'] = self
+
+    @property
+    def backend(self):
+        return self.app.config.get('COUNT_CACHE_BACKEND') if self.app is not None else None
+
+    def watch(self, *models):
+        """监听模型的插入和删除事件"""
+        for model in models:
+            event.listen(model, 'after_insert', self._mark_dirty)
+            event.listen(model, 'after_delete', self._mark_dirty)
+
+    def _mark_dirty(self, mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('dirty_count_tables', set()).add(mapper.local_table.name)
+
+    def touch(self, *tables):
+        """批量插入或删除、写入关联表不会触发模型事件, 由调用方标记表已变化, 提交后生效"""
+        db.session.info.setdefault('dirty_count_tables', set()).update(tables)
+
+    def bump(self, tables):
+        """把各表的版本号加一"""
+        if self.backend == 'redis':
+            try:
+                pipe = self.app.redis.pipeline(transaction=False)
+                for table in tables:
+                    pipe.hincrby(self.GENERATIONS_KEY, table, 1)
+                pipe.execute()
+                return
+            except RedisError:
+                self.app.logger.exception('[总数缓存]更新版本号失败')
+        with self._lock:
+            for table in tables:
+                self.generations[table] = self.generations.get(table, 0) + 1
+
+    def get_generations(self, tables) -> dict:
+        """读取各表的版本号, Redis 不可用时返回 None, 此时不使用缓存"""
+        tables = sorted(tables)
+        if self.backend == 'redis':
+            try:
+                values = self.app.redis.hmget(self.GENERATIONS_KEY, tables) if tables else []
+            except RedisError:
+                self.app.logger.exception('[总数缓存]读取版本号失败')
+                return None
+            return {table: int(value or 0) for table, value in zip(tables, values)}
+        with self._lock:
+            return {table: self.generations.get(table, 0) for table in tables}
+
+    def _after_commit(self, session):
+        tables = session.info.pop('dirty_count_tables', None)
+        if tables:
+            self.bump(tables)
+
+    def _after_rollback(self, session):
+        session.info.pop('dirty_count_tables', None)
+
+    def key(self, query):
+        """缓存键: 编译后的 SQL 和参数"""
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        return str(compiled), repr(sorted(compiled.params.items()))
+
+    def count(self, query, mode='cached'):
+        """统计查询的总数, mode 取值:
+        cached: 使用未过期且未失效的缓存; approx: 允许使用过期或已失效的缓存;
+        exact: 重新统计并刷新缓存; none: 不统计, 返回 None"""
+        if mode == 'none':
+            return None
+        query = query.order_by(None)
+        key = self.key(query)
+        tables = {t.name for t in find_tables(query.statement, check_columns=True, include_aliases=True,
+                                              include_joins=True) if isinstance(t, Table)}
+        generation = self.get_generations(tables)
+
+        if mode != 'exact':
+            entry = self.cache.get(key, allow_expired=(mode == 'approx'))
+            if entry is not None and (mode == 'approx' or entry[1] == generation):
+                return entry[0]
+
+        total = query.count()
+        if generation is not None:
+            self.cache.set(key, (total, generation), ttl=current_app.config['COUNT_CACHE_TTL'])
+        return total
+
+
+class ObjectCache(object):
+    """按主键缓存模型对象, 命中时不访问数据库
+
+    缓存的是对象及其多对一关联的列值, 读取时重建为脱离会话的对象, 再以 load=False 合并到当前会话,
+    各请求拿到的是各自会话中的实例. 模型更新或删除时, 在刷新和提交后各清除一次对应条目,
+    关联的模型变化时清空整个缓存.
+    OBJECT_CACHE_BACKEND 为 redis 时, 提交后还会把对象和整个缓存的版本号记在 app.redis 中, 每次读取先比较版本号,
+    其他进程的修改立即生效; 为 memory 时只清除当前进程的缓存, 其他进程最多在条目的有效期内读到旧对象"""
+
+    def __init__(self, model, relations=None, maxsize=4096):
+        # relations: 一并缓存的多对一关联, {关联名: 关联模型}
+        self.app = None
+        self.model = model
+        self.relations = relations or {}
+        self.cache = TTLCache(maxsize=maxsize)
+        event.listen(model, 'after_update', self._evict)
+        event.listen(model, 'after_delete', self._evict)
+        for related in self.relations.values():
+            event.listen(related, 'after_update', self._evict_all)
+            event.listen(related, 'after_delete', self._evict_all)
+
+    def init_app(self, app):
+        self.app = app
+        self.cache.clear()
+
+    @property
+    def backend(self):
+        return self.app.config.get('OBJECT_CACHE_BACKEND') if self.app is not None else None
+
+    def version_key(self, id=None):
+        """整个缓存(id 为 None)或单个对象的版本号键"""
+        name = self.model.__tablename__
+        return 'madblog:object:{}:version'.format(name) if id is None else \
+            'madblog:object:{}:{}:version'.format(name, id)
+
+    def get_versions(self, id):
+        """读取整个缓存和对象的版本号, Redis 不可用时返回 None, 此时不使用缓存"""
+        if self.backend != 'redis':
+            return ()
+        try:
+            return tuple(int(value or 0) for value in self.app.redis.mget([self.version_key(), self.version_key(id)]))
+        except RedisError:
+            self.app.logger.exception('[对象缓存]读取版本号失败')
+            return None
+
+    def bump(self, ids):
+        """把对象的版本号加一, id 为 None 时使整个缓存失效"""
+        if self.backend != 'redis':
+            return
+        try:
+            pipe = self.app.redis.pipeline(transaction=False)
+            for id in ids:
+                pipe.incr(self.version_key(id))
+                if id is not None:
+                    pipe.expire(self.version_key(id), 86400)
+            pipe.execute()
+        except RedisError:
+            self.app.logger.exception('[对象缓存]更新版本号失败')
+
+    def get(self, id, ttl=None):
+        """按主键读取对象, 未命中或版本号变化时查询数据库并写入缓存"""
+        # 先读版本号再查数据库, 期间提交的修改会使版本号变化, 不会把旧对象当作新版本缓存
+        versions = self.get_versions(id)
+        entry = self.cache.get(id) if versions is not None else None
+        if entry is None or entry[1] != versions:
+            obj = self.model.query.get(id)
+            if obj is not None and versions is not None:
+                self.cache.set(id, (self._snapshot(obj), versions), ttl=ttl)
+            return obj
+        (columns, relations), _ = entry
+        obj = self._restore(self.model, columns)
+        for name, values in relations.items():
+            set_committed_value(obj, name, None if values is None else self._restore(self.relations[name], values))
+        return db.session.merge(obj, load=False)
+
+    def delete(self, id):
+        self.cache.delete(id)
+        self.bump([id])
+
+    def clear(self):
+        self.cache.clear()
+        self.bump([None])
+
+    def _snapshot(self, obj):
+        relations = {}
+        for name in self.relations:
+            related = getattr(obj, name)
+            relations[name] = None if related is None else self._columns(related)
+        return self._columns(obj), relations
+
+    @staticmethod
+    def _columns(obj):
+        return {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs}
+
+    @staticmethod
+    def _restore(model, columns):
+        obj = inspect(model).class_manager.new_instance()
+        for key, value in columns.items():
+            set_committed_value(obj, key, value)
+        make_transient_to_detached(obj)
+        return obj
+
+    def _evict(self, mapper, connection, target):
+        self.cache.delete(target.id)
+        # 提交前其他请求可能又读到了旧值, 提交后再清除一次
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('evicted_objects', set()).add((self, target.id))
+
+    def _evict_all(self, mapper, connection, target):
+        self.cache.clear()
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('evicted_objects', set()).add((self, None))
+
+    @staticmethod
+    def _after_commit(session):
+        evicted = {}
+        for cache, id in session.info.pop('evicted_objects', ()):
+            evicted.setdefault(cache, set()).add(id)
+        for cache, ids in evicted.items():
+            if None in ids:
+                cache.cache.clear()
+            else:
+                for id in ids:
+                    cache.cache.delete(id)
+            cache.bump(ids)
+
+
+class ResponseCache(object):
+    """公开 GET 接口的响应缓存
+
+    每个标签(如 posts, post:1, post:1:comments)维护一个版本号, 响应的 ETag 由请求路径、参数和所用标签的
+    版本号计算得到. 请求带有相同的 If-None-Match 时直接返回 304, 缓存中有同一 ETag 的响应时直接返回缓存,
+    两种情况都不访问数据库. 被监视的模型写入时按 watch 登记的函数得到标签, 不经过模型事件的批量写入
+    调用 invalidate 标记标签, 事务提交后版本号加一, 旧的缓存随之失效.
+    RESPONSE_CACHE_BACKEND 为 redis 时版本号和响应保存在 app.redis 中, 多个进程共享;
+    为 memory 时保存在当前进程; 为 None 时不缓存"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.cache = TTLCache()
+        self.versions = {}
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.cache = TTLCache(ttl=app.config.get('RESPONSE_CACHE_TTL', 300),
+                              maxsize=app.config.get('RESPONSE_CACHE_SIZE', 1024))
+        with self._lock:
+            self.versions.clear()
+            self.stats.clear()
+        app.extensions['response_cache'] = self
+
+    @property
+    def backend(self):
+        return self.app.config.get('RESPONSE_CACHE_BACKEND') if self.app is not None else None
+
+    # 所有响应都带有的标签, clear() 使全部缓存失效
+    ALL = '*'
+
+    def watch(self, model, tags):
+        """监听模型的写入, tags(对象, 操作) 返回受影响的标签, 操作为 insert, update 或 delete"""
+        for operation in ('insert', 'update', 'delete'):
+            event.listen(model, 'after_' + operation, self._mark_dirty(tags, operation))
+
+    def _mark_dirty(self, tags, operation):
+        def listener(mapper, connection, target):
+            session = object_session(target)
+            if session is not None:
+                session.info.setdefault('dirty_response_tags', set()).update(tags(target, operation))
+        return listener
+
+    def invalidate(self, *tags):
+        """标记标签已变化, 提交后生效"""
+        db.session.info.setdefault('dirty_response_tags', set()).update(tags)
+
+    def clear(self):
+        """使全部缓存的响应失效"""
+        self.bump(self.ALL)
+
+    def bump(self, *tags):
+        """立即把标签的版本号加一"""
+        if self.backend == 'redis':
+            try:
+                pipe = self.app.redis.pipeline(transaction=False)
+                for tag in tags:
+                    pipe.incr('madblog:response:tag:' + tag)
+                pipe.execute()
+            except RedisError:
+                self.app.logger.exception('[响应缓存]更新版本号失败')
+            return
+        with self._lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+
+    def get_versions(self, tags):
+        if self.backend == 'redis':
+            values = self.app.redis.mget(['madblog:response:tag:' + tag for tag in tags])
+            return [int(value or 0) for value in values]
+        with self._lock:
+            return [self.versions.get(tag, 0) for tag in tags]
+
+    def _load(self, key):
+        if self.backend == 'redis':
+            value = self.app.redis.get('madblog:response:' + key)
+            if value is None:
+                return None
+            etag, body = value.split(b'\n', 1)
+            return etag.decode(), body
+        return self.cache.get(key)
+
+    def _store(self, key, etag, body):
+        if self.backend == 'redis':
+            self.app.redis.setex('madblog:response:' + key, self.cache.ttl, etag.encode() + b'\n' + body)
+        else:
+            self.cache.set(key, (etag, body))
+
+    def respond(self, tags, build):
+        """返回缓存的响应, 未命中时调用 build() 生成响应并缓存"""
+        if not self.backend or request.method != 'GET':
+            return build()
+        args = sorted(request.args.items(multi=True))
+        key = sha1(repr((request.path, args)).encode('utf-8')).hexdigest()
+        tags = list(tags) + [self.ALL]
+        try:
+            versions = self.get_versions(tags)
+            etag = sha1(repr((key, tags, versions)).encode('utf-8')).hexdigest()
+            if etag in request.if_none_match:
+                self.stats['not_modified'] += 1
+                return self._make_response(etag, status=304)
+            entry = self._load(key)
+        except RedisError:
+            self.app.logger.exception('[响应缓存]读取失败')
+            return build()
+        if entry is not None and entry[0] == etag:
+            self.stats['hits'] += 1
+            return self._make_response(etag, entry[1])
+
+        self.stats['misses'] += 1
+        response = make_response(build())
+        if response.status_code == 200:
+            # 版本号在查询数据库之前读取, 期间发生的修改会使这个 ETag 失效, 不会缓存旧数据
+            try:
+                self._store(key, etag, response.get_data())
+            except RedisError:
+                self.app.logger.exception('[响应缓存]写入失败')
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    @staticmethod
+    def _make_response(etag, body=b'', status=200):
+        response = current_app.response_class(body, status=status, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def cached(self, *tags):
+        """视图装饰器, 标签中的 {参数名} 用视图的 URL 参数替换"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                return self.respond([tag.format(**kwargs) for tag in tags], lambda: view(*args, **kwargs))
+            return wrapper
+        return decorator
+
+    def _after_commit(self, session):
+        tags = session.info.pop('dirty_response_tags', None)
+        if tags and self.backend:
+            self.bump(*tags)
+
+    @staticmethod
+    def _after_rollback(session):
+        session.info.pop('dirty_response_tags', None)
+
+
+count_cache = CountCache()
+event.listen(db.session, 'after_commit', count_cache._after_commit)
+event.listen(db.session, 'after_rollback', count_cache._after_rollback)
+event.listen(db.session, 'after_commit', ObjectCache._after_commit)
+
+response_cache = ResponseCache()
+event.listen(db.session, 'after_commit', response_cache._after_commit)
+event.listen(db.session, 'after_rollback', response_cache._after_rollback)
@@ -0,0 +1,45 @@
+"""
+File:counters.py
+Author:laoyang
+"""
+from sqlalchemy import and_, func, select
+
+from app.extensions import db
+from app.models import User, Post, Comment, followers, posts_likes, comments_likes, user_cache
+from app.utils.cache import response_cache
+
+
+def counter_sources():
+    """冗余计数列及其来源: (模型, 计数列, 关联表中指向该模型的外键列)"""
+    return [
+        (Post, 'likes_count', posts_likes.c.post_id),
+        (Post, 'comments_count', Comment.__table__.c.post_id),
+        (Comment, 'likes_count', comments_likes.c.comments_id),
+        (User, 'followers_count', followers.c.followed_id),
+        (User, 'followeds_count', followers.c.follower_id),
+        (User, 'posts_count', Post.__table__.c.author_id),
+    ]
+
+
+def reconcile_counters(batch_size=1000, progress=None) -> int:
+    """按 id 区间分批用关联表重新计算冗余计数, 只更新有偏差的行, 每批单独提交, 返回修正的行数
+
+    progress 回调参数为 (模型, 计数列, 已处理到的 id)"""
+    repaired = 0
+    for model, name, foreign_key in counter_sources():
+        table = model.__table__
+        column = table.c[name]
+        actual = select([func.count()]).where(foreign_key == table.c.id).as_scalar()
+        max_id = db.session.query(func.max(table.c.id)).scalar() or 0
+        for low in range(0, max_id + 1, batch_size):
+            result = db.session.execute(table.update().where(and_(
+                table.c.id >= low, table.c.id < low + batch_size, column != actual)).values({name: actual}))
+            db.session.commit()
+            repaired += result.rowcount
+            if progress is not None:
+                progress(model, name, min(low + batch_size - 1, max_id))
+    # 批量 UPDATE 不经过 ORM 事件, 缓存的用户和响应需要重新生成
+    if repaired:
+        user_cache.clear()
+        response_cache.clear()
+    return repaired
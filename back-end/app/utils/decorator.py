@@ -1,17 +1,25 @@
 from functools import wraps
 
-from flask import g
+from flask import current_app, g
 
 from app.api.error import error_response
 from app.models import Permission
 
 
+def has_permission(permission):
+    """当前用户是否具有某个权限, token 中带有权限位掩码时直接读取, 不查询角色"""
+    claims = g.get('token_claims')
+    if current_app.config['TOKEN_PERMISSION_CLAIMS'] and claims and 'perms' in claims:
+        return claims['perms'] & permission == permission
+    return g.current_user.can(permission)
+
+
 def permission_required(permission):
     """检查常规权限"""
     def decorator(f):
         @wraps(f)
         def decorator_function(*args,**kwargs):
-            if not g.current_user.can(permission):
+            if not has_permission(permission):
                 return error_response(403)
             else:
                 return f(*args,**kwargs)
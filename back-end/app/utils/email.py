@@ -2,24 +2,340 @@
 File:email.py
 Author:laoyang
 """
+import atexit
+import json
+import queue
+import smtplib
+import sys
+import threading
+import time
+from uuid import uuid4
+
 from flask import current_app
 from flask_mail import Message
 from app.extensions import mail
-from threading import Thread
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class SMTPTransport(object):
+    """Flask-Mail 的 SMTP 连接, 第一次发送时建立, 之后在多封邮件间复用"""
 
+    def __init__(self):
+        self.connection = None
 
-def send_email(subject, recipients:list, sender:str, text_body:str, html_body:str, attachments=None, sync=False):
-    """发送邮件"""
+    def send(self, msg):
+        if self.connection is None:
+            self.connection = mail.connect().__enter__()
+        try:
+            self.connection.send(msg)
+        except smtplib.SMTPServerDisconnected:
+            # 空闲连接被服务器关闭, 重新连接后再发一次
+            self.close()
+            self.connection = mail.connect().__enter__()
+            self.connection.send(msg)
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.__exit__(None, None, None)
+            except smtplib.SMTPException:
+                pass
+            self.connection = None
+
+
+class FileTransport(object):
+    """把邮件追加写入文件, 用于测试和压测"""
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, msg):
+        data = msg.as_string()
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(data + '\n\n')
+
+    def close(self):
+        pass
+
+
+class ConsoleTransport(object):
+    """把邮件打印到标准输出, 用于本地开发"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def send(self, msg):
+        self.stream.write('To: {}\nSubject: {}\n\n{}\n\n'.format(', '.join(msg.send_to), msg.subject, msg.body))
+
+    def close(self):
+        pass
+
+
+def make_transport(app):
+    """根据 MAIL_TRANSPORT 配置创建发送方式: smtp, file 或 console"""
+    name = app.config['MAIL_TRANSPORT']
+    if name == 'file':
+        return FileTransport(app.config['MAIL_FILE_PATH'])
+    if name == 'console':
+        return ConsoleTransport()
+    return SMTPTransport()
+
+
+class EmailDispatcher(object):
+    """后台发送邮件: 有界队列加固定数量的发送线程, 每个线程持有一个持久的连接
+
+    队列满时 submit 最多等待 MAIL_QUEUE_TIMEOUT 秒, 仍然满载则在调用方线程中同步发送, 把压力传回请求方;
+    连接空闲超过 MAIL_IDLE_TIMEOUT 秒后关闭, 进程退出前把队列中的邮件发完"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._queue = None
+        self._threads = []
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self.shutdown)
+        else:
+            self.shutdown()
+        self.app = app
+        self._queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        app.extensions['email_dispatcher'] = self
+
+    def submit(self, msg):
+        """把邮件放入发送队列"""
+        self._start_workers()
+        try:
+            self._queue.put(msg, timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            self.app.logger.warning('[邮件]发送队列已满, 改为同步发送')
+            transport = make_transport(self.app)
+            try:
+                transport.send(msg)
+            finally:
+                transport.close()
+
+    def pending(self) -> int:
+        """尚未发送完成的邮件数"""
+        return self._queue.unfinished_tasks if self._queue is not None else 0
+
+    def flush(self, timeout=None) -> bool:
+        """等待队列中的邮件发送完成, 超时返回 False"""
+        if self._queue is None:
+            return True
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def shutdown(self, timeout=None):
+        """发完队列中的邮件后停止发送线程"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        if not threads:
+            return
+        self.flush(timeout)
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+    def _start_workers(self):
+        if self._threads:
+            return
+        with self._lock:
+            if not self._threads:
+                for _ in range(self.app.config['MAIL_WORKERS']):
+                    thread = threading.Thread(target=self._run, args=(self.app, self._queue), daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    @staticmethod
+    def _run(app, tasks):
+        with app.app_context():
+            transport = make_transport(app)
+            while True:
+                try:
+                    msg = tasks.get(timeout=app.config['MAIL_IDLE_TIMEOUT'])
+                except queue.Empty:
+                    transport.close()
+                    continue
+                if msg is None:
+                    tasks.task_done()
+                    break
+                try:
+                    transport.send(msg)
+                except Exception:
+                    app.logger.exception('[邮件]发送失败')
+                    transport.close()
+                finally:
+                    tasks.task_done()
+            transport.close()
+
+
+email_dispatcher = EmailDispatcher()
+
+
+def build_email(subject, recipients:list, sender:str, text_body:str, html_body:str):
+    """构建一封邮件"""
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
+    return msg
+
+
+# RQ 发送邮件使用的 Redis 键: 待发送列表, 发送失败超过重试次数的死信列表, 是否已有发送任务在排队,
+# 每个发送任务正在处理的邮件列表, 以及这些列表的租约到期时间(有序集合)
+OUTBOX_KEY = 'madblog:email:outbox'
+DEAD_LETTER_KEY = 'madblog:email:dead'
+SCHEDULED_KEY = 'madblog:email:scheduled'
+PROCESSING_KEY = 'madblog:email:processing:{}'
+LEASES_KEY = 'madblog:email:leases'
+
+# 从待发送列表头部取出一批邮件, 在同一个原子操作中放入发送任务的处理列表
+TAKE_SCRIPT = """
+local items = redis.call('lrange', KEYS[1], 0, ARGV[1] - 1)
+if #items > 0 then
+    redis.call('ltrim', KEYS[1], #items, -1)
+    redis.call('rpush', KEYS[2], unpack(items))
+end
+return items
+"""
+
+
+def email_to_dict(msg, attempts=0) -> dict:
+    """把邮件序列化为可以放入 Redis 的字典"""
+    return {'subject': msg.subject, 'recipients': msg.recipients, 'sender': msg.sender,
+            'text_body': msg.body, 'html_body': msg.html, 'attempts': attempts}
+
+
+def email_from_dict(data):
+    """从字典重建邮件"""
+    return build_email(data['subject'], data['recipients'], data['sender'], data['text_body'], data['html_body'])
+
+
+def schedule_drain():
+    """没有发送任务在排队或执行时, 放入一个新的发送任务
+
+    标记在 MAIL_JOB_TIMEOUT 秒后过期, 发送任务执行期间不断续期; 任务失败或 worker 退出后,
+    下一封入队的邮件会重新放入发送任务"""
+    if current_app.redis.set(SCHEDULED_KEY, 1, nx=True, ex=current_app.config['MAIL_JOB_TIMEOUT']):
+        current_app.task_queue.enqueue('app.utils.tasks.send_queued_emails')
+
+
+def queue_email(msg):
+    """把邮件放入 Redis 待发送列表, 并保证有一个发送任务在 RQ 队列中, 多封邮件由同一个任务合并发送"""
+    current_app.redis.rpush(OUTBOX_KEY, json.dumps(email_to_dict(msg)))
+    schedule_drain()
+
+
+def deliver(payloads, transport, max_retries):
+    """用同一个连接发送一批邮件, 返回 (需要重试的, 放弃重试的)"""
+    retry, dead = [], []
+    for data in payloads:
+        try:
+            transport.send(email_from_dict(data))
+        except Exception:
+            current_app.logger.exception('[邮件]发送失败: %s', data['recipients'])
+            # 连接可能已经不可用, 下一封重新连接
+            transport.close()
+            data['attempts'] = data.get('attempts', 0) + 1
+            (retry if data['attempts'] < max_retries else dead).append(data)
+    return retry, dead
+
+
+def recover_outbox() -> int:
+    """把租约已过期的发送任务(worker 意外退出)没有处理完的邮件放回待发送列表头部, 返回邮件数"""
+    redis = current_app.redis
+    count = 0
+    for token in redis.zrangebyscore(LEASES_KEY, 0, time.time()):
+        key = PROCESSING_KEY.format(token.decode('utf-8'))
+        while redis.rpoplpush(key, OUTBOX_KEY) is not None:
+            count += 1
+        redis.zrem(LEASES_KEY, token)
+    if count:
+        current_app.logger.warning('[邮件]%d 封邮件的发送任务已失效, 重新放回待发送列表', count)
+    return count
+
+
+def drain_outbox():
+    """RQ 任务: 每次取出 MAIL_BATCH_SIZE 封邮件在一个 SMTP 会话中发送, 直到待发送列表为空
+
+    取出的邮件先移入本任务的处理列表, 发送完才删除; 任务每批续期 MAIL_JOB_TIMEOUT 秒的租约,
+    worker 意外退出后由下一个发送任务放回待发送列表, 邮件不会丢失.
+    失败的邮件放回列表末尾, 间隔 MAIL_RETRY_DELAY 秒后重试, 超过 MAIL_MAX_RETRIES 次后移入死信列表"""
+    redis = current_app.redis
+    batch_size = current_app.config['MAIL_BATCH_SIZE']
+    timeout = current_app.config['MAIL_JOB_TIMEOUT']
+    token = uuid4().hex
+    processing = PROCESSING_KEY.format(token)
+    recover_outbox()
+    sent = 0
+    while True:
+        redis.zadd(LEASES_KEY, {token: time.time() + timeout})
+        redis.expire(SCHEDULED_KEY, timeout)
+        items = redis.eval(TAKE_SCRIPT, 2, OUTBOX_KEY, processing, batch_size)
+        if not items:
+            redis.zrem(LEASES_KEY, token)
+            redis.delete(SCHEDULED_KEY)
+            # 清除标记前可能又有邮件入队, 此时由本任务继续发送
+            if redis.llen(OUTBOX_KEY) and redis.set(SCHEDULED_KEY, 1, nx=True, ex=timeout):
+                continue
+            return sent
+        payloads = [json.loads(item) for item in items]
+        transport = make_transport(current_app)
+        try:
+            retry, dead = deliver(payloads, transport, current_app.config['MAIL_MAX_RETRIES'])
+        finally:
+            transport.close()
+        sent += len(payloads) - len(retry) - len(dead)
+        pipe = redis.pipeline()
+        if dead:
+            pipe.rpush(DEAD_LETTER_KEY, *[json.dumps(data) for data in dead])
+        if retry:
+            pipe.rpush(OUTBOX_KEY, *[json.dumps(data) for data in retry])
+        pipe.delete(processing)
+        pipe.execute()
+        if retry:
+            time.sleep(current_app.config['MAIL_RETRY_DELAY'])
+
+
+def requeue_dead_letters() -> int:
+    """把死信列表中的邮件和失效发送任务中的邮件重新放入待发送列表, 返回邮件数"""
+    redis = current_app.redis
+    count = recover_outbox()
+    while True:
+        item = redis.lpop(DEAD_LETTER_KEY)
+        if item is None:
+            break
+        data = json.loads(item)
+        data['attempts'] = 0
+        redis.rpush(OUTBOX_KEY, json.dumps(data))
+        count += 1
+    if count:
+        schedule_drain()
+    return count
+
+
+def send_email(subject, recipients:list, sender:str, text_body:str, html_body:str, attachments=None, sync=False):
+    """发送邮件: MAIL_USE_QUEUE 为真时交给 RQ 任务发送, 否则放入进程内的后台发送队列"""
+    msg = build_email(subject, recipients, sender, text_body, html_body)
 
     if sync:
         mail.send(msg)
     else:
-        Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start().start()
+        dispatch_email(msg)
+
+
+def dispatch_email(msg):
+    """异步发送一封已构建的邮件, 由 MAIL_USE_QUEUE 决定交给 RQ 任务还是进程内的发送队列"""
+    if current_app.config['MAIL_USE_QUEUE']:
+        queue_email(msg)
+    else:
+        email_dispatcher.submit(msg)
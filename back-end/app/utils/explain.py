@@ -0,0 +1,82 @@
+"""
+File:explain.py
+Author:laoyang
+"""
+from sqlalchemy import and_, or_
+
+
+def query_shapes():
+    """热点查询的形状, 参数取任意 id 即可, 只看执行计划"""
+    from app.extensions import db
+    from app.models import followers, blacklist, posts_likes, comments_likes, Post, Comment, Message, \
+        Notification, Conversation, Timeline
+
+    return [
+        ('is_following', db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == 1, followers.c.followed_id == 2)),
+        ('followers_of', db.session.query(followers.c.follower_id).filter(followers.c.followed_id == 1)),
+        ('is_blocking', db.session.query(blacklist.c.block_id).filter(
+            blacklist.c.user_id == 1, blacklist.c.block_id == 2)),
+        ('blocked_by', db.session.query(blacklist.c.user_id).filter(blacklist.c.block_id == 1)),
+        ('post_is_liked_by', db.session.query(posts_likes.c.post_id).filter(
+            posts_likes.c.user_id == 1, posts_likes.c.post_id == 2)),
+        ('post_likers', db.session.query(posts_likes.c.user_id).filter(posts_likes.c.post_id == 1)),
+        ('comment_is_liked_by', db.session.query(comments_likes.c.comments_id).filter(
+            comments_likes.c.user_id == 1, comments_likes.c.comments_id == 2)),
+        ('comment_likers', db.session.query(comments_likes.c.user_id).filter(comments_likes.c.comments_id == 1)),
+        ('user_posts', Post.query.filter(Post.author_id == 1)),
+        ('post_comments', Comment.query.filter(Comment.post_id == 1, Comment.parent_id.is_(None))),
+        ('comment_children', Comment.query.filter(Comment.parent_id == 1)),
+        ('user_comments', Comment.query.filter(Comment.author_id == 1)),
+        ('user_notifications', Notification.query.filter(Notification.user_id == 1)),
+        ('history_messages', Message.query.filter(or_(
+            and_(Message.sender_id == 1, Message.recipient_id == 2),
+            and_(Message.sender_id == 2, Message.recipient_id == 1)))),
+        ('conversations', Conversation.query.filter(Conversation.user_id == 1)),
+        ('timeline', Timeline.query.filter(Timeline.user_id == 1)),
+    ]
+
+
+def explain(query):
+    """返回查询的执行计划, 每个步骤一行文本"""
+    from app.extensions import db
+    dialect = db.engine.dialect
+    compiled = query.statement.compile(dialect=dialect)
+    conn = db.session.connection()
+    if dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+        if dialect.name == 'postgresql':
+            # 小表上 PostgreSQL 总会选择顺序扫描, 关掉后才能看出有没有可用的索引
+            conn.execute('SET LOCAL enable_seqscan = off')
+    if compiled.positional:
+        params = [compiled.params[name] for name in compiled.positiontup]
+        result = conn.execute(prefix + str(compiled), *params)
+    else:
+        result = conn.execute(prefix + str(compiled), compiled.params)
+    keys = list(result.keys())
+    return [' '.join(str(row[key]) for key in keys if row[key] is not None)
+            if dialect.name == 'mysql' else str(row[-1]) for row in result]
+
+
+def is_full_scan(dialect_name, line) -> bool:
+    """判断执行计划中的一行是否为全表扫描"""
+    if dialect_name == 'sqlite':
+        # SCAN TABLE x / SCAN x 是全表扫描, SCAN x USING (COVERING) INDEX 是走索引
+        return line.startswith('SCAN') and 'USING' not in line
+    if dialect_name == 'mysql':
+        return ' ALL ' in ' %s ' % line
+    return 'Seq Scan' in line
+
+
+def audit():
+    """对所有热点查询执行 EXPLAIN, 返回 [(名称, 执行计划, 是否有全表扫描)]"""
+    from app.extensions import db
+    dialect_name = db.engine.dialect.name
+    report = []
+    for name, query in query_shapes():
+        plan = explain(query)
+        report.append((name, plan, any(is_full_scan(dialect_name, line) for line in plan)))
+    db.session.rollback()
+    return report
@@ -0,0 +1,61 @@
+"""
+File:json_provider.py
+Author:laoyang
+"""
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from uuid import UUID
+
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    """标准库编码器, 时间统一输出为 ISO 8601 格式, 不带时区的时间视为 UTC, 以 Z 结尾"""
+
+    def default(self, o):
+        if isinstance(o, datetime):
+            if o.tzinfo is None or o.utcoffset() == timedelta(0):
+                return o.replace(tzinfo=None).isoformat() + 'Z'
+            return o.isoformat()
+        if isinstance(o, date):
+            return o.isoformat()
+        if isinstance(o, Decimal):
+            return float(o)
+        if isinstance(o, UUID):
+            return str(o)
+        return super(JSONEncoder, self).default(o)
+
+
+class OrjsonEncoder(JSONEncoder):
+    """用 orjson 编码, 输出与标准库编码器一致; orjson 不支持的值交给 default, 仍然失败时退回标准库"""
+
+    def encode(self, o):
+        option = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(o, default=self.default, option=option).decode('utf-8')
+        except orjson.JSONEncodeError:
+            return super(OrjsonEncoder, self).encode(o)
+
+
+PROVIDERS = {
+    'stdlib': JSONEncoder,
+    'orjson': OrjsonEncoder,
+}
+
+
+def get_json_encoder(name='auto'):
+    """按名称返回 JSON 编码器, auto 表示安装了 orjson 时使用 orjson"""
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+    if name == 'orjson' and orjson is None:
+        raise RuntimeError('JSON_PROVIDER is orjson but orjson is not installed.')
+    return PROVIDERS[name]
@@ -0,0 +1,37 @@
+"""
+File:pagination.py
+Author:laoyang
+"""
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+# 游标: 当前页边界记录的 (时间戳, id), backwards 表示向前(上一页)翻页
+Cursor = namedtuple('Cursor', ['timestamp', 'id', 'backwards'])
+
+
+def encode_cursor(timestamp, id, backwards=False) -> str:
+    """把 (时间戳, id) 编码为不透明的游标字符串"""
+    raw = json.dumps([timestamp.isoformat(), id, 'p' if backwards else 'n'])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(token: str) -> Cursor:
+    """解析游标字符串, 格式错误时抛出 ValueError"""
+    try:
+        padding = '=' * (-len(token) % 4)
+        timestamp, id, direction = json.loads(base64.urlsafe_b64decode(token + padding).decode('utf-8'))
+        return Cursor(datetime.fromisoformat(timestamp), int(id), direction == 'p')
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+
+
+def seek_clause(column, id_column, cursor: Cursor):
+    """构造定位条件: 结果按 (column, id) 倒序, 向后翻页取更旧的记录, 向前翻页取更新的记录"""
+    if cursor.backwards:
+        return or_(column > cursor.timestamp, and_(column == cursor.timestamp, id_column > cursor.id))
+    return or_(column < cursor.timestamp, and_(column == cursor.timestamp, id_column < cursor.id))
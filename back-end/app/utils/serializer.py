@@ -0,0 +1,26 @@
+"""
+File:serializer.py
+Author:laoyang
+"""
+from sqlalchemy.orm import selectinload
+
+
+def eager_options(model):
+    """根据模型声明的 __serialize_relations__ 生成预加载选项
+
+    __serialize_relations__ 列出 to_dict 会访问的关联, 如 ('author', 'post.author'),
+    每个关联对整页数据只发出一条 IN 查询, 序列化时直接从 identity map 中读取, 不再逐行懒加载"""
+    options = []
+    for path in getattr(model, '__serialize_relations__', ()):
+        loader, entity = None, model
+        for name in path.split('.'):
+            attr = getattr(entity, name)
+            loader = selectinload(attr) if loader is None else loader.selectinload(attr)
+            entity = attr.property.mapper.class_
+        options.append(loader)
+    return options
+
+
+def serialize_collection(model, query):
+    """执行查询并批量序列化, 查询次数与结果条数无关"""
+    return [item.to_dict() for item in query.options(*eager_options(model)).all()]
@@ -0,0 +1,117 @@
+"""
+File:stream.py
+Author:laoyang
+"""
+import json
+import queue
+import threading
+from time import time
+
+from redis.exceptions import RedisError
+from sqlalchemy import event
+
+
+class RedisSubscription(object):
+    """订阅一个 Redis 频道"""
+
+    def __init__(self, redis, channel):
+        self.pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def get(self, timeout):
+        """等待下一条通知, 超时返回 None"""
+        deadline = time() + timeout
+        while True:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return None
+            message = self.pubsub.get_message(timeout=remaining)
+            if message is not None and message['type'] == 'message':
+                return json.loads(message['data'])
+
+    def close(self):
+        self.pubsub.close()
+
+
+class MemorySubscription(object):
+    """进程内的订阅, 用于测试和单进程部署"""
+
+    def __init__(self, stream, channel):
+        self.stream = stream
+        self.channel = channel
+        self.queue = queue.Queue()
+        with stream._lock:
+            stream._subscribers.setdefault(channel, set()).add(self.queue)
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.stream._lock:
+            subscribers = self.stream._subscribers.get(self.channel, set())
+            subscribers.discard(self.queue)
+            if not subscribers:
+                self.stream._subscribers.pop(self.channel, None)
+
+
+class NotificationStream(object):
+    """用户通知的推送通道
+
+    add_notification 写入的通知在事务提交后发布到用户的频道, SSE 和长轮询接口订阅该频道,
+    有新通知时立即返回, 没有变化时不查询数据库. NOTIFICATION_STREAM_BACKEND 为 redis 时使用
+    app.redis 的发布订阅, 多个进程之间共享; 为 memory 时只在当前进程内推送"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app.extensions import db
+
+        if self.app is None:
+            event.listen(db.session, 'after_commit', self._after_commit)
+            event.listen(db.session, 'after_rollback', self._after_rollback)
+        self.app = app
+        app.extensions['notification_stream'] = self
+
+    @staticmethod
+    def channel(user_id):
+        return 'madblog:notifications:{}'.format(user_id)
+
+    def queue(self, session, user_id, event_data):
+        """记录一条待发布的通知, 事务提交后才发布"""
+        session.info.setdefault('pending_notifications', []).append((user_id, event_data))
+
+    def publish(self, user_id, event_data):
+        """立即发布一条通知"""
+        channel = self.channel(user_id)
+        if self.app.config['NOTIFICATION_STREAM_BACKEND'] == 'redis':
+            try:
+                self.app.redis.publish(channel, json.dumps(event_data))
+            except RedisError:
+                # 推送失败不影响业务, 客户端仍然可以按 since 轮询拿到
+                self.app.logger.exception('[通知]发布失败')
+            return
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscriber in subscribers:
+            subscriber.put(event_data)
+
+    def subscribe(self, user_id):
+        """订阅用户的通知, 用完需要调用 close()"""
+        if self.app.config['NOTIFICATION_STREAM_BACKEND'] == 'redis':
+            return RedisSubscription(self.app.redis, self.channel(user_id))
+        return MemorySubscription(self, self.channel(user_id))
+
+    def _after_commit(self, session):
+        for user_id, event_data in session.info.pop('pending_notifications', ()):
+            self.publish(user_id, event_data)
+
+    def _after_rollback(self, session):
+        session.info.pop('pending_notifications', None)
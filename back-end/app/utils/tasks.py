@@ -5,8 +5,10 @@ from rq import get_current_job
 
 from app import create_app
 from app import db
-from app.models import User, Message, Task
-from app.utils.email import send_email
+from app.models import User, Message, Task, TaskChunk, UnreadCounter, Conversation
+from app.utils.broadcast import broadcast, run_chunk
+from app.utils.counters import reconcile_counters
+from app.utils.email import drain_outbox
 from config import Config
 
 # RQ worker 在我们的博客Flask应用之外运行，所以需要创建自己的应用实例
@@ -35,71 +37,78 @@ def _set_task_progress(progress):
                                                      'progress': progress})
 
         if progress >= 100:  # 进度为100%时，更新Task对象为已完成
-            task.complete = True
+            task.complate = True
         db.session.commit()
 
 
+def _notify_sender(sender, body):
+    """群发结束后，由管理员再给发送方发送一条已完成的提示私信"""
+    admin = User.query.filter_by(email=app.config['ADMINS'][0]).first()
+    message = Message()
+    message.body = '[群发私信]已完成, 内容: \n\n' + body
+    message.sender = admin
+    message.recipient = sender
+    db.session.add(message)
+    db.session.flush()
+    # 同步更新会话汇总, 提示私信才会出现在发送方的收件箱中
+    if admin is not None:
+        Conversation.incr(admin.id, [sender.id])
+    # 给发送方发送新私信通知
+    UnreadCounter.incr(sender.id, 'unread_messages_count')
+    sender.add_notification('unread_messages_count', sender.new_recived_messages())
+    db.session.commit()
+
+
 def send_messages(*args, **kwargs):
     """群发私信"""
     try:
         # 发送者
         _set_task_progress(0)
-        i = 0
         sender = User.query.get(kwargs.get('user_id'))
-        recipients = User.query.filter(User.id != sender.id)
-        total_recipients = recipients.count()
-
-        for user in recipients:
-            message = Message()
-            message.body = kwargs.get('body')
-            message.sender = sender
-            message.recipient = user
-            db.session.add(message)
-            user.add_notification('unread_message_count', user.new_recived_messages())
-            db.session.commit()
-
-            # 给接收者发送一封邮件
-            text_body = '''
-                        Dear {},
-                        {}
-                        Sincerely,
-                        The Madblog Team
-                        Note: replies to this email address are not monitored.
-                        '''.format(user.username, message.body)
-
-            html_body = '''
-                        <p>Dear {0},</p>
-                        <p>{1}</p>
-                        <p>Sincerely,</p>
-                        <p>The Madblog Team</p>
-                        <p><small>Note: replies to this email address are not monitored.</small></p>
-                        '''.format(user.username, message.body)
-            # 后台任务已经是异步了，所以send_email()没必要再用多线程异步，所以这里指定了 sync=True
-            send_email('[Madblog] 温馨提醒',
-                       sender=app.config['MAIL_SENDER'],
-                       recipients=[user.email],
-                       text_body=text_body,
-                       html_body=html_body,
-                       sync=True)
-
-            time.sleep(1)
-            i += 1
-            _set_task_progress(100 * i // total_recipients)
+        # 分批发送, 每批结束后更新一次进度
+        broadcast(sender.id, kwargs.get('body'),
+                  progress=lambda sent, total, last_id: _set_task_progress(100 * sent // total if total else 100))
 
         job = get_current_job()
         task = Task.query.get(job.get_id())
         task.complate = True
         db.session.commit()
 
-        # 群发结束后，由管理员再给发送方发送一条已完成的提示私信
-        message = Message()
-        message.body = '[群发私信]已完成, 内容: \n\n' + kwargs.get('body')
-        message.sender = User.query.filter_by(email=app.config['ADMINS'][0]).first()
-        message.recipient = sender
-        db.session.add(message)
-        # 给发送方发送新私信通知
-        sender.add_notification('unread_messages_count', sender.new_recived_messages())
-        db.session.commit()
+        _notify_sender(sender, kwargs.get('body'))
 
     except Exception as e:
         app.logger.error('[群发私信]后台任务出错了', exc_info=sys.exc_info())
+
+
+def send_messages_chunk(chunk_id, sender_id, body):
+    """群发私信的一个子任务, 只发送给一个id范围内的用户; 出错时抛出异常, rq 将其记为失败, 可单独重试"""
+    try:
+        run_chunk(TaskChunk.query.get(chunk_id), sender_id, body)
+    except Exception:
+        app.logger.error('[群发私信]子任务出错了', exc_info=sys.exc_info())
+        raise
+
+
+def finish_broadcast(task_id, sender_id, body):
+    """所有子任务完成后执行, 标记任务完成并通知发送方"""
+    task = Task.query.get(task_id)
+    task.complate = True
+    task.user.add_notification('task_progress', {'task_id': task_id,
+                                                 'description': task.description,
+                                                 'progress': 100})
+    db.session.commit()
+    _notify_sender(User.query.get(sender_id), body)
+
+
+def send_queued_emails():
+    """发送 Redis 待发送列表中的邮件"""
+    sent = drain_outbox()
+    app.logger.info('[邮件]发送了 %d 封邮件', sent)
+    return sent
+
+
+def repair_counters(batch_size=1000):
+    """修正文章、评论和用户的冗余计数"""
+    repaired = reconcile_counters(batch_size)
+    app.logger.info('[计数]修正了 %d 行', repaired)
+    return repaired
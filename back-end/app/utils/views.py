@@ -0,0 +1,83 @@
+"""
+File:views.py
+Author:laoyang
+"""
+import atexit
+import threading
+import time
+from collections import Counter
+
+
+class ViewCounter(object):
+    """文章阅读数的写回缓冲
+
+    读取文章时只在进程内存中计数, 由后台线程每隔 VIEW_FLUSH_INTERVAL 秒把累计值批量写入 posts.views,
+    增量相同的文章合并成一条 UPDATE; 进程退出时再写一次. VIEW_FLUSH_INTERVAL 为 0 时不启动后台线程"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self.flush)
+        self.app = app
+        app.extensions['view_counter'] = self
+
+    def incr(self, post_id, n=1):
+        """文章阅读数加 n, 不访问数据库"""
+        with self._lock:
+            self._pending[post_id] += n
+        self._start_flusher()
+
+    def pending(self, post_id=None) -> int:
+        """尚未写入数据库的阅读数, 不指定文章时返回总数"""
+        with self._lock:
+            if post_id is not None:
+                return self._pending.get(post_id, 0)
+            return sum(self._pending.values())
+
+    def flush(self) -> int:
+        """把缓冲的阅读数写入数据库, 返回写入的阅读数"""
+        from app.extensions import db
+        from app.models import Post
+
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending or self.app is None:
+            return 0
+        # 增量相同的文章用一条 UPDATE ... WHERE id IN (...) 更新
+        batches = {}
+        for post_id, n in pending.items():
+            batches.setdefault(n, []).append(post_id)
+        try:
+            # 不推送应用上下文, 以免在请求线程中调用时清理掉当前的数据库会话
+            with db.get_engine(self.app).begin() as connection:
+                for n, ids in batches.items():
+                    connection.execute(Post.__table__.update().where(Post.id.in_(ids)).values(
+                        views=db.func.coalesce(Post.views, 0) + n))
+        except Exception:
+            # 写入失败时放回缓冲, 下次再写
+            with self._lock:
+                self._pending.update(pending)
+            self.app.logger.exception('[阅读数]写入数据库失败')
+            return 0
+        return sum(pending.values())
+
+    def _start_flusher(self):
+        interval = self.app.config.get('VIEW_FLUSH_INTERVAL', 0) if self.app is not None else 0
+        if not interval or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+                self._thread.start()
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            self.flush()
@@ -23,8 +23,44 @@ class Config(object):
     MAIL_USERNAME = '491127805@qq.com'
     MAIL_PASSWORD = 'kzsqoxmjnosjbibe'
     MAIL_SENDER = 'laoyang<491127805@qq.com>'
+    ADMINS = ['491127805@qq.com']
+    MAIL_USE_QUEUE = True  # 邮件交给 RQ 任务发送, 请求中只入队
+    MAIL_BATCH_SIZE = 50  # RQ 任务每个 SMTP 会话发送的邮件数
+    MAIL_MAX_RETRIES = 3  # 发送失败的最大重试次数, 超过后移入死信列表
+    MAIL_RETRY_DELAY = 10  # 重试前等待的秒数
+    MAIL_JOB_TIMEOUT = 300  # 发送任务的排队标记和处理列表的租约秒数, 任务失效后最多等待这么久即可恢复
+    MAIL_TRANSPORT = os.environ.get('MAIL_TRANSPORT') or 'smtp'  # smtp, file 或 console
+    MAIL_FILE_PATH = os.path.join(basedir, 'mail.log')  # file 方式写入的文件
+    MAIL_WORKERS = 2  # 发送邮件的线程数, 每个线程一个持久连接
+    MAIL_QUEUE_SIZE = 1000  # 待发送邮件队列的长度
+    MAIL_QUEUE_TIMEOUT = 5  # 队列满时最多等待的秒数, 超时后同步发送
+    MAIL_IDLE_TIMEOUT = 30  # 连接空闲多少秒后关闭
 
     POSTS_PER_PAGE = 10
     USERS_PER_PAGE = 10
     COMMENTS_PER_PAGE = 10
-    MESSAGES_PER_PAGE = 10
\ No newline at end of file
+    MESSAGES_PER_PAGE = 10
+    TASKS_PER_PAGE = 10
+    COUNT_CACHE_TTL = 60  # 分页总数缓存的有效期(秒)
+    COUNT_CACHE_BACKEND = 'redis'  # 分页总数缓存的表版本号: redis(多进程共享) 或 memory(仅当前进程)
+    VIEW_FLUSH_INTERVAL = 10  # 文章阅读数写入数据库的间隔(秒)
+    USER_CACHE_TTL = 60  # token 认证时用户缓存的有效期(秒)
+    OBJECT_CACHE_BACKEND = 'redis'  # 用户缓存的失效通知: redis(多进程共享版本号) 或 memory(仅清除当前进程)
+    LAST_SEEN_INTERVAL = 60  # 同一用户更新最后访问时间的最短间隔(秒)
+    BROADCAST_CHUNK_SIZE = 500  # 群发私信每批的人数
+    BROADCAST_RATE = 50  # 群发私信每秒最多发送的人数, 0 表示不限速
+    BROADCAST_JOB_SIZE = 10000  # 群发私信每个子任务负责的人数, 子任务由多个 worker 并行执行, 0 表示不拆分
+    TIMELINE_FANOUT_LIMIT = 5000  # 粉丝数超过该值的作者发布文章时不写入粉丝时间线, 读取时合并
+    NOTIFICATION_STREAM_BACKEND = 'redis'  # 通知推送通道: redis 或 memory(仅当前进程)
+    NOTIFICATION_STREAM_TIMEOUT = 300  # SSE 连接保持的最长秒数, 之后由客户端重连
+    NOTIFICATION_POLL_TIMEOUT = 25  # 长轮询最多等待的秒数
+    NOTIFICATION_HEARTBEAT = 15  # SSE 心跳间隔(秒)
+    ADJACENCY_CACHE_BACKEND = 'redis'  # 关注/拉黑/点赞关系缓存: redis, memory(仅当前进程) 或 None(不缓存)
+    ADJACENCY_CACHE_TTL = 3600  # 关系集合的有效期(秒)
+    RESPONSE_CACHE_BACKEND = 'redis'  # 公开接口的响应缓存: redis, memory(仅当前进程) 或 None(不缓存)
+    RESPONSE_CACHE_TTL = 300  # 缓存的响应保留的秒数
+    RESPONSE_CACHE_SIZE = 1024  # memory 方式最多缓存的响应数
+    JSON_PROVIDER = 'auto'  # 接口响应的 JSON 编码器: orjson, stdlib 或 auto(安装了 orjson 时使用 orjson)
+    JSON_AS_ASCII = False  # 中文不转义, 两种编码器输出一致
+    JSONIFY_PRETTYPRINT_REGULAR = False  # 不缩进, 调试模式下 Flask 仍会缩进
+    TOKEN_PERMISSION_CLAIMS = True  # 权限校验读取 token 中的权限位掩码
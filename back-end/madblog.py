@@ -12,7 +12,8 @@ from app import create_app
 from flask_script import Manager
 from flask_migrate import MigrateCommand
 from app.extensions import db
-from app.models import User, Role, Notification, Message, Post, Comment, Permission
+from app.models import User, Role, Notification, Message, Post, Comment, Permission, UnreadCounter, Timeline, \
+    Conversation
 
 app = create_app()
 
@@ -20,11 +21,238 @@ app = create_app()
 @app.shell_context_processor
 def make_shell_context():
     return {'db': db, 'Role': Role, 'User': User, 'Post': Post, 'Comment': Comment,
-            'Notification': Notification, 'Message': Message, 'Permission': Permission}
+            'Notification': Notification, 'Message': Message, 'Permission': Permission,
+            'UnreadCounter': UnreadCounter, 'Timeline': Timeline,
+            'Conversation': Conversation}
 
 
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def rebuild_counters():
+    """根据源数据重新计算所有用户的未读计数"""
+    rows = UnreadCounter.rebuild()
+    db.session.commit()
+    print('Rebuilt {} unread counters.'.format(rows))
+
+
+@manager.command
+def rebuild_conversations():
+    """根据私信表重新生成会话汇总"""
+    rows = Conversation.rebuild()
+    db.session.commit()
+    print('Rebuilt {} conversations.'.format(rows))
+
+
+@manager.command
+def rebuild_timelines():
+    """根据关注关系重新生成首页时间线"""
+    rows = Timeline.rebuild()
+    db.session.commit()
+    print('Rebuilt {} timeline entries.'.format(rows))
+
+
+@manager.command
+def reconcile_counters(batch_size=1000, queue=False):
+    """按关联表修正文章、评论和用户的冗余计数, 指定 --queue 时交给 RQ worker 执行"""
+    if queue:
+        job = app.task_queue.enqueue('app.utils.tasks.repair_counters', int(batch_size))
+        print('Queued job {}.'.format(job.get_id()))
+        return
+    from app.utils.counters import reconcile_counters as reconcile
+    rows = reconcile(int(batch_size))
+    print('Repaired {} counters.'.format(rows))
+
+
+@manager.command
+def explain_queries():
+    """对热点查询执行 EXPLAIN, 出现全表扫描时以非零状态退出"""
+    from app.utils.explain import audit
+    report = audit()
+    for name, plan, full_scan in report:
+        print('{:<22}{}'.format(name, 'FULL SCAN' if full_scan else 'ok'))
+        for line in plan:
+            print('    ' + line)
+    scans = [name for name, plan, full_scan in report if full_scan]
+    if scans:
+        print('Full scans: {}'.format(', '.join(scans)))
+        sys.exit(1)
+
+
+@manager.command
+def bench_email(count=1000, transport='file'):
+    """测量后台发送邮件的吞吐量, 默认写入 MAIL_FILE_PATH, 不连接真实的邮件服务器"""
+    import time
+    from app.utils.email import build_email, email_dispatcher
+
+    app.config['MAIL_TRANSPORT'] = transport
+    count = int(count)
+    with app.app_context():
+        started = time.time()
+        for i in range(count):
+            email_dispatcher.submit(build_email('[Madblog] bench %d' % i, recipients=['bench%d@example.com' % i],
+                                                sender=app.config['MAIL_SENDER'],
+                                                text_body='bench', html_body='<p>bench</p>'))
+        email_dispatcher.flush()
+        elapsed = time.time() - started
+    print('Sent {} emails in {:.2f}s ({:.0f}/s).'.format(count, elapsed, count / elapsed if elapsed else 0))
+
+
+@manager.command
+def retry_dead_emails():
+    """把发送失败的邮件重新放入发送队列"""
+    from app.utils.email import requeue_dead_letters
+
+    with app.app_context():
+        count = requeue_dead_letters()
+    print('Requeued {} emails.'.format(count))
+
+
+@manager.command
+def bench_notifications(clients=10, seconds=5, interval=0.5):
+    """对比按 since 定时轮询和长轮询两种方式获取通知时客户端请求产生的数据库查询次数"""
+    import json
+    import tempfile
+    import threading
+    import time
+    from sqlalchemy import event
+    from config import Config
+
+    clients, seconds, interval = int(clients), float(seconds), float(interval)
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        NOTIFICATION_STREAM_BACKEND = 'memory'
+        MAIL_USE_QUEUE = False
+        VIEW_FLUSH_INTERVAL = 0
+
+    bench_app = create_app(BenchConfig)
+    with bench_app.app_context():
+        db.create_all()
+        users = [User(username='bench%d' % i, email='bench%d@example.com' % i) for i in range(clients)]
+        db.session.add_all(users)
+        db.session.commit()
+        accounts = [(u.id, u.get_token(expires_in=3600)) for u in users]
+        engine = db.engine
+
+    local = threading.local()
+    counter = {'queries': 0}
+    lock = threading.Lock()
+
+    def count_query(*args):
+        # 只统计客户端请求产生的查询
+        if getattr(local, 'client', False):
+            with lock:
+                counter['queries'] += 1
+
+    event.listen(engine, 'before_cursor_execute', count_query)
+
+    def run(mode):
+        counter['queries'] = 0
+        received = []
+        start = time.time()
+        stop = start + seconds
+
+        def client(user_id, token):
+            local.client = True
+            test_client = bench_app.test_client()
+            headers = {'Authorization': 'Bearer ' + token}
+            since = start
+            while time.time() < stop:
+                if mode == 'poll':
+                    response = test_client.get('/api/users/%d/notifications/?since=%r' % (user_id, since),
+                                               headers=headers)
+                else:
+                    timeout = max(0.1, stop - time.time())
+                    response = test_client.get('/api/users/%d/notifications/poll?since=%r&timeout=%s' % (
+                        user_id, since, timeout), headers=headers)
+                events = json.loads(response.get_data(as_text=True))
+                if events:
+                    since = events[-1]['timestamp']
+                    with lock:
+                        received.extend(events)
+                if mode == 'poll':
+                    time.sleep(interval)
+
+        threads = [threading.Thread(target=client, args=account) for account in accounts]
+        for thread in threads:
+            thread.start()
+        # 每隔 interval 秒给一个用户写一条通知
+        n = 0
+        with bench_app.app_context():
+            while time.time() < stop:
+                user_id = accounts[n % clients][0]
+                User.query.get(user_id).add_notification('bench', n)
+                db.session.commit()
+                n += 1
+                time.sleep(interval)
+        for thread in threads:
+            thread.join()
+        print('{:>9}: {} queries, {} notifications written, {} received'.format(
+            mode, counter['queries'], n, len(received)))
+
+    try:
+        run('poll')
+        run('long-poll')
+    finally:
+        os.remove(path)
+
+
+
+@manager.command
+def bench_json(per_page=100, rounds=200):
+    """测量一页评论(默认 100 条)的 to_collection_dict 和各 JSON 编码器的耗时"""
+    import tempfile
+    import time
+    from flask import json
+    from config import Config
+    from app.utils.json_provider import PROVIDERS, orjson
+
+    per_page, rounds = int(per_page), int(rounds)
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        RESPONSE_CACHE_BACKEND = None
+        ADJACENCY_CACHE_BACKEND = None
+
+    bench_app = create_app(BenchConfig)
+    try:
+        with bench_app.app_context():
+            db.create_all()
+            user = User(username='bench', email='bench@example.com', name='测试用户')
+            post = Post(title='bench', body='body', author=user)
+            db.session.add_all([user, post])
+            db.session.add_all([Comment(body='评论 %d ' % i * 10, post=post, author=user) for i in range(per_page)])
+            db.session.commit()
+
+            with bench_app.test_request_context('/api/comments/?per_page=%d' % per_page):
+                query = Comment.query.order_by(Comment.timestamp.desc())
+                started = time.time()
+                for _ in range(rounds):
+                    data = Comment.to_collection_dict(query, 1, per_page, 'api.get_comments')
+                    db.session.expunge_all()
+                elapsed = time.time() - started
+                print('{:>18}: {:.3f} ms/page'.format('to_collection_dict', elapsed * 1000 / rounds))
+
+                for name, encoder in PROVIDERS.items():
+                    if name == 'orjson' and orjson is None:
+                        print('{:>18}: not installed'.format(name))
+                        continue
+                    started = time.time()
+                    for _ in range(rounds):
+                        body = json.dumps(data, cls=encoder, separators=(',', ':'))
+                    elapsed = time.time() - started
+                    print('{:>18}: {:.3f} ms/page, {} bytes'.format(name, elapsed * 1000 / rounds,
+                                                                   len(body.encode('utf-8'))))
+    finally:
+        os.remove(path)
+
+
 if __name__ == '__main__':
     manager.run()
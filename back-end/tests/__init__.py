@@ -2,8 +2,55 @@
 File:tests/__init__.py,
 Author:laoyang
 """
+from contextlib import contextmanager
+
 from config import Config
 
+PASSWORD = 'asdf456'
+
+
 class TestConfig(Config):
     TESTING = True
-    SQLALCHEMY_DATABASE_URI = 'sqlite://'
\ No newline at end of file
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    VIEW_FLUSH_INTERVAL = 0  # 测试中手动写入阅读数
+    MAIL_USE_QUEUE = False  # 测试环境没有 Redis, 邮件在进程内发送
+    NOTIFICATION_STREAM_BACKEND = 'memory'
+    ADJACENCY_CACHE_BACKEND = 'memory'
+    RESPONSE_CACHE_BACKEND = 'memory'
+    COUNT_CACHE_BACKEND = 'memory'
+    OBJECT_CACHE_BACKEND = 'memory'
+
+
+def add_users(prefix, count, role='reader'):
+    """创建 prefix0, prefix1... 共 count 个用户, 密码都是 PASSWORD; role 为角色的 slug, None 表示不分配角色"""
+    from app.extensions import db
+    from app.models import User, Role
+
+    if role is not None:
+        if Role.query.count() == 0:
+            Role.insert_roles()
+        role = Role.query.filter_by(slug=role).first()
+    users = [User(username='%s%d' % (prefix, i), email='%s%d@163.com' % (prefix, i), role=role)
+             for i in range(count)]
+    for u in users:
+        u.password = PASSWORD
+    db.session.add_all(users)
+    db.session.commit()
+    return users
+
+
+@contextmanager
+def count_queries():
+    """收集上下文中执行的 SQL 语句"""
+    from app.extensions import db
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
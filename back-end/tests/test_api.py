@@ -3,12 +3,18 @@ File:test_api.py
 Author:Young
 """
 import json
+import threading
+import time
 from base64 import b64encode
-from app.models import User
-from . import TestConfig
+from datetime import datetime, timedelta
+
+from flask import g
+
+from app.models import User, Post, Comment, Message, Role, Permission, UnreadCounter, Notification
+from . import TestConfig, PASSWORD, add_users, count_queries
 import unittest,re
 from app import create_app
-from app.extensions import db
+from app.extensions import db, view_counter, notification_stream
 
 
 class ApiTestCase(unittest.TestCase):
@@ -58,6 +64,16 @@ class ApiTestCase(unittest.TestCase):
             'Accept': 'application/json',
         }
 
+    def login(self, user):
+        """用 add_users 创建的用户登录, 返回带 token 的 headers"""
+        return self.get_token_auth_headers(user.username, PASSWORD)
+
+    def post_json(self, url, headers, data, status=201) -> dict:
+        """POST 一个 JSON 请求, 检查状态码后返回解析后的响应"""
+        response = self.client.post(url, headers=headers, data=json.dumps(data))
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.get_data(as_text=True))
+
     def test_get_token(self):
         """测试用户登陆获取JWT"""
         # 创建用户
@@ -100,4 +116,482 @@ class ApiTestCase(unittest.TestCase):
     def test_anonymous(self):
         """测试不需要认证的接口"""
         response = self.client.get('/api/posts/')
-        self.assertEqual(response.status_code,200)
\ No newline at end of file
+        self.assertEqual(response.status_code,200)
+    def test_posts_cursor_pagination(self):
+        """测试文章列表的游标分页"""
+        u = User(username='laoyang666', email='laoyang666@163.com')
+        db.session.add(u)
+        now = datetime.utcnow()
+        for i in range(5):
+            db.session.add(Post(title='post %d' % i, author=u, timestamp=now + timedelta(minutes=i)))
+        db.session.commit()
+
+        response = self.client.get('/api/posts/?cursor=&per_page=2')
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual([item['title'] for item in json_response['items']], ['post 4', 'post 3'])
+        self.assertNotIn('total_items', json_response['_meta'])
+        self.assertIsNone(json_response['_links']['prev'])
+
+        response = self.client.get(json_response['_links']['next'])
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual([item['title'] for item in json_response['items']], ['post 2', 'post 1'])
+
+        response = self.client.get(json_response['_links']['prev'])
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual([item['title'] for item in json_response['items']], ['post 4', 'post 3'])
+        self.assertIsNone(json_response['_links']['prev'])
+
+        response = self.client.get('/api/posts/?cursor=&per_page=2&count=exact')
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(json_response['_meta']['total_items'], 5)
+
+        response = self.client.get('/api/posts/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+
+    def test_posts_count_modes(self):
+        """测试分页总数的缓存和 count 参数"""
+        u = User(username='laoyang777', email='laoyang777@163.com')
+        db.session.add(u)
+        for i in range(3):
+            db.session.add(Post(title='post %d' % i, author=u))
+        db.session.commit()
+
+        response = self.client.get('/api/posts/?per_page=2')
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(json_response['_meta']['total_items'], 3)
+        self.assertEqual(json_response['_meta']['total_pages'], 2)
+
+        # 新增文章后缓存失效
+        db.session.add(Post(title='post 3', author=u))
+        db.session.commit()
+        response = self.client.get('/api/posts/?per_page=2')
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(json_response['_meta']['total_items'], 4)
+
+        response = self.client.get('/api/posts/?per_page=2&count=none')
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertIsNone(json_response['_meta']['total_items'])
+        self.assertIsNotNone(json_response['_links']['next'])
+
+        response = self.client.get('/api/posts/?count=wrong')
+        self.assertEqual(response.status_code, 400)
+
+    def test_response_cache(self):
+        """测试公开接口的响应缓存和 ETag"""
+        from app.utils.cache import response_cache
+        u = User(username='laoyang888', email='laoyang888@163.com')
+        post = Post(title='post', body='body', author=u)
+        db.session.add_all([u, post])
+        db.session.commit()
+        url = '/api/posts/%d' % post.id
+
+        response = self.client.get(url)
+        etag = response.headers['ETag']
+        self.assertEqual(response_cache.stats['misses'], 1)
+        # 带有 If-None-Match 和命中缓存时都不访问数据库, 阅读数照常计数
+        with count_queries() as statements:
+            not_modified = self.client.get(url, headers={'If-None-Match': etag})
+            cached = self.client.get(url)
+        self.assertEqual(statements, [])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(cached.get_data(), response.get_data())
+        self.assertEqual((response_cache.stats['hits'], response_cache.stats['not_modified']), (1, 1))
+        self.assertEqual(view_counter.pending(post.id), 3)
+
+        # 修改文章后 ETag 变化
+        post.title = 'new title'
+        db.session.commit()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['title'], 'new title')
+        view_counter.flush()
+
+    def test_json_encoding(self):
+        """测试接口响应中时间和 Decimal 的编码"""
+        from decimal import Decimal
+        from flask import json as flask_json
+        from app.utils.json_provider import PROVIDERS, orjson
+        data = {'time': datetime(2020, 1, 2, 3, 4, 5), 'price': Decimal('1.5'), 'name': '老杨'}
+        expected = '{"name":"老杨","price":1.5,"time":"2020-01-02T03:04:05Z"}'
+        for name, encoder in PROVIDERS.items():
+            if name == 'orjson' and orjson is None:
+                continue
+            self.assertEqual(flask_json.dumps(data, cls=encoder, separators=(',', ':')), expected, name)
+
+        u = User(username='laoyang999', email='laoyang999@163.com', member_since=datetime(2020, 1, 1))
+        u.password = '123'
+        db.session.add(u)
+        db.session.commit()
+        response = self.client.get('/api/users/%d' % u.id, headers=self.get_token_auth_headers('laoyang999', '123'))
+        self.assertIn('"member_since":"2020-01-01T00:00:00Z"', response.get_data(as_text=True))
+
+    def test_collection_query_count(self):
+        """测试列表接口的查询次数不随每页条数增长"""
+        u1, u2 = add_users('laoyang', 2)
+        for i in range(6):
+            post = Post(title='post %d' % i, author=u1 if i % 2 else u2)
+            root = Comment(body='comment %d' % i, post=post, author=u2)
+            db.session.add_all([post, root, Comment(body='reply %d' % i, post=post, author=u1, parent=root)])
+            db.session.add(Message(body='message %d' % i, sender=u1, recipient=u2))
+            db.session.add(Message(body='message %d' % i, sender=u2, recipient=u1))
+        db.session.commit()
+        headers = self.login(u1)
+        # 第一次认证时把用户写入缓存
+        self.client.get('/api/messages/?count=none', headers=headers)
+
+        for url, auth in [('/api/posts/', None), ('/api/comments/', None), ('/api/messages/', headers)]:
+            counts = []
+            for per_page in (2, 10):
+                with count_queries() as statements:
+                    response = self.client.get(url + '?per_page=%d&count=none' % per_page, headers=auth)
+                self.assertEqual(response.status_code, 200)
+                counts.append(len(statements))
+            self.assertEqual(counts[0], counts[1], url)
+
+    def test_get_followers(self):
+        """测试粉丝列表带有关注时间和 is_following 标志"""
+        users = add_users('fan', 4)
+        for u in users[1:]:
+            u.follow(users[0])
+        users[0].follow(users[1])
+        db.session.commit()
+        headers = self.login(users[0])
+        self.client.get('/api/users/%d' % users[0].id, headers=headers)
+
+        counts = []
+        for per_page in (1, 3):
+            with count_queries() as statements:
+                response = self.client.get('/api/users/%d/followers?per_page=%d&count=exact' % (users[0].id, per_page),
+                                           headers=headers)
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(statements))
+        self.assertEqual(counts[0], counts[1])
+
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(len(json_response['items']), 3)
+        following = {item['username']: item['is_following'] for item in json_response['items']}
+        self.assertEqual(following, {'fan1': True, 'fan2': False, 'fan3': False})
+        self.assertTrue(all(item['timestamp'] for item in json_response['items']))
+
+        # 关注列表可以匿名访问, 此时没有 is_following 标志; 测试中请求共用应用上下文, 先清除上一个请求的用户
+        g.pop('current_user', None)
+        response = self.client.get('/api/users/%d/followeds' % users[1].id)
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual([item['username'] for item in json_response['items']], ['fan0'])
+        self.assertNotIn('is_following', json_response['items'][0])
+
+    def test_get_post_comments_thread(self):
+        """测试文章评论树的加载"""
+        u = User(username='laoyang000', email='laoyang000@163.com')
+        post = Post(title='post', author=u)
+        db.session.add_all([u, post])
+        roots = [Comment(body='root %d' % i, post=post, author=u) for i in range(2)]
+        db.session.add_all(roots)
+        db.session.commit()
+
+        def add_replies(count):
+            parent = roots[0]
+            for i in range(count):
+                parent = Comment(body='reply', post=post, author=u, parent=parent)
+                db.session.add(parent)
+            db.session.commit()
+
+        counts = []
+        for replies in (1, 4):
+            add_replies(replies)
+            with count_queries() as statements:
+                response = self.client.get('/api/posts/%d/comments/?count=exact&format=nested' % post.id)
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(statements))
+        self.assertEqual(counts[0], counts[1])
+
+        json_response = json.loads(response.get_data(as_text=True))
+        thread = [item for item in json_response['items'] if item['id'] == roots[0].id][0]
+        depth = 0
+        replies = thread['replies']
+        while replies:
+            depth += 1
+            self.assertEqual(len(replies), 1 if depth > 1 else 2)
+            replies = replies[-1]['replies']
+        self.assertEqual(depth, 4)
+
+        # 默认按时间平铺在 descendants 中
+        response = self.client.get('/api/posts/%d/comments/' % post.id)
+        json_response = json.loads(response.get_data(as_text=True))
+        thread = [item for item in json_response['items'] if item['id'] == roots[0].id][0]
+        self.assertNotIn('replies', thread)
+        self.assertEqual(len(thread['descendants']), 5)
+        response = self.client.get('/api/posts/%d/comments/?max_depth=2' % post.id)
+        json_response = json.loads(response.get_data(as_text=True))
+        thread = [item for item in json_response['items'] if item['id'] == roots[0].id][0]
+        self.assertEqual(sorted(c['depth'] for c in thread['descendants']), [1, 1, 2])
+
+    def test_reply_notifications(self):
+        """测试回复评论时通知文章作者和所有祖先评论的作者"""
+        users = add_users('reply', 3)
+        post = Post(title='post', author=users[0])
+        db.session.add(post)
+        db.session.commit()
+        ids = [u.id for u in users]
+        headers = [self.login(u) for u in users]
+
+        def reply(i, parent_id=None):
+            return self.post_json('/api/comments/', headers[i],
+                                  {'body': 'hi', 'post_id': post.id, 'parent_id': parent_id})['id']
+
+        def unread():
+            return [UnreadCounter.get(id, 'unread_recived_comments_count') for id in ids]
+
+        root = reply(1)
+        self.assertEqual(unread(), [1, 0, 0])
+        child = reply(0, root)
+        self.assertEqual(unread(), [1, 1, 0])
+        reply(2, child)
+        self.assertEqual(unread(), [2, 2, 0])
+
+        # 删除一级评论时连同回复一起从所有通知对象的未读计数中减掉
+        response = self.client.delete('/api/comments/%d' % root, headers=headers[0])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(unread(), [0, 0, 0])
+        payloads = {n.user_id: n.get_data() for n in Notification.query.filter_by(
+            name='unread_recived_comments_count')}
+        self.assertEqual(payloads, {ids[0]: 0, ids[1]: 0})
+
+    def test_delete_comment_notifications(self):
+        """测试删除被回复的评论后, 回复的通知对象的未读计数一起减少"""
+        users = add_users('thread', 3)
+        post = Post(title='post', author=users[0])
+        db.session.add(post)
+        db.session.commit()
+        ids = [u.id for u in users]
+        headers = [self.login(u) for u in users]
+        root = self.post_json('/api/comments/', headers[1], {'body': 'hi', 'post_id': post.id})['id']
+        self.post_json('/api/comments/', headers[2], {'body': 'hi', 'post_id': post.id, 'parent_id': root})
+        self.assertEqual([UnreadCounter.get(id, 'unread_recived_comments_count') for id in ids], [2, 1, 0])
+
+        response = self.client.delete('/api/comments/%d' % root, headers=headers[0])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual([UnreadCounter.get(id, 'unread_recived_comments_count') for id in ids], [0, 0, 0])
+
+    def test_comment_counters(self):
+        """测试通过接口发表和删除评论时更新文章的评论数"""
+        u, = add_users('counter', 1)
+        post = Post(title='post', author=u)
+        db.session.add(post)
+        db.session.commit()
+        headers = self.login(u)
+
+        def create(parent_id=None):
+            return self.post_json('/api/comments/', headers,
+                                  {'body': 'hi', 'post_id': post.id, 'parent_id': parent_id})['id']
+
+        def comments_count():
+            db.session.expire_all()
+            return Post.query.get(post.id).comments_count
+
+        root = create()
+        create(create(root))
+        other = create()
+        self.assertEqual(comments_count(), 4)
+        # 删除评论时连同所有回复一起减掉
+        response = self.client.delete('/api/comments/%d' % root, headers=headers)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(comments_count(), 1)
+        self.client.delete('/api/comments/%d' % other, headers=headers)
+        self.assertEqual(comments_count(), 0)
+
+    def test_delete_post_notifications(self):
+        """测试删除文章后粉丝的未读计数和通知一起更新"""
+        author, = add_users('writer', 1, role='author')
+        fans = add_users('fan', 3)
+        for fan in fans:
+            fan.follow(author)
+        db.session.commit()
+        headers = self.login(author)
+        post_id = self.post_json('/api/posts/', headers, {'title': 't', 'body': 'b'})['id']
+        fan_ids = [fan.id for fan in fans]
+        self.assertEqual(UnreadCounter.get_many(fan_ids, 'unread_followeds_posts_count'), dict.fromkeys(fan_ids, 1))
+
+        with count_queries() as statements:
+            response = self.client.delete('/api/posts/%d' % post_id, headers=headers)
+        self.assertEqual(response.status_code, 204)
+        self.assertLess(len(statements), 30)
+        self.assertEqual(UnreadCounter.get_many(fan_ids, 'unread_followeds_posts_count'), dict.fromkeys(fan_ids, 0))
+        payloads = {n.user_id: n.get_data() for n in Notification.query.filter_by(
+            name='unread_followeds_posts_count')}
+        self.assertEqual(payloads, dict.fromkeys(fan_ids, 0))
+
+    def test_get_post_views(self):
+        """测试读取文章不提交事务, 阅读数批量写入"""
+        u = User(username='laoyang111', email='laoyang111@163.com')
+        post = Post(title='post', author=u)
+        db.session.add_all([u, post])
+        db.session.commit()
+
+        with count_queries() as statements:
+            for _ in range(3):
+                response = self.client.get('/api/posts/%d' % post.id)
+                self.assertEqual(response.status_code, 200)
+        self.assertFalse([s for s in statements if s.startswith('UPDATE')])
+        self.assertEqual(view_counter.pending(post.id), 3)
+
+        # 不存在的文章不计数
+        self.assertEqual(self.client.get('/api/posts/9999').status_code, 404)
+        self.assertEqual(view_counter.pending(9999), 0)
+
+        self.assertEqual(view_counter.flush(), 3)
+        self.assertEqual(view_counter.pending(), 0)
+        db.session.expire_all()
+        self.assertEqual(post.views, 3)
+
+    def test_token_user_cache(self):
+        """测试 token 认证时缓存用户, 用户或角色更新后失效"""
+        u, = add_users('laoyang', 1)
+        token = u.get_token()
+        self.assertEqual(User.verify_token(token).id, u.id)
+        db.session.remove()
+
+        # 命中缓存时不访问数据库
+        with count_queries() as statements:
+            user = User.verify_token(token)
+            self.assertEqual(user.role.slug, 'reader')
+            self.assertTrue(user.seen_recently())
+        self.assertEqual(statements, [])
+        self.assertIsNone(User.verify_token(token + 'x'))
+
+        # 更新用户或角色后重新查询
+        user.about_me = 'hello'
+        db.session.commit()
+        db.session.remove()
+        with count_queries() as statements:
+            self.assertEqual(User.verify_token(token).about_me, 'hello')
+        self.assertTrue(statements)
+        Role.query.filter_by(slug='reader').first().name = 'reader'
+        db.session.commit()
+        db.session.remove()
+        with count_queries() as statements:
+            User.verify_token(token).role
+        self.assertTrue(statements)
+
+        response = self.client.get('/api/users/%d' % u.id, headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(response.status_code, 200)
+
+    def test_token_permission_claims(self):
+        """测试权限校验读取 token 中的权限, 角色变化后旧 token 失效"""
+        u, = add_users('laoyang', 1)
+        headers = self.login(u)
+        self.client.get('/api/metrics', headers=headers)
+
+        with count_queries() as statements:
+            response = self.client.get('/api/metrics', headers=headers)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse([s for s in statements if 'FROM roles' in s])
+
+        # 修改角色权限后, 之前签发的 token 被拒绝
+        reader = Role.query.filter_by(slug='reader').first()
+        reader.add_permission(Permission.ADMIN)
+        db.session.commit()
+        self.assertEqual(reader.version, 1)
+        response = self.client.get('/api/metrics', headers=headers)
+        self.assertEqual(response.status_code, 401)
+        headers = self.login(u)
+        response = self.client.get('/api/metrics', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+        # 更换角色同样使旧 token 失效
+        u = User.query.filter_by(username='laoyang0').first()
+        u.role = Role.query.filter_by(slug='author').first()
+        db.session.commit()
+        response = self.client.get('/api/metrics', headers=headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_poll_notifications(self):
+        """测试长轮询: 已有通知立即返回, 否则等到新通知推送"""
+        u1, u2 = add_users('laoyang', 2, role=None)
+        u1.add_notification('unread_messages_count', 1)
+        db.session.commit()
+        headers = self.login(u1)
+        url = '/api/users/%d/notifications/poll' % u1.id
+
+        response = self.client.get(url + '?timeout=1', headers=headers)
+        events = json.loads(response.get_data(as_text=True))
+        self.assertEqual([(e['name'], e['payload']) for e in events], [('unread_messages_count', 1)])
+        since = events[-1]['timestamp']
+
+        # 没有新通知时超时返回空列表
+        response = self.client.get(url + '?timeout=0.1&since=%r' % since, headers=headers)
+        self.assertEqual(json.loads(response.get_data(as_text=True)), [])
+
+        # 等待期间提交的通知立即推送, 不再查询数据库
+        stream = notification_stream.subscribe(u1.id)
+        notification_stream.publish(u2.id, {'name': 'other', 'payload': 0, 'timestamp': since + 1})
+        u1 = User.query.get(u1.id)
+        u1.add_notification('unread_messages_count', 2)
+        db.session.commit()
+        self.assertEqual(stream.get(1)['payload'], 2)
+        stream.close()
+
+        results = []
+        worker = threading.Thread(target=lambda: results.append(
+            self.client.get(url + '?timeout=5&since=%r' % (since + 10), headers=headers)))
+        worker.start()
+        time.sleep(0.3)
+        notification_stream.publish(u1.id, {'name': 'unread_messages_count', 'payload': 3, 'timestamp': since + 20})
+        worker.join(5)
+        events = json.loads(results[0].get_data(as_text=True))
+        self.assertEqual([e['payload'] for e in events], [3])
+
+    def test_conversations(self):
+        """测试私信会话汇总在发送、删除和阅读后保持一致"""
+        users = add_users('chat', 3, role=None)
+        ids = [u.id for u in users]
+        headers = [self.login(u) for u in users]
+
+        def send(i, j, body):
+            return self.post_json('/api/messages/', headers[i], {'body': body, 'recipient_id': ids[j]})['id']
+
+        send(0, 1, 'a')
+        last = send(0, 1, 'b')
+        send(2, 1, 'c')
+        send(0, 2, 'd')
+
+        response = self.client.get('/api/users/%d/messages-recipients/' % ids[0], headers=headers[0])
+        items = json.loads(response.get_data(as_text=True))['items']
+        self.assertEqual([(i['recipient']['id'], i['total_count'], i['new_count']) for i in items],
+                         [(ids[2], 1, 1), (ids[1], 2, 2)])
+
+        # 删除最后一条私信后, 会话指向上一条
+        response = self.client.delete('/api/messages/%d' % last, headers=headers[0])
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get('/api/users/%d/messages-senders/' % ids[1], headers=headers[1])
+        items = json.loads(response.get_data(as_text=True))['items']
+        self.assertEqual([(i['sender']['id'], i['body'], i['new_count']) for i in items],
+                         [(ids[0], 'a', 1), (ids[2], 'c', 1)])
+
+        # 阅读与对方的私信记录后, 未读数清零
+        self.client.get('/api/users/%d/history-messages/?from=%d' % (ids[1], ids[2]), headers=headers[1])
+        response = self.client.get('/api/users/%d/messages-senders/' % ids[1], headers=headers[1])
+        items = json.loads(response.get_data(as_text=True))['items']
+        self.assertEqual([i.get('is_new') for i in items], [None, None])
+
+    def test_history_messages_cursor(self):
+        """测试私信记录的游标分页"""
+        users = add_users('talk', 3, role=None)
+        ids = [u.id for u in users]
+        headers = [self.login(u) for u in users]
+        for i, (a, b) in enumerate([(0, 1), (1, 0), (2, 1), (0, 1), (1, 0)]):
+            self.post_json('/api/messages/', headers[a], {'body': str(i), 'recipient_id': ids[b]})
+
+        url = '/api/users/%d/history-messages/?from=%d&per_page=2&cursor=' % (ids[1], ids[0])
+        bodies = []
+        while url:
+            response = self.client.get(url, headers=headers[1])
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.get_data(as_text=True))
+            bodies.extend(item['body'] for item in data['items'])
+            url = data['_links']['next']
+        # 倒序返回双方的私信, 不包括第三人的
+        self.assertEqual(bodies, ['4', '3', '1', '0'])
@@ -0,0 +1,168 @@
+"""
+File:test_broadcast.py
+Author:laoyang
+"""
+import json
+import unittest
+from unittest import mock
+
+from app import create_app
+from app.extensions import db, mail
+from app.models import User, Message, Notification, UnreadCounter, Task, TaskChunk
+from app.utils import broadcast as broadcast_module
+from app.utils.broadcast import broadcast, plan_chunks, run_chunk
+from app.utils.email import email_dispatcher
+from tests import TestConfig
+
+
+class BroadcastTestCase(unittest.TestCase):
+    """群发私信测试类"""
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config.update(BROADCAST_CHUNK_SIZE=2, BROADCAST_RATE=0)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_broadcast(self):
+        """测试分批群发私信"""
+        users = [User(username='user%d' % i, email='user%d@163.com' % i) for i in range(6)]
+        db.session.add_all(users)
+        db.session.commit()
+        sender = users[0]
+        UnreadCounter.incr(users[1].id, 'unread_messages_count')
+        db.session.commit()
+
+        progress = []
+        with mail.record_messages() as outbox:
+            sent = broadcast(sender.id, 'hello', progress=lambda sent, total, last_id: progress.append((sent, total)))
+            email_dispatcher.flush()
+        self.assertEqual(sent, 5)
+        self.assertEqual(progress, [(2, 5), (4, 5), (5, 5)])
+        self.assertEqual(len(outbox), 5)
+        self.assertEqual(Message.query.filter_by(sender_id=sender.id).count(), 5)
+        self.assertEqual(UnreadCounter.get(users[1].id, 'unread_messages_count'), 2)
+        self.assertEqual(UnreadCounter.get(users[2].id, 'unread_messages_count'), 1)
+        notification = Notification.query.filter_by(user_id=users[1].id, name='unread_messages_count').one()
+        self.assertEqual(json.loads(notification.payload_json), 2)
+
+        # 只发送给id范围内的用户
+        self.assertEqual(broadcast(sender.id, 'again', min_id=users[2].id, max_id=users[3].id), 2)
+
+    def test_chunked_broadcast(self):
+        """测试按id范围拆分子任务, 汇总进度, 失败的子任务从中断处继续"""
+        users = [User(username='user%d' % i, email='user%d@163.com' % i) for i in range(8)]
+        db.session.add_all(users)
+        db.session.commit()
+        sender = users[0]
+        task = Task(id='task-1', name='send_messages', description='broadcast', user=sender)
+        db.session.add(task)
+        chunks = plan_chunks(task, sender.id, 3)
+        db.session.commit()
+        self.assertEqual([c.total for c in chunks], [3, 3, 1])
+        self.assertEqual(task.get_progress(), 0)
+
+        run_chunk(chunks[0], sender.id, 'hello')
+        self.assertEqual(chunks[0].status, TaskChunk.DONE)
+        self.assertEqual(task.get_progress(), 100 * 3 // 7)
+
+        # 第二批发送时出错, 子任务记为失败, 已发送的部分不再重复
+        send_chunk = broadcast_module.send_chunk
+        calls = []
+
+        def flaky(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError('smtp down')
+            return send_chunk(*args)
+
+        with mock.patch.object(broadcast_module, 'send_chunk', flaky):
+            with self.assertRaises(RuntimeError):
+                run_chunk(chunks[1], sender.id, 'hello')
+        self.assertEqual(chunks[1].status, TaskChunk.FAILED)
+        self.assertEqual(chunks[1].sent, 2)
+
+        run_chunk(chunks[1], sender.id, 'hello')
+        run_chunk(chunks[2], sender.id, 'hello')
+        self.assertEqual(chunks[1].attempts, 2)
+        self.assertEqual(task.get_progress(), 100)
+        for u in users[1:]:
+            self.assertEqual(Message.query.filter_by(recipient_id=u.id).count(), 1)
+
+    def test_broadcast_email_failure(self):
+        """测试邮件发送失败不中断群发, 子任务不会重复插入私信"""
+        users = [User(username='user%d' % i, email='user%d@163.com' % i) for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        sender = users[0]
+        task = Task(id='task-2', name='send_messages', description='broadcast', user=sender)
+        db.session.add(task)
+        chunk = plan_chunks(task, sender.id, 4)[0]
+        db.session.commit()
+
+        def dispatch(msg):
+            if msg.recipients == [users[1].email]:
+                raise RuntimeError('bad address')
+            dispatched.append(msg.recipients[0])
+
+        dispatched = []
+        with mock.patch.object(broadcast_module, 'dispatch_email', dispatch):
+            run_chunk(chunk, sender.id, 'hello')
+        self.assertEqual(chunk.status, TaskChunk.DONE)
+        self.assertEqual(dispatched, [u.email for u in users[2:]])
+        self.assertEqual(Message.query.filter_by(sender_id=sender.id).count(), 4)
+
+        # 批次中途失败时私信和进度一起回滚, 重试后每人只收到一条
+        chunk.status, chunk.sent, chunk.last_id = TaskChunk.QUEUED, 0, None
+        Message.query.delete()
+        db.session.commit()
+        with mock.patch.object(broadcast_module, 'send_chunk_emails', side_effect=RuntimeError('crash')):
+            with self.assertRaises(RuntimeError):
+                run_chunk(chunk, sender.id, 'hello')
+        self.assertEqual((chunk.sent, chunk.last_id), (2, users[2].id))
+        run_chunk(chunk, sender.id, 'hello')
+        self.assertEqual(Message.query.filter_by(sender_id=sender.id).count(), 4)
+
+    def test_retry_failed_chunks(self):
+        """测试只重试失败和 worker 退出后停在 running 的子任务, 状态提交后才重新入队"""
+        users = [User(username='user%d' % i, email='user%d@163.com' % i) for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        task = Task(id='task-3', name='send_messages', description='broadcast', user=users[0])
+        db.session.add(task)
+        chunks = plan_chunks(task, users[0].id, 1)
+        for chunk, status in zip(chunks, [TaskChunk.DONE, TaskChunk.FAILED, TaskChunk.RUNNING, TaskChunk.RUNNING]):
+            chunk.status, chunk.job_id = status, 'job-%d' % chunk.id
+        db.session.commit()
+        # 第3个子任务的 worker 已退出, job 被 rq 记为失败; 第4个仍在执行
+        lost, alive = chunks[2].job_id, chunks[3].job_id
+        events = []
+
+        class FakeJob(object):
+            def __init__(self, job_id):
+                self.id = job_id
+                self.is_failed = job_id != alive
+
+            def requeue(self):
+                events.append(('requeue', self.id))
+
+        def on_commit(session):
+            events.append(('commit',))
+
+        db.event.listen(db.session, 'after_commit', on_commit)
+        self.app.task_queue = mock.Mock()
+        try:
+            with mock.patch('rq.registry.StartedJobRegistry'), \
+                    mock.patch('rq.job.Job.fetch', side_effect=lambda job_id, connection: FakeJob(job_id)):
+                self.assertEqual(task.retry_failed_chunks(), 2)
+        finally:
+            db.event.remove(db.session, 'after_commit', on_commit)
+        self.assertEqual(events, [('commit',), ('requeue', chunks[1].job_id), ('requeue', lost)])
+        self.assertEqual([c.status for c in chunks],
+                         [TaskChunk.DONE, TaskChunk.QUEUED, TaskChunk.QUEUED, TaskChunk.RUNNING])
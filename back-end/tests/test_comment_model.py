@@ -0,0 +1,81 @@
+"""
+File:test_comment_model.py
+Author:laoyang
+"""
+import unittest
+from app import create_app
+from app.models import User, Post, Comment, UnreadCounter, Notification
+from tests import TestConfig
+from app.extensions import db, adjacency_cache
+from app.utils.cache import count_cache
+
+
+class CommentModelTestCase(unittest.TestCase):
+    """评论模型测试类"""
+    def setUp(self):
+        """每个测试用例执行前启动"""
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        """测试用例执行完毕后启动"""
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_comment_path(self):
+        """测试评论树的物化路径"""
+        u = User(username='john', email='john@163.com')
+        post = Post(title='post', author=u)
+        root = Comment(body='root', post=post, author=u)
+        child = Comment(body='child', post=post, author=u, parent=root)
+        db.session.add_all([u, post, root, child])
+        db.session.commit()
+        # 只设置 parent_id 的评论
+        grandchild = Comment(body='grandchild', post=post, author=u, parent_id=child.id)
+        other = Comment(body='other', post=post, author=u)
+        db.session.add_all([grandchild, other])
+        db.session.commit()
+
+        self.assertEqual(grandchild.path, root.path + child.path[-11:] + grandchild.path[-11:])
+        self.assertEqual([root.depth, child.depth, grandchild.depth], [0, 1, 2])
+        self.assertEqual(root.get_descendants(), {child, grandchild})
+        self.assertEqual(grandchild.get_ancestors(), [child, root])
+        self.assertEqual(other.get_descendants(), set())
+
+        u.liked_comments.append(grandchild)
+        db.session.commit()
+        self.assertEqual(count_cache.count(Comment.query), 4)
+        child.delete_thread()
+        db.session.commit()
+        self.assertEqual(Comment.query.all(), [root, other])
+        self.assertEqual(count_cache.count(Comment.query), 2)
+        self.assertEqual(u.liked_comments.count(), 0)
+
+    def test_delete_thread_likes(self):
+        """测试删除评论树时减少被删评论作者的未读点赞数, 并移除点赞集合缓存"""
+        u1 = User(username='john', email='john@163.com')
+        u2 = User(username='susan', email='susan@163.com')
+        post = Post(title='post', author=u1)
+        root = Comment(body='root', post=post, author=u2)
+        child = Comment(body='child', post=post, author=u1, parent=root)
+        other = Comment(body='other', post=post, author=u2)
+        db.session.add_all([u1, u2, post, root, child, other])
+        db.session.commit()
+        root.liked_by(u1)
+        other.liked_by(u1)
+        child.liked_by(u2)
+        db.session.commit()
+        self.assertTrue(adjacency_cache.contains('liked_comments', u1.id, root.id))
+        self.assertEqual([UnreadCounter.get(u.id, 'unread_likes_count') for u in (u1, u2)], [1, 2])
+        root_id, child_id = root.id, child.id
+
+        root.delete_thread()
+        db.session.commit()
+        self.assertEqual([UnreadCounter.get(u.id, 'unread_likes_count') for u in (u1, u2)], [0, 1])
+        self.assertEqual(Notification.query.filter_by(user_id=u2.id, name='unread_likes_count').one().get_data(), 1)
+        self.assertFalse(adjacency_cache.contains('liked_comments', u1.id, root_id))
+        self.assertFalse(adjacency_cache.contains('liked_comments', u2.id, child_id))
+        self.assertTrue(adjacency_cache.contains('liked_comments', u1.id, other.id))
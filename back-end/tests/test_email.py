@@ -0,0 +1,56 @@
+"""
+File:test_email.py
+Author:laoyang
+"""
+import os
+import tempfile
+import unittest
+
+from app import create_app
+from app.utils.email import FileTransport, build_email, deliver, email_dispatcher, email_to_dict, send_email
+from tests import TestConfig
+
+
+class EmailDispatcherTestCase(unittest.TestCase):
+    """后台发送邮件测试类"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.app = create_app(TestConfig)
+        self.app.config.update(MAIL_TRANSPORT='file', MAIL_FILE_PATH=self.path, MAIL_WORKERS=2, MAIL_QUEUE_SIZE=4)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        email_dispatcher.shutdown()
+        self.app_context.pop()
+        os.remove(self.path)
+
+    def test_send_email(self):
+        """测试邮件进入队列, 由发送线程写出, flush 等待发送完成"""
+        for i in range(20):
+            send_email('subject %d' % i, recipients=['user%d@163.com' % i], sender='madblog@163.com',
+                       text_body='hello', html_body='<p>hello</p>')
+        self.assertTrue(email_dispatcher.flush(timeout=10))
+        self.assertEqual(email_dispatcher.pending(), 0)
+        with open(self.path, encoding='utf-8') as f:
+            content = f.read()
+        self.assertEqual(content.count('Subject: subject'), 20)
+
+    def test_deliver_batch(self):
+        """测试一批邮件共用一个连接发送, 失败的邮件按重试次数分为重试和死信"""
+        class FlakyTransport(FileTransport):
+            def send(self, msg):
+                if 'bad' in msg.recipients[0]:
+                    raise RuntimeError('rejected')
+                super().send(msg)
+
+        payloads = [email_to_dict(build_email('subject', [address], 'madblog@163.com', 'hello', '<p>hello</p>'),
+                                  attempts=attempts)
+                    for address, attempts in [('a@163.com', 0), ('bad1@163.com', 0), ('bad2@163.com', 2)]]
+        retry, dead = deliver(payloads, FlakyTransport(self.path), max_retries=3)
+        self.assertEqual([(d['recipients'], d['attempts']) for d in retry], [(['bad1@163.com'], 1)])
+        self.assertEqual([(d['recipients'], d['attempts']) for d in dead], [(['bad2@163.com'], 3)])
+        with open(self.path, encoding='utf-8') as f:
+            self.assertEqual(f.read().count('Subject: subject'), 1)